@@ -0,0 +1,264 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Optional, Dict, Callable, List, Tuple
+
+import xxhash
+
+from hashing import hash_file, hash_files
+from processes import run_process
+from resources import MB
+
+# Bump this to stop using the artifacts stored so far (e.g., when the way they are stored changes).
+ARTIFACT_CACHE_VERSION = 1
+DEFAULT_ARTIFACT_CACHE_SIZE = 50 * 1024  # MB
+
+EXPORTS_DIRECTORY_NAME = 'exports'
+BLENDS_DIRECTORY_NAME = 'blends'
+
+# Written by an interrupted store (e.g., on a machine that crashed), and removed once this old.
+STALE_TEMPORARY_FILE_AGE = 24 * 60 * 60
+
+TOOL_VERSIONS_FILENAME = '.bdktools.json'
+# Must match the prefix written by `blender/versions.py`.
+VERSIONS_RESULT_PREFIX = 'BDK_VERSIONS:'
+
+_tool_versions_lock = threading.Lock()
+_umodel_fingerprint: Optional[str] = None
+_blender_fingerprint: Optional[str] = None
+
+
+# A cache of exported package directories and built `.blend` files, shared by every build that points at the same
+# directory (e.g., a mounted share), so that a package that was already built somewhere with the same tools doesn't
+# have to be built again. Artifacts are stored under a hash of everything they were built from, and the least
+# recently used ones are evicted once the cache is larger than `max_size`.
+# Every artifact is a single file that is written to a temporary file and renamed into place, so that concurrent
+# builds never see partial artifacts.
+class ArtifactCache:
+
+    def __init__(self, directory: Optional[str] = None, max_size: int = DEFAULT_ARTIFACT_CACHE_SIZE * MB):
+        self.directory = directory
+        self.max_size = max_size
+        self.restored_count = 0
+        self.stored_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.directory is not None
+
+    def _get_root_directory(self) -> str:
+        return os.path.join(self.directory, f'v{ARTIFACT_CACHE_VERSION}')
+
+    def _get_path(self, kind: str, key: str, extension: str) -> str:
+        return os.path.join(self._get_root_directory(), kind, key[:2], key + extension)
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @staticmethod
+    def _touch(path: str):
+        # The modification time marks when the artifact was last used, since access times aren't updated on many
+        # file systems.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _write(path: str, write: Callable[[str], None]):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        os.close(fd)
+        try:
+            write(temporary_path)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.isfile(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def restore_export(self, key: str, package_directory: str) -> bool:
+        # Extracts the exported files of the package into its directory, and returns whether they were in the cache.
+        path = self._get_path(EXPORTS_DIRECTORY_NAME, key, '.zip')
+        try:
+            with zipfile.ZipFile(path) as archive:
+                archive.extractall(package_directory)
+        except (OSError, zipfile.BadZipFile):
+            # The artifact doesn't exist, or was evicted by another build while it was being read.
+            return False
+        self._touch(path)
+        self._count('restored_count')
+        return True
+
+    def store_export(self, key: str, package_directory: str):
+        # Cube map images are left out, since they are rendered into the export directory by the build itself.
+        def write(temporary_path: str):
+            with zipfile.ZipFile(temporary_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+                for directory, _, filenames in os.walk(package_directory):
+                    for filename in filenames:
+                        if os.path.basename(directory) == 'Cubemap' and filename.endswith('.tga'):
+                            continue
+                        file_path = os.path.join(directory, filename)
+                        archive.write(file_path, os.path.relpath(file_path, package_directory))
+
+        if not os.path.isdir(package_directory):
+            return
+        try:
+            self._write(self._get_path(EXPORTS_DIRECTORY_NAME, key, '.zip'), write)
+        except OSError as e:
+            print(f'Failed to store {package_directory} in the artifact cache: {e}')
+            return
+        self._count('stored_count')
+
+    def restore_blend(self, key: str, output_path: str) -> bool:
+        path = self._get_path(BLENDS_DIRECTORY_NAME, key, '.blend')
+        if not os.path.isfile(path):
+            return False
+        try:
+            self._write(output_path, lambda x: shutil.copyfile(path, x))
+        except OSError:
+            return False
+        self._touch(path)
+        self._count('restored_count')
+        return True
+
+    def store_blend(self, key: str, blend_path: str):
+        try:
+            self._write(self._get_path(BLENDS_DIRECTORY_NAME, key, '.blend'), lambda x: shutil.copyfile(blend_path, x))
+        except OSError as e:
+            print(f'Failed to store {blend_path} in the artifact cache: {e}')
+            return
+        self._count('stored_count')
+
+    def _list_artifacts(self) -> List[Tuple[float, int, str]]:
+        # Returns the last use time, size and path of every artifact, and removes stale temporary files.
+        artifacts = []
+        now = time.time()
+        for directory, _, filenames in os.walk(self._get_root_directory()):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                    if filename.endswith('.tmp'):
+                        if now - stat.st_mtime > STALE_TEMPORARY_FILE_AGE:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                artifacts.append((stat.st_mtime, stat.st_size, path))
+        return artifacts
+
+    def trim(self):
+        # Evicts the least recently used artifacts until the cache fits in `max_size`, and reports what the build
+        # restored and stored.
+        if not self.is_enabled:
+            return
+        artifacts = sorted(self._list_artifacts())
+        size = sum(x[1] for x in artifacts)
+        evicted_count = 0
+        evicted_size = 0
+        for _, artifact_size, path in artifacts:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= artifact_size
+            evicted_count += 1
+            evicted_size += artifact_size
+        message = f'Artifact cache: {self.restored_count} restored | {self.stored_count} stored'
+        if evicted_count > 0:
+            message += f' | {evicted_count} evicted ({evicted_size / MB:.0f} MB)'
+        print(f'{message} | {size / MB:.0f} of {self.max_size / MB:.0f} MB used')
+        self.restored_count = 0
+        self.stored_count = 0
+
+
+# Shared by every stage, and set from the command line. It is disabled until a directory is set.
+artifact_cache = ArtifactCache()
+
+
+def _hash_key(values: List) -> str:
+    return xxhash.xxh3_128_hexdigest(json.dumps(values).encode())
+
+
+def _hash_addon(path: str) -> str:
+    if os.path.isfile(path):
+        return hash_file(path)
+    paths = sorted(str(x) for x in Path(path).rglob('*') if x.is_file() and '__pycache__' not in x.parts)
+    hashes = hash_files(paths)
+    return _hash_key([[os.path.relpath(x, path), hashes[x]] for x in paths])
+
+
+def _get_blender_versions() -> Dict:
+    # Asks Blender for its version and those of the addons (see `blender/versions.py`). Starting Blender takes a
+    # while, so the result is kept in the build directory until Blender itself changes.
+    blender_path = str(Path(os.environ['BLENDER_PATH']).resolve())
+    stat = os.stat(blender_path)
+    blender_stat = [blender_path, stat.st_size, stat.st_mtime]
+    cache_path = os.path.join(str(Path(os.environ['BUILD_DIRECTORY']).resolve()), TOOL_VERSIONS_FILENAME)
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached['blender_stat'] == blender_stat and all(os.path.exists(x['path']) for x in cached['versions']['addons'].values()):
+            return cached['versions']
+    except (OSError, ValueError, KeyError):
+        pass
+    args = [blender_path, '--background', '--python', './blender/versions.py']
+    lines = []
+
+    def on_output(line: str):
+        if line.startswith(VERSIONS_RESULT_PREFIX):
+            lines.append(line)
+
+    run_process(args, on_output=on_output)
+    if len(lines) == 0:
+        raise RuntimeError('Blender and addon versions could not be determined')
+    versions = json.loads(lines[-1][len(VERSIONS_RESULT_PREFIX):])
+    with open(cache_path, 'w') as f:
+        json.dump({'blender_stat': blender_stat, 'versions': versions}, f)
+    return versions
+
+
+def get_umodel_fingerprint() -> str:
+    global _umodel_fingerprint
+    with _tool_versions_lock:
+        if _umodel_fingerprint is None:
+            _umodel_fingerprint = hash_file(str(Path(os.environ['UMODEL_PATH']).resolve()))
+        return _umodel_fingerprint
+
+
+def get_blender_fingerprint() -> str:
+    # Identifies the Blender and addon versions. Addons are identified by the contents of their files as well, since
+    # development versions change without their version number changing.
+    global _blender_fingerprint
+    with _tool_versions_lock:
+        if _blender_fingerprint is None:
+            versions = _get_blender_versions()
+            addons = {name: [x['version'], _hash_addon(x['path'])] for name, x in sorted(versions['addons'].items())}
+            _blender_fingerprint = _hash_key([versions['blender'], addons])
+        return _blender_fingerprint
+
+
+def get_export_key(package_path: str, package_hash: str, import_hashes: Dict[str, Optional[str]]) -> str:
+    # The exported files depend on the contents of the package, its name (which the objects of the package reference
+    # themselves by), and the packages that it imports assets from.
+    return _hash_key(['export', os.path.basename(package_path), package_hash, sorted(import_hashes.items()),
+                      get_umodel_fingerprint()])
+
+
+def get_blend_key(package_path: str, output_fingerprint: str, asset_hashes: Dict[str, str], blend_version: str) -> str:
+    # A library depends on everything that was exported for the package, the objects of other packages that its
+    # assets reference, and where it (and the libraries it links to) are, since links are stored as paths.
+    library_directories = [str(Path(os.environ[x]).resolve()) for x in ('LIBRARY_DIRECTORY', 'MAPS_DIRECTORY')]
+    return _hash_key(['blend', Path(package_path).as_posix(), output_fingerprint, sorted(asset_hashes.items()),
+                      blend_version, get_blender_fingerprint(), library_directories])
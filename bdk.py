@@ -1,6 +1,8 @@
 import argparse
+import os
 import re
 from argparse import ArgumentParser
+from pathlib import Path
 from typing import Optional
 
 from dotenv import load_dotenv
@@ -10,6 +12,9 @@ UMODEL_VERSION_MIN = 1601
 IO_SCENE_PSK_PSA_VERSION_MIN = '5.0.0'
 IO_IMPORT_UMATERIAL_VERSION_MIN = '0.1.0'
 
+# Commands that write a build trace when they finish.
+TRACED_COMMANDS = ['export', 'build-cubemaps', 'build', 'build-previews', 'rebuild']
+
 load_dotenv()
 
 
@@ -55,12 +60,40 @@ def env(args: argparse.Namespace):
 
 def build(args: argparse.Namespace):
     from build import build_assets
-    build_assets(dry=args.dry, mod=args.mod, clean=args.clean, no_export=args.no_export, name_filter=args.name_filter, no_cubemaps=args.no_cubemaps)
+    set_memory_headroom(args)
+    set_process_limits(args)
+    set_artifact_cache(args)
+    set_content_store(args)
+    set_texture_transcoder(args)
+    release_quarantine(args)
+    worker_max_memory = args.worker_max_memory * 1024 * 1024 if args.worker_max_memory else None
+    build_assets(dry=args.dry, mod=args.mod, clean=args.clean, no_export=args.no_export, name_filter=args.name_filter, no_cubemaps=args.no_cubemaps,
+                 cubemap_engine=args.cubemap_engine, export_jobs=args.export_jobs, cubemap_jobs=args.cubemap_jobs, blend_jobs=args.blend_jobs,
+                 worker_max_jobs=args.worker_max_jobs, worker_max_memory=worker_max_memory, pipeline=args.pipeline, queue_size=args.queue_size,
+                 defer_previews=args.defer_previews, shard=args.shard)
 
 
 def export(args: argparse.Namespace):
     from build import export_assets
-    export_assets(dry=args.dry, mod=args.mod, clean=args.clean, name_filter=args.name_filter)
+    set_memory_headroom(args)
+    set_process_limits(args)
+    set_artifact_cache(args)
+    set_content_store(args)
+    release_quarantine(args)
+    export_assets(dry=args.dry, mod=args.mod, clean=args.clean, name_filter=args.name_filter, jobs=args.jobs)
+
+
+def watch(args: argparse.Namespace):
+    from watch import watch_assets
+    set_memory_headroom(args)
+    set_process_limits(args)
+    set_artifact_cache(args)
+    set_content_store(args)
+    set_texture_transcoder(args)
+    worker_max_memory = args.worker_max_memory * 1024 * 1024 if args.worker_max_memory else None
+    watch_assets(mod=args.mod, name_filter=args.name_filter, cubemap_engine=args.cubemap_engine, export_jobs=args.export_jobs,
+                 cubemap_jobs=args.cubemap_jobs, blend_jobs=args.blend_jobs, worker_max_jobs=args.worker_max_jobs,
+                 worker_max_memory=worker_max_memory, debounce=args.debounce, polling=args.poll, poll_interval=args.poll_interval)
 
 
 def rebuild(args: argparse.Namespace):
@@ -70,16 +103,210 @@ def rebuild(args: argparse.Namespace):
 
 def build_cubemaps(args: argparse.Namespace):
     from build import build_cube_maps
-    build_cube_maps(clean=args.clean, name_filter=args.name_filter)
+    set_memory_headroom(args)
+    set_process_limits(args)
+    build_cube_maps(clean=args.clean, name_filter=args.name_filter, engine=args.cubemap_engine, jobs=args.jobs)
+
+
+def build_previews(args: argparse.Namespace):
+    from build import build_previews
+    set_memory_headroom(args)
+    set_process_limits(args)
+    build_previews(name_filter=args.name_filter, jobs=args.jobs)
 
 
 def init(args: argparse.Namespace):
     pass
 
 
+def query(args: argparse.Namespace):
+    from catalog import Catalog
+    catalog = Catalog.load()
+    # The name can be a reference (e.g., `Texture'Package.Group.Name'`), a qualified name (`Package.Name`), or just
+    # the name of a package or object.
+    if '\'' in args.name:
+        reference = UReference.from_string(args.name)
+        package_name, object_name = reference.package_name, reference.object_name
+    elif '.' in args.name:
+        values = args.name.split('.')
+        package_name, object_name = values[0], values[-1]
+    else:
+        package_name, object_name = args.name, None
+    results = catalog.find_referencing_packages(package_name, object_name)
+    if object_name is None and len(results) == 0:
+        results = catalog.find_referencing_packages(object_name=args.name)
+    print(f'{len(results)} package(s) reference {args.name}')
+    for package_path, reference_count in results:
+        print(f'{package_path} ({reference_count} reference(s))')
+
+
+def ls(args: argparse.Namespace):
+    import fnmatch
+    from build import find_package_paths
+    from packages import read_package, PackageError
+    package_paths = find_package_paths(args.package, args.mod)
+    if len(package_paths) == 0:
+        print(f'No package named {args.package}')
+    for package_path in package_paths:
+        try:
+            package = read_package(package_path)
+        except PackageError as e:
+            print(f'{package_path}: {e}')
+            continue
+        print(f'{package_path} (version {package.version}/{package.licensee_version}, {len(package.names)} names, '
+              f'{len(package.imports)} imports, {len(package.exports)} exports)')
+        if args.imports:
+            objects = [(x.class_name, package.get_object_path(-i - 1), None) for i, x in enumerate(package.imports)]
+        else:
+            objects = [(package.get_export_class_name(x), package.get_object_path(i + 1), x.serial_size)
+                       for i, x in enumerate(package.exports)]
+        for class_name, path, size in objects:
+            if args.class_filter is not None and not fnmatch.fnmatch(class_name, args.class_filter):
+                continue
+            print(f'{class_name}\'{path}\'' + (f' ({size} bytes)' if size is not None else ''))
+
+
+def logs(args: argparse.Namespace):
+    from build import find_package_paths
+    from joblogs import find_job_logs, print_job_log
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    package_paths = find_package_paths(args.package, args.mod)
+    if len(package_paths) == 0:
+        print(f'No package named {args.package}')
+    for package_path in package_paths:
+        log_paths = find_job_logs(os.path.relpath(package_path, root_directory), args.stage)
+        if len(log_paths) == 0:
+            print(f'No logs for {package_path}')
+        for log_path in log_paths:
+            print_job_log(log_path, args.tail)
+
+
+def quarantine(args: argparse.Namespace):
+    from build import print_quarantined_packages, release_quarantined_packages
+    if args.release:
+        release_quarantined_packages(args.name_filter)
+    else:
+        print_quarantined_packages(args.name_filter)
+
+
+def merge_manifests(args: argparse.Namespace):
+    from sharding import merge_manifests
+    merge_manifests(args.fragments or None, keep=args.keep)
+
+
+def stats(args: argparse.Namespace):
+    from tracing import print_stats
+    print_stats(command=args.trace_command, run_count=args.runs, package_count=args.packages)
+
+
+def add_cubemap_engine_argument(parser: ArgumentParser):
+    parser.add_argument('--cubemap_engine', required=False, choices=['blender', 'numpy'], default='blender',
+                        help='convert cube maps by rendering them in Blender or with NumPy')
+
+
+def jobs_type(value: str):
+    if value == 'auto':
+        return value
+    return int(value)
+
+
+def shard_type(value: str):
+    from sharding import Shard
+    return Shard.from_string(value)
+
+
+def add_jobs_argument(parser: ArgumentParser, name: str, process_name: str, *aliases: str):
+    parser.add_argument(name, *aliases, required=False, type=jobs_type, default='auto',
+                        help=f'number of concurrent {process_name} processes, or "auto" to size it from the CPU count and available memory')
+
+
+def add_memory_headroom_argument(parser: ArgumentParser):
+    parser.add_argument('--memory_headroom', required=False, type=int, default=1024,
+                        help='memory (MB) to leave free; new processes wait until there is enough')
+
+
+def set_memory_headroom(args: argparse.Namespace):
+    from resources import memory_gate, MB
+    memory_gate.headroom = args.memory_headroom * MB
+
+
+def add_process_limit_arguments(parser: ArgumentParser):
+    parser.add_argument('--timeout_scale', required=False, type=float, default=1.0,
+                        help='multiplier for the timeouts of umodel and Blender, which scale with package size (0 = no timeouts)')
+    parser.add_argument('--hang_timeout', required=False, type=float, default=300,
+                        help='seconds without output or CPU usage after which a process is considered hung and killed (0 = never)')
+    parser.add_argument('--retries', required=False, type=int, default=2,
+                        help='number of times a package that failed to export or crashed Blender is retried')
+
+
+def set_process_limits(args: argparse.Namespace):
+    from processes import process_limits
+    process_limits.timeout_scale = args.timeout_scale
+    process_limits.hang_timeout = args.hang_timeout or None
+    process_limits.retries = max(0, args.retries)
+
+
+def add_artifact_cache_arguments(parser: ArgumentParser):
+    parser.add_argument('--artifact_cache', required=False, default=os.environ.get('ARTIFACT_CACHE_DIRECTORY', None),
+                        help='directory (e.g., on a share) of exported packages and libraries built with the same tools, '
+                             'which are restored instead of being built again (default: $ARTIFACT_CACHE_DIRECTORY)')
+    parser.add_argument('--artifact_cache_size', required=False, type=int,
+                        default=int(os.environ.get('ARTIFACT_CACHE_SIZE', 50 * 1024)),
+                        help='size (MB) of the artifact cache, beyond which the least recently used artifacts are evicted '
+                             '(default: $ARTIFACT_CACHE_SIZE or 51200)')
+    parser.add_argument('--no_artifact_cache', required=False, action='store_true', default=False,
+                        help='neither restore from nor store in the artifact cache')
+
+
+def set_artifact_cache(args: argparse.Namespace):
+    from artifacts import artifact_cache
+    from resources import MB
+    artifact_cache.directory = args.artifact_cache if not args.no_artifact_cache else None
+    artifact_cache.max_size = args.artifact_cache_size * MB
+
+
+def add_dedup_argument(parser: ArgumentParser):
+    parser.add_argument('--dedup', required=False, nargs='?', choices=['hardlink', 'reflink'], const='hardlink',
+                        default=None,
+                        help='replace identical exported files with hardlinks (the default) or reflinks to a single copy '
+                             'in the build directory, and only transcode identical textures once')
+
+
+def set_content_store(args: argparse.Namespace):
+    from dedup import content_store
+    content_store.method = args.dedup
+
+
+def add_texture_arguments(parser: ArgumentParser):
+    parser.add_argument('--textures', required=False, choices=['tga', 'png', 'half', 'quarter'], default='tga',
+                        help='textures that libraries reference: the exported TGA files, or PNG files transcoded from '
+                             'them at full, half or quarter resolution (proxies for viewport use); switching rebuilds '
+                             'the libraries')
+    add_jobs_argument(parser, '--texture_jobs', 'texture transcoding')
+
+
+def set_texture_transcoder(args: argparse.Namespace):
+    from build import get_texture_job_count
+    from textures import texture_transcoder
+    texture_transcoder.variant = args.textures
+    texture_transcoder.job_count = get_texture_job_count(args.texture_jobs)
+
+
+def release_quarantine(args: argparse.Namespace):
+    if args.retry_quarantined and not args.dry:
+        from build import release_quarantined_packages
+        release_quarantined_packages(args.name_filter)
+
+
 def add_common_arguments(parser: ArgumentParser):
     parser.add_argument('--dry', required=False, action='store_true', default=False)
     parser.add_argument('--clean', required=False, action='store_true', default=False)
+    parser.add_argument('--retry_quarantined', required=False, action='store_true', default=False,
+                        help='build the packages that were quarantined after failing repeatedly')
+    add_memory_headroom_argument(parser)
+    add_process_limit_arguments(parser)
+    add_artifact_cache_arguments(parser)
+    add_dedup_argument(parser)
 
 
 if __name__ == '__main__':
@@ -91,29 +318,119 @@ if __name__ == '__main__':
 
     export_parser = subparsers.add_parser('export')
     export_parser.add_argument('--name_filter', required=False, default=None)
+    add_jobs_argument(export_parser, '--jobs', 'umodel')
     add_common_arguments(export_parser)
     export_parser.set_defaults(func=export)
 
     build_cubemaps_parser = subparsers.add_parser('build-cubemaps')
     build_cubemaps_parser.add_argument('--clean', required=False, default=False, action='store_true')
+    build_cubemaps_parser.add_argument('--name_filter', required=False, default=None)
+    add_cubemap_engine_argument(build_cubemaps_parser)
+    add_jobs_argument(build_cubemaps_parser, '--jobs', 'cube map')
+    add_memory_headroom_argument(build_cubemaps_parser)
+    add_process_limit_arguments(build_cubemaps_parser)
     build_cubemaps_parser.set_defaults(func=build_cubemaps)
 
     build_parser = subparsers.add_parser('build')
     build_parser.add_argument('--no_export', required=False, action='store_true')
     build_parser.add_argument('--no_cubemaps', required=False, action='store_true')
     build_parser.add_argument('--name_filter', required=False, default=None)
+    add_cubemap_engine_argument(build_parser)
+    add_jobs_argument(build_parser, '--export_jobs', 'umodel')
+    add_jobs_argument(build_parser, '--cubemap_jobs', 'cube map')
+    add_jobs_argument(build_parser, '--blend_jobs', 'Blender worker', '--workers')
+    build_parser.add_argument('--worker_max_jobs', required=False, type=int, default=100, help='packages a Blender worker builds before it is restarted')
+    build_parser.add_argument('--worker_max_memory', required=False, type=int, default=4096, help='memory usage (MB) after which a Blender worker is restarted (0 = no limit)')
+    build_parser.add_argument('--pipeline', required=False, action='store_true', help='blend packages as soon as they are exported instead of after every package is')
+    build_parser.add_argument('--queue_size', required=False, type=int, default=64, help='maximum number of exported packages waiting to be blended in --pipeline mode')
+    build_parser.add_argument('--defer_previews', required=False, action='store_true', help='generate asset previews in a low-priority pass after every package is blended')
+    build_parser.add_argument('--shard', required=False, type=shard_type, default=None, metavar='K/N',
+                              help='build the Kth of N shares of the out-of-date packages (e.g., one per machine), into a manifest fragment; '
+                                   'every shard must start from the same manifest')
+    add_texture_arguments(build_parser)
     add_common_arguments(build_parser)
     build_parser.set_defaults(func=build)
 
+    watch_parser = subparsers.add_parser('watch', help='rebuild packages as soon as they are saved')
+    watch_parser.add_argument('--name_filter', required=False, default=None)
+    add_cubemap_engine_argument(watch_parser)
+    add_jobs_argument(watch_parser, '--export_jobs', 'umodel')
+    add_jobs_argument(watch_parser, '--cubemap_jobs', 'cube map')
+    add_jobs_argument(watch_parser, '--blend_jobs', 'Blender worker', '--workers')
+    watch_parser.add_argument('--worker_max_jobs', required=False, type=int, default=100, help='packages a Blender worker builds before it is restarted')
+    watch_parser.add_argument('--worker_max_memory', required=False, type=int, default=4096, help='memory usage (MB) after which a Blender worker is restarted (0 = no limit)')
+    watch_parser.add_argument('--debounce', required=False, type=float, default=1.0, help='seconds to wait for more changes before rebuilding')
+    watch_parser.add_argument('--poll', required=False, action='store_true', help='scan for changes periodically instead of using inotify')
+    watch_parser.add_argument('--poll_interval', required=False, type=float, default=2.0, help='seconds between scans when polling')
+    add_memory_headroom_argument(watch_parser)
+    add_process_limit_arguments(watch_parser)
+    add_artifact_cache_arguments(watch_parser)
+    add_dedup_argument(watch_parser)
+    add_texture_arguments(watch_parser)
+    watch_parser.set_defaults(func=watch)
+
+    build_previews_parser = subparsers.add_parser('build-previews', help='generate the asset previews deferred by build --defer_previews')
+    build_previews_parser.add_argument('--name_filter', required=False, default=None)
+    add_jobs_argument(build_previews_parser, '--jobs', 'Blender worker')
+    add_memory_headroom_argument(build_previews_parser)
+    add_process_limit_arguments(build_previews_parser)
+    build_previews_parser.set_defaults(func=build_previews, jobs=1)
+
     env_parser = subparsers.add_parser('env')
     env_parser.set_defaults(func=env)
 
     init_parser = subparsers.add_parser('init')
     init_parser.set_defaults(func=init)
 
+    query_parser = subparsers.add_parser('query', help='list the exported packages that reference a package or object')
+    query_parser.add_argument('name', help='package or object name, or a reference (e.g., Texture\'Package.Name\')')
+    query_parser.set_defaults(func=query)
+
+    ls_parser = subparsers.add_parser('ls', help='list the objects in a package, read from its header without exporting it')
+    ls_parser.add_argument('package', help='package name (e.g., MyTextures or MyTextures.utx) or path')
+    ls_parser.add_argument('--imports', required=False, action='store_true', help='list the objects it imports instead')
+    ls_parser.add_argument('--class_filter', required=False, default=None, help='only list objects of matching classes (e.g., Texture)')
+    ls_parser.set_defaults(func=ls)
+
+    logs_parser = subparsers.add_parser('logs', help='show the output of the latest jobs that built a package')
+    logs_parser.add_argument('package', help='package name (e.g., MyTextures or MyTextures.utx) or path')
+    logs_parser.add_argument('--stage', required=False, default=None, choices=['export', 'cubemap', 'blend', 'previews'])
+    logs_parser.add_argument('--tail', required=False, type=int, default=None, help='only show the last N lines of each log')
+    logs_parser.set_defaults(func=logs)
+
+    quarantine_parser = subparsers.add_parser('quarantine', help='list the packages that are skipped because they failed repeatedly')
+    quarantine_parser.add_argument('--name_filter', required=False, default=None)
+    quarantine_parser.add_argument('--release', required=False, action='store_true', help='build them again on the next build')
+    quarantine_parser.set_defaults(func=quarantine)
+
+    merge_manifests_parser = subparsers.add_parser('merge-manifests', help='combine the manifest fragments written by build --shard into the manifest')
+    merge_manifests_parser.add_argument('fragments', nargs='*', help='fragment paths (by default, every fragment in the build directory)')
+    merge_manifests_parser.add_argument('--keep', required=False, action='store_true', help='keep the fragments after merging them')
+    merge_manifests_parser.set_defaults(func=merge_manifests)
+
+    stats_parser = subparsers.add_parser('stats', help='compare the trace of the latest build with earlier ones')
+    stats_parser.add_argument('--command', dest='trace_command', required=False, default='build', choices=TRACED_COMMANDS)
+    stats_parser.add_argument('--runs', required=False, type=int, default=5, help='number of earlier runs to compare with')
+    stats_parser.add_argument('--packages', required=False, type=int, default=10, help='number of packages to list')
+    stats_parser.set_defaults(func=stats)
+
     args = parser.parse_args()
 
+    # Ctrl+C kills the child processes of the build (e.g., umodel and Blender) instead of leaving them running.
+    from processes import process_engine
+    process_engine.handle_interrupts()
+
+    # The output of child processes goes to per-job logs (see `bdk logs`), and only to the console as well if asked.
+    from joblogs import job_logs
+    job_logs.echo = args.verbose
+
     if args.command is None:
         parser.print_help()
+    elif args.command in TRACED_COMMANDS:
+        from tracing import tracer
+        try:
+            args.func(args)
+        finally:
+            tracer.save(args.command)
     else:
         args.func(args)
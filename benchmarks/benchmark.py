@@ -0,0 +1,290 @@
+# Measures the overhead of bdk itself by building a synthetic game tree with stand-ins for umodel and Blender.
+#
+#   python benchmarks/benchmark.py --packages 10000
+#
+# The stand-ins write small but realistically laid out output (props files, PSKX and TGA files, placeholder .blend
+# files), and can be slowed down with the `--*_delay` arguments to simulate real jobs.
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Callable, Any
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPOSITORY_DIRECTORY = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPOSITORY_DIRECTORY))
+
+IGNORE_PATTERNS = ['*/Backup/*', '*_old.usx', '*Unused*']
+
+# The fraction of generated packages that are placed where the ignore patterns exclude them.
+IGNORED_FRACTION = 0.05
+
+
+def make_package(rng: random.Random, package_name: str, kind: str, texture_packages: List[Tuple[str, List[str]]]) -> Dict:
+    def random_texture_reference() -> str:
+        referenced_package_name, texture_names = rng.choice(texture_packages)
+        return f'Texture\'{referenced_package_name}.{rng.choice(texture_names)}\''
+
+    objects = []
+    if kind == '.utx':
+        has_cube_map = rng.random() < 0.1
+        texture_names = [f'T{i}' for i in range(rng.randint(6 if has_cube_map else 1, 8))]
+        objects += [{'class': 'Texture', 'name': x} for x in texture_names]
+        if has_cube_map:
+            faces = {f'Faces[{i}]': f'Texture\'{package_name}.{x}\'' for i, x in enumerate(texture_names[:6])}
+            objects.append({'class': 'Cubemap', 'name': 'Cube', 'properties': faces})
+        if texture_packages and rng.random() < 0.2:
+            objects.append({'class': 'Shader', 'name': 'S0', 'properties': {'Diffuse': random_texture_reference()}})
+        texture_packages.append((package_name, texture_names))
+    elif kind == '.u':
+        objects.append({'class': 'Shader', 'name': 'S0', 'properties': {'Diffuse': random_texture_reference()}})
+    else:
+        for i in range(rng.randint(1, 10)):
+            properties = {f'Material[{j}]': random_texture_reference() for j in range(rng.randint(1, 3))}
+            objects.append({'class': 'StaticMesh', 'name': f'M{i}', 'properties': properties, 'size': rng.randint(1024, 65536)})
+    return {'objects': objects}
+
+
+def generate_tree(root_directory: str, package_count: int, seed: int = 0, packages_per_directory: int = 200) -> Dict[str, int]:
+    # Writes `package_count` packages (plus a few that are ignored) and the .bdkignore file, and returns the number
+    # of packages of each kind.
+    rng = random.Random(seed)
+    texture_packages: List[Tuple[str, List[str]]] = []
+    counts = {}
+    ignored_count = 0
+    for i in range(package_count + int(package_count * IGNORED_FRACTION)):
+        is_ignored = i >= package_count
+        roll = rng.random()
+        # The first package is always a texture package, so that the others have something to reference.
+        if roll < 0.45 or not texture_packages:
+            directory, kind = 'Textures', '.utx'
+        elif roll < 0.9:
+            directory, kind = 'StaticMeshes', '.usx'
+        elif roll < 0.95:
+            directory, kind = 'System', '.u'
+        else:
+            directory, kind = 'StaticMeshes', '.rom'
+        package_name = f'P{i:06d}'
+        if is_ignored:
+            ignored_directory, package_name = rng.choice([('Backup', package_name), ('', f'{package_name}_old'), ('', f'Unused{package_name}')])
+            if package_name.endswith('_old'):
+                directory, kind = 'StaticMeshes', '.usx'
+            directory = os.path.join(directory, ignored_directory)
+        package_directory = os.path.join(root_directory, directory, f'Set{i // packages_per_directory:04d}')
+        os.makedirs(package_directory, exist_ok=True)
+        package = make_package(rng, package_name, kind, texture_packages if not is_ignored else list(texture_packages))
+        with open(os.path.join(package_directory, package_name + kind), 'w') as f:
+            json.dump(package, f)
+        if is_ignored:
+            ignored_count += 1
+        else:
+            counts[kind] = counts.get(kind, 0) + 1
+    with open(os.path.join(root_directory, '.bdkignore'), 'w') as f:
+        f.write('\n'.join(IGNORE_PATTERNS) + '\n')
+    counts['ignored'] = ignored_count
+    return counts
+
+
+def write_stub(directory: str, name: str, script_path: str) -> str:
+    # Returns the path of an executable that runs the script with this interpreter.
+    if os.name == 'nt':
+        path = os.path.join(directory, f'{name}.bat')
+        with open(path, 'w') as f:
+            f.write(f'@"{sys.executable}" "{script_path}" %*\n')
+    else:
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script_path}" "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def get_peak_memory_usage() -> Tuple[Optional[int], Optional[int]]:
+    # Returns the peak resident set size (in bytes) of this process and of its largest child process.
+    if resource is None:
+        return None, None
+    # `ru_maxrss` is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+
+def run_phase(name: str, log_file, func: Callable, *args, **kwargs) -> Dict[str, Any]:
+    from tracing import tracer, summarize
+    event_count = len(tracer.events)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log_file), contextlib.redirect_stderr(log_file):
+        result = func(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+    spans = summarize({'traceEvents': tracer.events[event_count:]})['spans']
+
+    def total(span_name: str) -> float:
+        return spans.get(span_name, {}).get('total', 0.0)
+
+    return {
+        'phase': name,
+        'wall_time': wall_time,
+        'scan': total('scan'),
+        'hash': total('hash_packages'),
+        'manifest_io': total('manifest_load') + total('manifest_save'),
+        'catalog_index': total('catalog_index'),
+        'blend_count': spans.get('blend', {}).get('count', 0),
+        'result': result
+    }
+
+
+def run_scheduler(package_paths: List[str], job_count: int) -> Dict[str, Any]:
+    # Measures building the dependency graph from the catalog and scheduling it with jobs that do nothing.
+    from catalog import Catalog
+    from scheduler import DependencyScheduler, build_dependency_graph, find_cycles, break_cycles
+    build_directory = os.environ['BUILD_DIRECTORY']
+    start = time.perf_counter()
+    graph = build_dependency_graph(package_paths, build_directory, Catalog.load())
+    graph_time = time.perf_counter() - start
+    start = time.perf_counter()
+    cycles = find_cycles(graph)
+    scheduler = DependencyScheduler(break_cycles(graph, cycles))
+    node_count = sum(1 for _ in scheduler.run(lambda x: None, max_workers=job_count))
+    schedule_time = time.perf_counter() - start
+    return {
+        'graph_time': graph_time,
+        'edge_count': sum(len(x) for x in graph.values()),
+        'cycle_count': len(cycles),
+        'schedule_time': schedule_time,
+        'nodes_per_second': node_count / schedule_time if schedule_time > 0 else None
+    }
+
+
+def touch_packages(root_directory: str, fraction: float, seed: int = 0) -> int:
+    # Updates the modification time of some packages without changing their contents.
+    from build import PACKAGE_SUFFIXES
+    rng = random.Random(seed)
+    paths = sorted(str(x) for x in Path(root_directory).rglob('*') if x.suffix in PACKAGE_SUFFIXES)
+    paths = rng.sample(paths, max(1, int(len(paths) * fraction)))
+    for path in paths:
+        os.utime(path)
+    return len(paths)
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [f'{report["package_count"]} package(s): ' + ', '.join(f'{k}: {v}' for k, v in report['counts'].items()),
+             f'Generated in {report["generate_time"]:.1f}s']
+    lines.append(f'{"phase":<20} {"wall":>9} {"scan":>9} {"hash":>9} {"manifest":>9} {"catalog":>9} {"blends/s":>9}')
+    for phase in report['phases']:
+        blend_rate = phase['blend_count'] / phase['wall_time'] if phase['blend_count'] and phase['wall_time'] > 0 else 0.0
+        lines.append(f'{phase["phase"]:<20} {phase["wall_time"]:>8.2f}s {phase["scan"]:>8.2f}s {phase["hash"]:>8.2f}s '
+                     f'{phase["manifest_io"]:>8.2f}s {phase["catalog_index"]:>8.2f}s {blend_rate:>9.1f}')
+    if report['unbuilt_count']:
+        lines.append(f'WARNING: {report["unbuilt_count"]} package(s) failed to build')
+    scheduler = report['scheduler']
+    lines.append(f'Dependency graph: {scheduler["edge_count"]} edge(s), {scheduler["cycle_count"]} cycle(s), '
+                 f'built in {scheduler["graph_time"]:.2f}s')
+    lines.append(f'Scheduling: {scheduler["nodes_per_second"]:.0f} package(s)/s')
+    peak_memory, peak_child_memory = report['peak_memory'], report['peak_child_memory']
+    if peak_memory is not None:
+        lines.append(f'Peak RSS: {peak_memory / 2 ** 20:.0f} MB (largest child process: {peak_child_memory / 2 ** 20:.0f} MB)')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bdk against a synthetic game tree')
+    parser.add_argument('--packages', type=int, default=1000, help='number of packages to generate (e.g., 1000 to 100000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=8, help='concurrent jobs for every stage')
+    parser.add_argument('--export_delay', type=float, default=0.0, help='seconds each export takes')
+    parser.add_argument('--cubemap_delay', type=float, default=0.0, help='seconds each cube map takes')
+    parser.add_argument('--blend_delay', type=float, default=0.0, help='seconds each blend job takes')
+    parser.add_argument('--startup_delay', type=float, default=0.0, help='seconds each Blender process takes to start')
+    parser.add_argument('--cubemap_engine', choices=['blender', 'numpy'], default='blender')
+    parser.add_argument('--pipeline', action='store_true', help='build with the pipelined build instead of stage by stage')
+    parser.add_argument('--touch_fraction', type=float, default=0.01, help='fraction of packages touched before the incremental build')
+    parser.add_argument('--directory', default=None, help='directory to generate the tree in (a temporary one by default)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated tree')
+    parser.add_argument('--output', default=None, help='also write the report to this JSON file')
+    args = parser.parse_args()
+
+    work_directory = args.directory if args.directory is not None else tempfile.mkdtemp(prefix='bdk-benchmark-')
+    root_directory = os.path.join(work_directory, 'root')
+    stub_directory = os.path.join(work_directory, 'bin')
+    os.makedirs(stub_directory, exist_ok=True)
+
+    os.environ.update({
+        'ROOT_DIRECTORY': root_directory,
+        'BUILD_DIRECTORY': os.path.join(work_directory, 'build'),
+        'LIBRARY_DIRECTORY': os.path.join(work_directory, 'library'),
+        'MAPS_DIRECTORY': os.path.join(work_directory, 'maps'),
+        'UMODEL_PATH': write_stub(stub_directory, 'umodel', str(REPOSITORY_DIRECTORY / 'benchmarks' / 'stub_umodel.py')),
+        'BLENDER_PATH': write_stub(stub_directory, 'blender', str(REPOSITORY_DIRECTORY / 'benchmarks' / 'stub_blender.py')),
+        'BDK_STUB_EXPORT_DELAY': str(args.export_delay),
+        'BDK_STUB_CUBEMAP_DELAY': str(args.cubemap_delay),
+        'BDK_STUB_BLEND_DELAY': str(args.blend_delay),
+        'BDK_STUB_STARTUP_DELAY': str(args.startup_delay),
+    })
+    os.makedirs(os.environ['BUILD_DIRECTORY'], exist_ok=True)
+    # The build scripts refer to the Blender files relative to the repository.
+    os.chdir(REPOSITORY_DIRECTORY)
+
+    from build import export_assets, build_cube_maps, build_assets, find_packages_to_blend
+    from manifest import BuildManifest
+
+    try:
+        start = time.perf_counter()
+        counts = generate_tree(root_directory, args.packages, args.seed)
+        generate_time = time.perf_counter() - start
+
+        phases = []
+        with open(os.path.join(work_directory, 'benchmark.log'), 'w') as log_file:
+            build_arguments = dict(cubemap_engine=args.cubemap_engine, export_jobs=args.jobs, cubemap_jobs=args.jobs,
+                                   blend_jobs=args.jobs, pipeline=args.pipeline)
+            if args.pipeline:
+                phases.append(run_phase('build', log_file, build_assets, **build_arguments))
+            else:
+                phases.append(run_phase('export', log_file, export_assets, jobs=args.jobs))
+                phases.append(run_phase('cubemaps', log_file, build_cube_maps, engine=args.cubemap_engine, jobs=args.jobs))
+                phases.append(run_phase('blend', log_file, build_assets, no_export=True, no_cubemaps=True, **build_arguments))
+            phases.append(run_phase('no-op build', log_file, build_assets, **build_arguments))
+            touch_packages(root_directory, args.touch_fraction, args.seed)
+            phases.append(run_phase('touched build', log_file, build_assets, **build_arguments))
+
+        for phase in phases:
+            phase.pop('result')
+
+        manifest = BuildManifest.load()
+        package_paths = list(manifest.files.keys())
+        scheduler = run_scheduler(package_paths, args.jobs)
+        peak_memory, peak_child_memory = get_peak_memory_usage()
+
+        report = {
+            'package_count': args.packages,
+            'counts': counts,
+            'generate_time': generate_time,
+            'phases': phases,
+            'scheduler': scheduler,
+            'unbuilt_count': len(find_packages_to_blend(manifest)),
+            'peak_memory': peak_memory,
+            'peak_child_memory': peak_child_memory
+        }
+        print(format_report(report), end='')
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if not args.keep and args.directory is None:
+            shutil.rmtree(work_directory, ignore_errors=True)
+        else:
+            print(f'Benchmark tree kept in {work_directory}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Stands in for Blender in benchmarks. It speaks the same protocols as `blender/cube2sphere.py` (with `--jobs`),
+# `blender/blend.py` (with `worker`) and `blender/versions.py`, but only writes placeholder files.
+import json
+import os
+import shutil
+import sys
+import time
+
+CUBEMAP_RESULT_PREFIX = 'BDK_CUBEMAP_RESULT:'
+WORKER_RESULT_PREFIX = 'BDK_WORKER_RESULT:'
+VERSIONS_RESULT_PREFIX = 'BDK_VERSIONS:'
+
+
+def render_cube_maps(jobs_path: str):
+    delay = float(os.environ.get('BDK_STUB_CUBEMAP_DELAY', '0'))
+    with open(jobs_path, 'r') as f:
+        jobs = json.load(f)
+    for job in jobs:
+        start = time.time()
+        time.sleep(delay)
+        success = all(os.path.isfile(x) for x in job['faces'])
+        if success:
+            shutil.copyfile(job['faces'][0], job['output'])
+        result = {'output': job['output'], 'success': success, 'start': start, 'duration': time.time() - start}
+        print(CUBEMAP_RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def worker():
+    delay = float(os.environ.get('BDK_STUB_BLEND_DELAY', '0'))
+    ready_time = time.time()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        start = time.time()
+        time.sleep(delay)
+        missing_preview_count = 0
+        if job.get('type', 'build') == 'build':
+            output_path = job['output_path']
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'wb') as f:
+                f.write(b'BLENDER-v400')
+            if job.get('defer_previews', False):
+                missing_preview_count = len(job.get('previews', {}))
+        spans = [{'name': 'save', 'start': start, 'duration': time.time() - start}]
+        result = {'success': True, 'missing_preview_count': missing_preview_count, 'spans': spans, 'ready_time': ready_time}
+        print(WORKER_RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def main():
+    time.sleep(float(os.environ.get('BDK_STUB_STARTUP_DELAY', '0')))
+    if any(x.endswith('versions.py') for x in sys.argv):
+        print(VERSIONS_RESULT_PREFIX + json.dumps({'blender': '4.0.0 (stub)', 'addons': {}}), flush=True)
+        return
+    args = sys.argv[sys.argv.index('--') + 1:]
+    if '--jobs' in args:
+        render_cube_maps(args[args.index('--jobs') + 1])
+    elif 'worker' in args:
+        worker()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# Stands in for umodel in benchmarks. Synthetic packages (see `benchmark.py`) are JSON files listing their objects, which
+# are exported the way umodel lays them out: `<output>/<package>/<class>/<name>.<extension>`.
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+TEXTURE_SIZE = 16
+
+
+def write_tga(path: str, size: int, seed: int):
+    header = struct.pack('<BBBHHBHHHHBB', 0, 0, 2, 0, 0, 0, 0, 0, size, size, 24, 0x20)
+    pixel = bytes(((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(pixel * (size * size))
+
+
+def main():
+    args = sys.argv[1:]
+    output_directory = [x for x in args if x.startswith('-out=')][0][len('-out='):].strip('"')
+    package_path = args[-1]
+    package_name = os.path.splitext(os.path.basename(package_path))[0]
+
+    with open(package_path, 'r') as f:
+        package = json.load(f)
+
+    time.sleep(float(os.environ.get('BDK_STUB_EXPORT_DELAY', '0')))
+
+    for i, obj in enumerate(package['objects']):
+        class_directory = os.path.join(output_directory, package_name, obj['class'])
+        os.makedirs(class_directory, exist_ok=True)
+        base_path = os.path.join(class_directory, obj['name'])
+        with open(base_path + '.props.txt', 'w') as f:
+            for key, reference in obj.get('properties', {}).items():
+                f.write(f'{key} = {reference}\n')
+        if obj['class'] == 'Texture':
+            write_tga(base_path + '.tga', TEXTURE_SIZE, i)
+        elif obj['class'] == 'StaticMesh':
+            with open(base_path + '.pskx', 'wb') as f:
+                # umodel's output only depends on the package, so the same object is always exported the same way.
+                f.write(random.Random(f'{package_name}.{obj["name"]}').randbytes(obj.get('size', 4096)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,18 @@
+import json
+import struct
 import sys
+import time
+import traceback
 import warnings
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Dict
 
 import bpy
+import numpy as np
 import os
 import glob
 import addon_utils
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 
 material_class_names = [
     'ColorModifier',
@@ -26,8 +31,154 @@ material_class_names = [
     'VertexColor',
 ]
 
+# Lines starting with this prefix are read by the worker pool in `workers.py` as job results.
+WORKER_RESULT_PREFIX = 'BDK_WORKER_RESULT:'
+
+
+def end_span(spans: List[dict], name: str, start: float) -> float:
+    # Records a phase of the build for the build trace, and returns the time it ended at.
+    end = time.time()
+    spans.append({'name': name, 'start': start, 'duration': end - start})
+    return end
+
+
+def get_preview_cache_path(cache_directory: Optional[str], key: Optional[str]) -> Optional[str]:
+    if cache_directory is None or key is None:
+        return None
+    return os.path.join(cache_directory, key[:2], f'{key}.preview')
+
+
+def has_preview(id: bpy.types.ID) -> bool:
+    return id.preview is not None and id.preview.image_size[0] > 0
+
+
+def load_preview(id: bpy.types.ID, path: str) -> bool:
+    # Previews are cached as their size followed by their RGBA pixels as floats.
+    try:
+        with open(path, 'rb') as f:
+            width, height = struct.unpack('<II', f.read(8))
+            pixels = np.frombuffer(f.read(), dtype=np.float32)
+    except (OSError, struct.error):
+        return False
+    if len(pixels) != width * height * 4:
+        return False
+    preview = id.preview_ensure()
+    preview.image_size = (width, height)
+    preview.image_pixels_float.foreach_set(pixels)
+    return True
+
+
+def store_preview(id: bpy.types.ID, path: str):
+    if not has_preview(id):
+        return
+    width, height = id.preview.image_size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    id.preview.image_pixels_float.foreach_get(pixels)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that concurrent workers never read a partial preview.
+    temporary_path = f'{path}.{os.getpid()}'
+    with open(temporary_path, 'wb') as f:
+        f.write(struct.pack('<II', width, height))
+        f.write(pixels.tobytes())
+    os.replace(temporary_path, path)
+
+
+def ensure_previews(ids: Dict[str, bpy.types.ID], previews: Dict[str, str], cache_directory: Optional[str],
+                    defer: bool = False) -> int:
+    # Gives each asset a preview, reusing the cached preview of assets whose inputs haven't changed. `ids` and
+    # `previews` (the cache keys) are keyed by `<class>/<name>`. Returns the number of assets left without a preview.
+    generated_ids = []
+    missing_count = 0
+    for preview_key, id in ids.items():
+        if has_preview(id):
+            continue
+        cache_path = get_preview_cache_path(cache_directory, previews.get(preview_key, None))
+        if cache_path is not None and load_preview(id, cache_path):
+            continue
+        if defer:
+            missing_count += 1
+            continue
+        id.asset_generate_preview()
+        generated_ids.append((id, cache_path))
+    for id, cache_path in generated_ids:
+        if cache_path is not None:
+            store_preview(id, cache_path)
+    return missing_count
+
+
+def get_asset_key(file: str) -> str:
+    # Returns the `<class>/<name>` key of the exported object that the props file belongs to.
+    return f'{Path(file).parent.name}/{os.path.basename(file).replace(".props.txt", "")}'
+
+
+def find_static_mesh_object(package_name: str, object_name: str) -> Optional[bpy.types.Object]:
+    package_reference = f'StaticMesh\'{package_name}.{object_name}\''
+    for obj in bpy.data.objects:
+        if obj.bdk.package_reference == package_reference:
+            return obj
+    return bpy.data.objects.get(object_name, None)
+
+
+def remove_assets(package_name: str, asset_keys: List[str], replaced_asset_keys: List[str]) -> Dict[str, bpy.types.Material]:
+    # Removes the assets that no longer exist or are about to be imported again. Materials that are replaced are only
+    # renamed out of the way, so that their users can be remapped to the new material once it is imported. Returns
+    # the renamed materials by their original name.
+    replaced_materials = {}
+    for asset_key in asset_keys + replaced_asset_keys:
+        class_name, object_name = asset_key.split('/', 1)
+        if class_name == 'StaticMesh':
+            obj = find_static_mesh_object(package_name, object_name)
+            if obj is None:
+                continue
+            mesh = obj.data
+            bpy.data.objects.remove(obj)
+            if mesh is not None and mesh.users == 0:
+                bpy.data.meshes.remove(mesh)
+        else:
+            material = bpy.data.materials.get(object_name, None)
+            if material is None:
+                continue
+            if asset_key in replaced_asset_keys:
+                material.name = f'{object_name}.bdk_replaced'
+                replaced_materials[object_name] = material
+            else:
+                bpy.data.materials.remove(material)
+    return replaced_materials
+
+
+def remap_replaced_materials(replaced_materials: Dict[str, bpy.types.Material]):
+    for object_name, old_material in replaced_materials.items():
+        new_material = bpy.data.materials.get(object_name, None)
+        if new_material is None:
+            # The material failed to import, so keep the old one.
+            old_material.name = object_name
+            continue
+        old_material.user_remap(new_material)
+        bpy.data.materials.remove(old_material)
+
+
+def use_transcoded_textures(input_directory: Path, textures: dict):
+    # Points the images that were loaded from the exported TGA files at their transcoded versions (see `textures.py`
+    # in the build tool), which are laid out like the export directory, where they exist.
+    for image in bpy.data.images:
+        if image.library is not None or not image.filepath:
+            continue
+        path = Path(os.path.realpath(bpy.path.abspath(image.filepath)))
+        if path.suffix.lower() != '.tga' or input_directory not in path.parents:
+            continue
+        transcoded_path = os.path.join(textures['directory'], str(path.relative_to(input_directory).with_suffix(''))) + \
+            textures['suffix']
+        if os.path.isfile(transcoded_path):
+            image.filepath = transcoded_path
+
+
+def build(args, spans: Optional[List[dict]] = None) -> dict:
+    # Builds the package's asset library. If `args.update` is set, the existing library is updated in place instead:
+    # the assets listed in `update['removed']` are removed and those in `update['changed']` (`<class>/<name>` keys)
+    # are imported again, leaving everything else untouched.
+    if spans is None:
+        spans = []
 
-def build(args):
     if not os.path.isdir(args.input_directory):
         raise RuntimeError(f'{args.input_directory} is not a directory')
 
@@ -35,10 +186,8 @@ def build(args):
 
     package_name = input_directory.parts[-1]
 
-    # TODO: There is a new bug where a SM in a Texture package references a Texture package
-    # that has not yet been built.
-    # It may be wise to do make a dependency graph or simply do the .blend file building
-    # in two passes (first materials, then statics)
+    # NOTE: Packages referenced by this one are built beforehand by the dependency scheduler in `build.py`, so any
+    # materials linked from other packages' asset libraries already exist.
 
     # Packages can hold basically any kind of asset in them.
     # As a result, static meshes can reference textures residing in the same package.
@@ -47,9 +196,25 @@ def build(args):
     # are in the .blend file before it evaluates any static meshes.
     material_files = []
     static_mesh_files = []
-    new_ids: List[bpy.types.ID] = []
+    # Keyed by `<class>/<name>`, which is how the build tool refers to their previews.
+    new_ids: Dict[str, bpy.types.ID] = {}
+
+    # The build tool passes the files listed in its catalog of exported objects, which saves walking the directory.
+    files = getattr(args, 'files', None)
+    if files is None:
+        files = glob.glob('**/*.props.txt', root_dir=args.input_directory)
+
+    update = getattr(args, 'update', None)
+    replaced_materials = {}
+    if update is not None:
+        start = time.time()
+        bpy.ops.wm.open_mainfile(filepath=args.output_path)
+        replaced_materials = remove_assets(package_name, update['removed'], update['changed'])
+        changed_asset_keys = set(update['changed'])
+        files = [x for x in files if get_asset_key(x) in changed_asset_keys]
+        end_span(spans, 'remove_stale_assets', start)
 
-    for file in glob.glob('**/*.props.txt', root_dir=args.input_directory):
+    for file in files:
         # The class type of the object is the directory name of the parent folder.
         class_type = Path(os.path.join(args.input_directory, file)).parent.parts[-1]
 
@@ -60,6 +225,10 @@ def build(args):
         else:
             warnings.warn(f'Unhandled class type: {class_type}')
 
+    failed_asset_keys = []
+
+    start = time.time()
+
     # Materials.
     for file in material_files:
         filepath = os.path.join(args.input_directory, file)
@@ -69,10 +238,15 @@ def build(args):
             bpy.ops.bdk.import_material(filepath=filepath)
         except Exception as e:
             print(e)
+            failed_asset_keys.append(get_asset_key(file))
             continue
 
         new_material = bpy.data.materials[object_name]
-        new_ids.append(new_material)
+        new_ids[get_asset_key(file)] = new_material
+
+    remap_replaced_materials(replaced_materials)
+
+    start = end_span(spans, 'import_materials', start)
 
     # Static Meshes.
     for file in static_mesh_files:
@@ -106,13 +280,28 @@ def build(args):
 
             new_object['Class'] = 'StaticMeshActor'
 
-            new_ids.append(new_object)
+            new_ids[f'StaticMesh/{object_name}'] = new_object
             break
+        else:
+            failed_asset_keys.append(f'StaticMesh/{object_name}')
+
+    start = end_span(spans, 'import_static_meshes', start)
 
-    # Generate previews.
-    for new_id in new_ids:
+    textures = getattr(args, 'textures', None)
+    if textures is not None:
+        use_transcoded_textures(input_directory, textures)
+        start = end_span(spans, 'use_transcoded_textures', start)
+
+    for new_id in new_ids.values():
         new_id.asset_mark()
-        new_id.asset_generate_preview()
+
+    # Generate previews, unless they are deferred to a separate pass (see `generate_previews`).
+    missing_preview_count = ensure_previews(new_ids, getattr(args, 'previews', None) or {},
+                                            getattr(args, 'preview_cache_directory', None),
+                                            getattr(args, 'defer_previews', False))
+
+    start = end_span(spans, 'generate_previews', start)
+
     # Save the file to disk.
     if args.output_path is None:
         args.output_path = os.path.join(args.input_directory, f'{package_name}.blend')
@@ -120,11 +309,84 @@ def build(args):
     output_directory = os.path.join(os.path.dirname(args.output_path))
     os.makedirs(output_directory, exist_ok=True)
 
-    if len(new_ids):
+    if update is not None:
+        if update['removed'] or update['changed']:
+            # Data that only the removed assets used (e.g., their images) would otherwise be kept in the file.
+            bpy.data.orphans_purge(do_recursive=True)
+            bpy.ops.wm.save_mainfile(filepath=os.path.abspath(args.output_path))
+            end_span(spans, 'save', start)
+    elif len(new_ids):
         bpy.ops.wm.save_as_mainfile(
             filepath=os.path.abspath(args.output_path),
             copy=True
             )
+        end_span(spans, 'save', start)
+
+    return {'missing_preview_count': missing_preview_count, 'failed_assets': failed_asset_keys}
+
+
+def generate_previews(args, spans: Optional[List[dict]] = None) -> dict:
+    # Generates the previews that were deferred when the library was built.
+    if spans is None:
+        spans = []
+
+    if not os.path.isfile(args.blend_path):
+        return {'missing_preview_count': 0}
+
+    bpy.ops.wm.open_mainfile(filepath=args.blend_path)
+
+    start = time.time()
+
+    ids = {}
+    for preview_key in args.previews:
+        class_name, object_name = preview_key.split('/', 1)
+        id = bpy.data.objects.get(object_name) if class_name == 'StaticMesh' else bpy.data.materials.get(object_name)
+        if id is not None and id.asset_data is not None:
+            ids[preview_key] = id
+
+    ensure_previews(ids, args.previews, args.preview_cache_directory)
+
+    start = end_span(spans, 'generate_previews', start)
+
+    bpy.ops.wm.save_mainfile(filepath=args.blend_path)
+
+    end_span(spans, 'save', start)
+
+    return {'missing_preview_count': 0}
+
+
+def worker(args):
+    # Stay alive and run one job (building a package, or generating its deferred previews) per line of JSON read from
+    # stdin, resetting to the template scene between jobs.
+    # This avoids paying for Blender startup and addon registration for every package.
+    template_path = bpy.data.filepath
+    ready_time = time.time()
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        job = json.loads(line)
+        spans = []
+        try:
+            if job.get('type', 'build') == 'previews':
+                result = generate_previews(Namespace(blend_path=job['blend_path'], previews=job['previews'],
+                                                     preview_cache_directory=job.get('preview_cache_directory', None)), spans)
+            else:
+                result = build(Namespace(input_directory=job['input_directory'], output_path=job.get('output_path', None),
+                                         files=job.get('files', None), previews=job.get('previews', None),
+                                         preview_cache_directory=job.get('preview_cache_directory', None),
+                                         defer_previews=job.get('defer_previews', False),
+                                         update=job.get('update', None), textures=job.get('textures', None)), spans)
+            result['success'] = True
+        except Exception as e:
+            traceback.print_exc()
+            result = {'success': False, 'error': str(e)}
+        start = time.time()
+        bpy.ops.wm.open_mainfile(filepath=template_path)
+        end_span(spans, 'reset', start)
+        # The time the worker became ready lets the build tool tell Blender startup apart from the job itself.
+        result.update(spans=spans, ready_time=ready_time)
+        print(WORKER_RESULT_PREFIX + json.dumps(result), flush=True)
 
 
 if __name__ == '__main__':
@@ -137,6 +399,8 @@ if __name__ == '__main__':
     build_subparser.add_argument('input_directory')
     build_subparser.add_argument('--output_path', required=False, default=None)
     build_subparser.set_defaults(func=build)
+    worker_subparser = subparsers.add_parser('worker')
+    worker_subparser.set_defaults(func=worker)
     args = sys.argv[sys.argv.index('--')+1:]
     args = parser.parse_args(args)
     args.func(args)
@@ -1,24 +1,53 @@
+import json
 import sys
+import time
+import traceback
+
 import bpy
 import argparse
 
+FACE_NAMES = ['front', 'back', 'right', 'left', 'top', 'bottom']
+
+# Lines starting with this prefix are read by `build.py` as the result of a job when rendering a job list.
+RESULT_PREFIX = 'BDK_CUBEMAP_RESULT:'
+
+
+def render(faces, output):
+    if len(faces) != len(FACE_NAMES):
+        # Otherwise the missing faces would keep the images of the previous job.
+        raise ValueError(f'expected {len(FACE_NAMES)} faces ({", ".join(FACE_NAMES)}), got {len(faces)}')
+    for face_name, face in zip(FACE_NAMES, faces):
+        image = bpy.data.images[face_name]
+        image.filepath = face
+        # Images keep their pixels from the previous job otherwise.
+        image.reload()
+
+    bpy.context.scene.render.filepath = output
+
+    bpy.ops.render.render(write_still=True)
+
+
 parser = argparse.ArgumentParser()
-parser.add_argument('front')
-parser.add_argument('back')
-parser.add_argument('right')
-parser.add_argument('left')
-parser.add_argument('top')
-parser.add_argument('bottom')
+parser.add_argument('faces', nargs='*', help=' '.join(FACE_NAMES))
 parser.add_argument('--output', required=False, default='./output.tga')
+parser.add_argument('--jobs', required=False, default=None,
+                    help='JSON file containing a list of jobs (e.g., [{"faces": [...], "output": "..."}]) to render in this session')
 args = parser.parse_args(sys.argv[sys.argv.index('--')+1:])
 
-bpy.data.images['front'].filepath = args.front
-bpy.data.images['back'].filepath = args.back
-bpy.data.images['right'].filepath = args.right
-bpy.data.images['left'].filepath = args.left
-bpy.data.images['top'].filepath = args.top
-bpy.data.images['bottom'].filepath = args.bottom
-
-bpy.context.scene.render.filepath = args.output
-
-bpy.ops.render.render(write_still=True)
+if args.jobs is not None:
+    with open(args.jobs, 'r') as f:
+        jobs = json.load(f)
+    for job in jobs:
+        start = time.time()
+        try:
+            render(job['faces'], job['output'])
+            success = True
+        except Exception:
+            traceback.print_exc()
+            success = False
+        result = {'output': job['output'], 'success': success, 'start': start, 'duration': time.time() - start}
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+else:
+    if len(args.faces) != len(FACE_NAMES):
+        parser.error(f'expected {len(FACE_NAMES)} faces ({", ".join(FACE_NAMES)})')
+    render(args.faces, args.output)
@@ -0,0 +1,33 @@
+import json
+import os
+
+import addon_utils
+import bpy
+
+# Must match the prefix read by `artifacts.py`.
+VERSIONS_RESULT_PREFIX = 'BDK_VERSIONS:'
+
+# The addons enabled by `blend.py`.
+ADDON_NAMES = ['io_scene_psk_psa', 'bdk_addon']
+
+
+def get_versions() -> dict:
+    # Returns the version of Blender and the version and location of each addon that libraries are built with. The
+    # build tool hashes the addons' files itself, since they change more often than their versions do.
+    addons = {}
+    for module in addon_utils.modules():
+        # Addons installed as extensions are named `bl_ext.<repository>.<name>`.
+        name = module.__name__.split('.')[-1]
+        if name not in ADDON_NAMES:
+            continue
+        bl_info = getattr(module, 'bl_info', {})
+        addons[name] = {
+            'version': '.'.join(str(x) for x in bl_info.get('version', ())),
+            'path': os.path.dirname(module.__file__) if os.path.basename(module.__file__) == '__init__.py' else module.__file__
+        }
+    build_hash = bpy.app.build_hash.decode() if isinstance(bpy.app.build_hash, bytes) else str(bpy.app.build_hash)
+    return {'blender': f'{bpy.app.version_string} ({build_hash})', 'addons': addons}
+
+
+if __name__ == '__main__':
+    print(VERSIONS_RESULT_PREFIX + json.dumps(get_versions()), flush=True)
@@ -1,133 +1,171 @@
+import asyncio
 import fnmatch
 import json
 import os
 import re
 import shutil
-import subprocess
+import tempfile
+import threading
 import time
-from glob import glob
 
 import tqdm
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Optional, Dict, List
+from functools import lru_cache
+from typing import Optional, Dict, List, Callable, Tuple, Union, Set, Iterable, NamedTuple
 from pathlib import Path
 
+from artifacts import artifact_cache, get_export_key, get_blend_key
 from bdk import UReference
+from catalog import Catalog
+from costs import CostModel, CostProgressBar, record_duration, EXPORT, BLEND
+from dedup import content_store, detach_files
+from hashing import hash_file, hash_files
+from joblogs import JobLog, job_logs
+from manifest import BuildManifest, QUARANTINE_FAILURE_COUNT
+from packages import read_referenced_package_names
+from processes import process_limits, process_engine, bounded, run_process_async, retry, retry_async, \
+    EXPORT_TIMEOUT_BASE, EXPORT_TIMEOUT_PER_MB, BLEND_TIMEOUT_BASE, BLEND_TIMEOUT_PER_MB, \
+    CUBEMAP_TIMEOUT_BASE, CUBEMAP_TIMEOUT_PER_CUBE_MAP
+from resources import memory_gate, get_job_count, UMODEL_MEMORY_ESTIMATE, BLENDER_MEMORY_ESTIMATE, \
+    NUMPY_CUBEMAP_MEMORY_ESTIMATE, TEXTURE_MEMORY_ESTIMATE, MB
+from scanner import ScannedFile, scan, read_ignore_patterns
+from scheduler import DependencyScheduler, build_dependency_graph, find_cycles, break_cycles, get_critical_path_costs, \
+    get_package_paths_by_name
+from sharding import Shard, use_fragment, select_shard_packages
+from textures import texture_transcoder, get_texture_directory, is_texture_up_to_date, remove_stale_textures, \
+    TEXTURE_VERSION
+from tracing import tracer
+from workers import BlenderWorkerPool
+
+PACKAGE_SUFFIXES = ['.usx', '.utx', '.rom', '.u']
+
+# Must match the prefix written by `blender/cube2sphere.py` when rendering a job list.
+CUBEMAP_RESULT_PREFIX = 'BDK_CUBEMAP_RESULT:'
+# Front, back, right, left, top and bottom (in the order of `blender/cube2sphere.py`).
+CUBE_MAP_FACE_COUNT = 6
+
+PREVIEW_CACHE_DIRECTORY_NAME = '.bdkpreviews'
+# Bump this to stop using the previews cached so far (e.g., when the way previews are rendered changes).
+PREVIEW_CACHE_VERSION = 1
+
+# Bump this when libraries built by an earlier version must be built from scratch. Any change to `blender/blend.py`
+# does that as well.
+BLEND_VERSION = 1
 
-MANIFEST_FILENAME = '.bdkmanifest'
 
+def rebuild_assets(mod, dry, clean):
+    manifest = BuildManifest.load()
+    for package_path, package in manifest['files'].items():
+        package['is_built'] = False
+        # Build the libraries from scratch instead of updating them.
+        package.pop('assets', None)
+    manifest.save()
+    build_assets(mod, dry, clean)
 
-class BuildManifest(dict):
 
-    class File(dict):
-        def __init__(self):
-            dict.__init__(self, last_modified_time=0.0, size=0, is_built=False)
+def get_asset_directories(mod: Optional[str] = None) -> List[str]:
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    asset_paths = [
+        "Animations",
+        "StaticMeshes",
+        "Textures",
+        "Sounds",
+        "System",  # .u files can contain assets as well.
+    ]
 
-        @property
-        def last_modified_time(self) -> float:
-            return self['last_modified_time']
+    if mod is not None:
+        asset_paths += [mod]
 
-        @property
-        def size(self) -> int:
-            return self['size']
+    return [os.path.join(root_directory, asset_path) for asset_path in asset_paths]
 
-        @property
-        def is_built(self) -> bool:
-            return self['is_built']
 
-        @is_built.setter
-        def is_built(self, value: bool):
-            self['is_built'] = value
+def scan_packages(mod: Optional[str] = None) -> Dict[str, ScannedFile]:
+    # Returns the packages in the asset directories that aren't excluded by the .bdkignore file, keyed by their path.
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    ignore_patterns = read_ignore_patterns(root_directory)
+    with tracer.span('scan'):
+        return scan(get_asset_directories(mod), PACKAGE_SUFFIXES, ignore_patterns)
 
-        @last_modified_time.setter
-        def last_modified_time(self, value: float):
-            self['last_modified_time'] = value
 
-        @size.setter
-        def size(self, value: int):
-            self['size'] = value
+class ExportResult(NamedTuple):
+    return_code: int
+    # How long umodel ran, in seconds.
+    duration: float
+    # Whether the exported files were restored from the artifact cache instead.
+    is_restored: bool = False
 
-    def __init__(self, files=dict(), cube_maps=dict()):
-        dict.__init__(self, files=files, cube_maps=cube_maps)
 
-    @property
-    def files(self) -> Dict[str, File]:
-        return self['files']
+async def export_package(output_path: str, package_path: str, log: JobLog) -> ExportResult:
+    root_dir = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    umodel_path = Path(os.environ['UMODEL_PATH']).resolve()
+    args = [str(umodel_path), '-export', '-nolinked', f'-out="{output_path}"', f'-path="{root_dir}"', package_path]
+    timeout = process_limits.get_timeout(EXPORT_TIMEOUT_BASE, EXPORT_TIMEOUT_PER_MB, os.path.getsize(package_path) / MB)
+    async with memory_gate.admit_async(UMODEL_MEMORY_ESTIMATE):
+        with tracer.span('export', package=os.path.relpath(package_path, root_dir)):
+            start = time.monotonic()
+            result = await run_process_async(args, timeout, log.write)
+            return ExportResult(result.returncode, time.monotonic() - start)
 
-    @property
-    def cube_maps(self) -> Dict[str, File]:
-        return self['cube_maps']
 
-    def mark_file_as_built(self, file: str):
-        if file in self.files:
-            self.files[file]['is_built'] = True
+def find_package_paths(name: str, mod: Optional[str] = None) -> List[str]:
+    # Returns the packages with the path (absolute, or relative to the root directory) or name (with or without its
+    # extension), looking them up in the manifest before scanning the asset directories.
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    for path in (name, os.path.join(root_directory, name)):
+        if os.path.isfile(path):
+            return [str(Path(path).resolve())]
 
-    def mark_cubemap_as_built(self, file: str):
-        if file in self.cube_maps:
-            self.cube_maps[file]['is_built'] = True
+    def find(package_paths: Iterable[str]) -> List[str]:
+        return sorted(
+            x for x in package_paths
+            if os.path.basename(x).lower() == name.lower() or Path(x).stem.lower() == name.lower()
+        )
 
-    @staticmethod
-    def load() -> 'BuildManifest':
-        build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
-        packages = {}
-        cube_maps = {}
-        manifest_path = Path(os.path.join(build_directory, MANIFEST_FILENAME)).resolve()
+    package_paths = find(os.path.join(root_directory, x) for x in BuildManifest.load().files)
+    return package_paths or find(scan_packages(mod).keys())
 
-        if os.path.isfile(manifest_path):
-            with open(manifest_path, 'r') as file:
-                try:
-                    data = json.load(file)
-                    packages = data.get('files', {})
-                    cube_maps = data.get('cube_maps', {})
-                except UnicodeDecodeError as e:
-                    print(e)
-                print('Build manifest loaded')
-        else:
-            print('Build manifest file not found')
 
-        return BuildManifest(files=packages, cube_maps=cube_maps)
+def find_packages_to_export(manifest: BuildManifest, mod: Optional[str] = None, dry: bool = False, clean: bool = False,
+                            name_filter: Optional[str] = None) -> Tuple[List[str], Dict[str, Dict]]:
+    # Returns the packages that are out-of-date and the manifest entries to write for each of them once exported.
+    # TODO: only clean the packages that we want to build (e.g. name_filter)
+    if clean and not dry:
+        manifest.clear()
 
-    def save(self):
-        build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
-        manifest_path = Path(os.path.join(build_directory, MANIFEST_FILENAME)).resolve()
-        with open(manifest_path, 'w') as file:
-            json.dump(self, file, indent=2)
+    scanned_files = scan_packages(mod)
+    remove_missing_packages(manifest, scanned_files, dry)
+    packages_to_build, pending_updates = find_out_of_date_packages(manifest, scanned_files, dry, clean, name_filter)
 
+    if not dry:
+        manifest.save()
 
-def rebuild_assets(mod, dry, clean):
-    manifest = BuildManifest.load()
-    for package_path, package in manifest['files'].items():
-        package['is_built'] = False
-    build_assets(mod, dry, clean)
+    return packages_to_build, pending_updates
 
 
-def export_package(output_path: str, package_path: str):
-    root_dir = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
-    umodel_path = Path(os.environ['UMODEL_PATH']).resolve()
-    args = [str(umodel_path), '-export', '-nolinked', f'-out="{output_path}"', f'-path="{root_dir}"', package_path]
-    return subprocess.run(args)
+def remove_package(manifest: BuildManifest, package_path: str, dry: bool = False):
+    # Removes a package (relative to the root directory) that no longer exists, and deletes its associated bdk-build
+    # data.
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    package_build_directory = Path(build_directory, package_path).with_suffix('')
+    if package_build_directory.is_dir():
+        shutil.rmtree(package_build_directory)
+    manifest.remove_file(package_path)
+    if not dry:
+        Catalog.load().remove_package(package_path)
 
 
-def export_assets(mod: Optional[str] = None, dry: bool = False, clean: bool = False, name_filter: Optional[str] = None) -> List[str]:
+def remove_missing_packages(manifest: BuildManifest, scanned_files: Dict[str, ScannedFile], dry: bool = False):
     root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
     build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
 
-    # TODO: only clean the packages that we want to build (e.g. name_filter)
-    if clean:
-        manifest = BuildManifest(files={})
-    else:
-        manifest = BuildManifest.load()
-
     # Remove package references that no longer exist, and delete their associated bdk-build data.
     manifest_files = [x for x in manifest.files]
     for file in manifest_files:
         path = Path(root_directory, file)
-        if not path.is_file():
+        if str(path) not in scanned_files and not path.is_file():
             print(f"{path} no longer exists!")
-            package_build_directory = Path(build_directory, file).with_suffix('')
-            if package_build_directory.is_dir():
-                shutil.rmtree(package_build_directory)
-            manifest.files.pop(file)
+            remove_package(manifest, file, dry)
 
     # Remove cubemap references that no longer exist.
     manifest_cube_maps = [x for x in manifest.cube_maps]
@@ -135,135 +173,433 @@ def export_assets(mod: Optional[str] = None, dry: bool = False, clean: bool = Fa
         path = Path(build_directory, file)
         if not path.is_file():
             print(f"{path} no longer exists!")
-            manifest.cube_maps.pop(file)
-
-    # Read ignore patterns from the .bdkignore file.
-    bdkignore_filename = '.bdkignore'
-    ignore_patterns = set()
-    bdkignore_path = os.path.join(root_directory, bdkignore_filename)
-    if os.path.isfile(bdkignore_path):
-        with open(bdkignore_path, 'r') as f:
-            ignore_patterns = map(lambda x: x.strip(), f.readlines())
+            manifest.remove_cube_map(file)
 
-    asset_paths = [
-        "Animations",
-        "StaticMeshes",
-        "Textures",
-        "Sounds",
-        "System",  # .u files can contain assets as well.
-    ]
 
-    if mod is not None:
-        asset_paths += [mod]
-
-    # Get a list of packages with matching suffixes in the root directory.
-    package_suffixes = ['.usx', '.utx', '.rom', '.u']
-    package_paths = set()
-
-    for asset_path in asset_paths:
-        package_paths = package_paths.union(set(str(p.resolve()) for p in Path(root_directory, asset_path).glob("**/*") if p.suffix in package_suffixes))
-
-    # Filter out packages based on patterns in the .bdkignore file in the root directory.
-    for ignore_pattern in ignore_patterns:
-        package_paths = package_paths.difference(fnmatch.filter(package_paths, ignore_pattern))
+def find_out_of_date_packages(manifest: BuildManifest, scanned_files: Dict[str, ScannedFile], dry: bool = False,
+                              clean: bool = False, name_filter: Optional[str] = None) -> Tuple[List[str], Dict[str, Dict]]:
+    # Returns which of the scanned packages are out-of-date, and the manifest entries to write for each of them once
+    # exported. The stats of the packages that are up-to-date are updated in the manifest, but not saved.
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    package_paths = scanned_files.keys()
 
     # Compile a list of packages that are out of date with the manifest.
+    # Packages whose modification time and size match the manifest are assumed to be unchanged. The rest are hashed
+    # and only rebuilt if their contents changed, so that touched-but-identical files (e.g., after a checkout or a
+    # copy from a build share) are not exported again.
     packages_to_build = []
+    packages_to_hash = {}
+    changed_package_paths = set()
     for package_path in package_paths:
         if name_filter is not None and not fnmatch.fnmatch(os.path.basename(package_path), name_filter):
             continue
         package_path_relative = os.path.relpath(package_path, root_directory)
         file = manifest.files.get(package_path_relative, None)
-        should_build_file = False
+        mtime = scanned_files[package_path].last_modified_time
+        size = scanned_files[package_path].size
 
-        if file:
-            if os.path.getmtime(package_path) != file['last_modified_time'] or \
-                    os.path.getsize(package_path) != file['size']:
-                should_build_file = True
-        else:
+        if file is None:
             file = BuildManifest.File()
-            should_build_file = True
+            manifest.files[package_path_relative] = file
+            changed_package_paths.add(package_path)
+        elif clean or mtime != file['last_modified_time'] or size != file['size']:
+            changed_package_paths.add(package_path)
+        elif file.get('hash', None) is not None:
+            continue
 
-        if clean:
-            should_build_file = True
+        packages_to_hash[package_path] = (mtime, size)
 
-        if should_build_file:
-            packages_to_build.append(package_path)
+    # The new stats of packages that are out-of-date are only written to the manifest once they have been exported,
+    # so that an interrupted build exports them again.
+    pending_updates = {}
+    quarantined_count = 0
+    with tracer.span('hash_packages', count=len(packages_to_hash)):
+        package_hashes = hash_files(packages_to_hash.keys())
+    for package_path, file_hash in package_hashes.items():
+        package_path_relative = os.path.relpath(package_path, root_directory)
+        file = manifest.files[package_path_relative]
+        mtime, size = packages_to_hash[package_path]
+        quarantine_entry = manifest.quarantine.get(package_path_relative, None)
+        if quarantine_entry is not None and quarantine_entry['hash'] != file_hash and not dry:
+            # The package changed since it failed, so it gets another chance.
+            manifest.clear_failures(package_path_relative)
+        previous_hash = file.get('hash', None)
+        is_unchanged = previous_hash == file_hash or \
+            (previous_hash is None and package_path not in changed_package_paths)  # Manifest predates hashes.
+        if is_unchanged and not clean:
+            file.update(last_modified_time=mtime, size=size, hash=file_hash)
+            continue
+        if manifest.is_quarantined(package_path_relative, file_hash):
+            quarantined_count += 1
+            continue
+        pending_updates[package_path] = dict(last_modified_time=mtime, size=size, hash=file_hash, is_built=False)
+        packages_to_build.append(package_path)
+
+    # Packages are exported again when a package that they import assets from changed, since their exported
+    # properties refer to those assets. The hashes of the imported packages are recorded when a package is exported.
+    package_paths_by_name = get_package_paths_by_name(manifest.files)
+    pending_hashes = {os.path.relpath(x, root_directory): update['hash'] for x, update in pending_updates.items()}
+
+    def get_import_hash(package_name: str) -> Optional[str]:
+        hashes = [pending_hashes.get(x, manifest.files[x].get('hash', None)) for x in package_paths_by_name.get(package_name, [])]
+        return ','.join(sorted(x or '' for x in hashes)) if hashes else None
+
+    invalidated_count = 0
+    for package_path_relative, file in manifest.files.items():
+        package_path = os.path.join(root_directory, package_path_relative)
+        imports = file.get('imports', None)
+        if not imports or package_path in pending_updates or file.get('hash', None) is None or \
+                manifest.is_quarantined(package_path_relative):
+            continue
+        if name_filter is not None and not fnmatch.fnmatch(os.path.basename(package_path), name_filter):
+            continue
+        if all(get_import_hash(x) == import_hash for x, import_hash in imports.items()) or not os.path.isfile(package_path):
+            continue
+        pending_updates[package_path] = dict(last_modified_time=file['last_modified_time'], size=file['size'],
+                                             hash=file['hash'], is_built=False)
+        packages_to_build.append(package_path)
+        invalidated_count += 1
+
+    # The headers are read without exporting anything (see `packages.py`).
+    with tracer.span('read_package_headers', count=len(pending_updates)):
+        for package_path, pending_update in pending_updates.items():
+            package_name = os.path.splitext(os.path.basename(package_path))[0].lower()
+            package_names = read_referenced_package_names(package_path) or set()
+            pending_update['imports'] = {
+                x: get_import_hash(x) for x in sorted(package_names) if x in package_paths_by_name and x != package_name
+            }
 
-        # Update the file stats in the manifest.
-        file['last_modified_time'] = os.path.getmtime(package_path)
-        file['size'] = os.path.getsize(package_path)
+    print(f'{len(package_paths)} file(s) | {len(packages_to_build)} file(s) out-of-date')
+    if invalidated_count > 0:
+        print(f'{invalidated_count} of them import assets from packages that changed')
+    if quarantined_count > 0:
+        print(f'{quarantined_count} quarantined package(s) skipped (see `bdk quarantine`)')
 
-        manifest.files[package_path_relative] = file
+    return packages_to_build, pending_updates
 
-    print(f'{len(package_paths)} file(s) | {len(packages_to_build)} file(s) out-of-date')
 
-    # This is here so tqdm displays correctly inside PyCharm terminals,
-    # otherwise it gets all messed up.
-    time.sleep(0.1)
+async def export_package_to_build_directory(package_path: str, pending_update: Optional[Dict] = None) -> ExportResult:
+    # Runs on the process engine. Reading and writing the artifact cache happens in other threads, so that it doesn't
+    # hold up the other exports.
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    package_path_relative = os.path.relpath(package_path, root_directory)
+    package_build_directory = os.path.join(build_directory, os.path.dirname(package_path_relative))
+    os.makedirs(package_build_directory, exist_ok=True)
+    # umodel exports the package into a directory of the same name.
+    package_directory = os.path.splitext(os.path.join(build_directory, package_path_relative))[0]
+    if os.path.isdir(package_directory):
+        await asyncio.to_thread(detach_files, package_directory)
+
+    artifact_key = None
+    if artifact_cache.is_enabled and pending_update is not None:
+        artifact_key = await asyncio.to_thread(get_export_key, package_path_relative, pending_update['hash'],
+                                               pending_update.get('imports', {}))
+        with tracer.span('restore_export', package=package_path_relative):
+            if await asyncio.to_thread(artifact_cache.restore_export, artifact_key, package_directory):
+                return ExportResult(0, 0.0, is_restored=True)
+
+    with job_logs.open(package_path_relative, 'export') as log:
+        result = await retry_async(lambda: export_package(package_build_directory, str(package_path), log),
+                                   lambda x: x.return_code != 0, f'export of {os.path.basename(package_path)}')
+    if result.return_code != 0:
+        job_logs.add_failure(log)
+    if artifact_key is not None and result.return_code == 0:
+        with tracer.span('store_export', package=package_path_relative):
+            await asyncio.to_thread(artifact_cache.store_export, artifact_key, package_directory)
+    return result
+
+
+def record_failure(manifest: BuildManifest, package_path: str, file_hash: Optional[str], stage: str):
+    if manifest.record_failure(package_path, file_hash, stage):
+        print(f'{package_path} failed to {stage} {QUARANTINE_FAILURE_COUNT} times in a row and is quarantined until it '
+              f'changes (see `bdk quarantine`)')
+
+
+def deduplicate_package(catalog: Catalog, package_path: str):
+    # Cube map images are left out, since they are rendered into the export directory (in place) by the build itself.
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    content_store.deduplicate(
+        (os.path.join(build_directory, file.path), file.size, file.hash)
+        for asset in catalog.get_objects(package_path) for file in asset.files
+        if not (asset.class_name == 'Cubemap' and file.path.lower().endswith('.tga'))
+    )
+
+
+def trim_content_store():
+    if content_store.is_enabled:
+        content_store.trim(Catalog.load().get_file_hashes())
+
+
+def complete_export(manifest: BuildManifest, package_path: str, pending_update: Dict, result: ExportResult) -> bool:
+    # Records the result of exporting a package in the manifest.
+    package_path_relative = os.path.relpath(package_path, str(Path(os.environ['ROOT_DIRECTORY']).resolve()))
+    if result.return_code != 0:
+        print(f'Failed to export package: {package_path}')
+        record_failure(manifest, package_path_relative, pending_update['hash'], 'export')
+        return False
+    manifest.clear_failures(package_path_relative, 'export')
+    catalog = Catalog.load()
+    with tracer.span('catalog_index', package=package_path_relative):
+        catalog.index_package(package_path_relative)
+    if content_store.is_enabled:
+        with tracer.span('deduplicate', package=package_path_relative):
+            deduplicate_package(catalog, package_path_relative)
+    file = manifest.files[package_path_relative]
+    output_fingerprint = catalog.get_output_fingerprint(package_path_relative)
+    # Packages often export exactly the same files as before (e.g., script packages that were recompiled), in which
+    # case the library that was built from them is still up-to-date.
+    is_unchanged = file['is_built'] and file.get('output_fingerprint', None) == output_fingerprint
+    file.update(pending_update, output_fingerprint=output_fingerprint)
+    # Restoring from the artifact cache says nothing about how long exporting the package takes.
+    if not result.is_restored:
+        record_duration(file, EXPORT, result.duration)
+    if is_unchanged:
+        file['is_built'] = True
+    manifest.commit_file(package_path_relative)
+    return True
+
+
+def get_export_job_count(jobs: Union[int, str] = 'auto') -> int:
+    # umodel is single-threaded.
+    return get_job_count(jobs, UMODEL_MEMORY_ESTIMATE)
+
+
+def get_cube_map_job_count(jobs: Union[int, str] = 'auto', engine: str = 'blender') -> int:
+    if engine == 'numpy':
+        return get_job_count(jobs, NUMPY_CUBEMAP_MEMORY_ESTIMATE)
+    # Blender renders with multiple threads.
+    return get_job_count(jobs, BLENDER_MEMORY_ESTIMATE, cpu_share=0.25)
+
+
+def get_blend_job_count(jobs: Union[int, str] = 'auto') -> int:
+    return get_job_count(jobs, BLENDER_MEMORY_ESTIMATE, cpu_share=0.5)
+
+
+def get_texture_job_count(jobs: Union[int, str] = 'auto') -> int:
+    return get_job_count(jobs, TEXTURE_MEMORY_ESTIMATE)
+
+
+def export_assets(mod: Optional[str] = None, dry: bool = False, clean: bool = False, name_filter: Optional[str] = None,
+                  jobs: Union[int, str] = 'auto') -> List[str]:
+    manifest = BuildManifest.load()
 
-    if not dry and len(packages_to_build) > 0:
-        with tqdm.tqdm(total=len(packages_to_build)) as pbar:
-            with ThreadPoolExecutor(max_workers=8) as executor:
-                jobs = []
-                for package_path in packages_to_build:
-                    package_build_directory = os.path.join(
-                        build_directory,
-                        os.path.dirname(os.path.relpath(package_path, root_directory))
-                    )
-                    os.makedirs(package_build_directory, exist_ok=True)
-                    jobs.append(executor.submit(export_package, package_build_directory, str(package_path)))
-                for _ in as_completed(jobs):
-                    pbar.update(1)
+    packages_to_build, pending_updates = find_packages_to_export(manifest, mod, dry, clean, name_filter)
 
     if not dry:
-        manifest.save()
+        export_packages(manifest, packages_to_build, pending_updates, jobs)
+        artifact_cache.trim()
+        trim_content_store()
 
     return packages_to_build
 
 
-def build_cube_map(cubemap_file: str, build_directory: str):
+def export_packages(manifest: BuildManifest, packages_to_build: List[str], pending_updates: Dict[str, Dict],
+                    jobs: Union[int, str] = 'auto'):
+    # This is here so tqdm displays correctly inside PyCharm terminals,
+    # otherwise it gets all messed up.
+    time.sleep(0.1)
+
+    if len(packages_to_build) > 0:
+        # The longest exports are started first, so that they don't hold up the end of the stage.
+        root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+        cost_model = CostModel(manifest)
+        costs = {x: cost_model.estimate(EXPORT, os.path.relpath(x, root_directory)) for x in packages_to_build}
+        with CostProgressBar() as pbar:
+            for package_path in packages_to_build:
+                pbar.add(costs[package_path])
+            semaphore = asyncio.Semaphore(get_export_job_count(jobs))
+            jobs = {}
+            for package_path in sorted(packages_to_build, key=lambda x: (-costs[x], x)):
+                future = process_engine.submit(bounded(semaphore, export_package_to_build_directory, package_path,
+                                                       pending_updates[package_path]))
+                jobs[future] = package_path
+            for future in as_completed(jobs):
+                package_path = jobs[future]
+                complete_export(manifest, package_path, pending_updates[package_path], future.result())
+                pbar.update(costs[package_path])
+        job_logs.print_failures()
+
+        unchanged_count = sum(1 for x in packages_to_build if manifest.files[os.path.relpath(x, root_directory)]['is_built'])
+        if unchanged_count > 0:
+            print(f'{unchanged_count} package(s) exported the same files as before and don\'t need to be blended again')
+
+
+def get_cube_map_faces(cubemap_file: str, build_directory: str) -> List[str]:
     relative_package_directory = Path(cubemap_file).parent.parent
-    with open(os.path.join(os.environ['BUILD_DIRECTORY'], cubemap_file), 'r') as f:
+    catalog = Catalog.load()
+    with open(os.path.join(build_directory, cubemap_file), 'r') as f:
         contents = f.read()
         textures = re.findall(r'Faces\[\d] = ([\w\d]+\'[\w\d_\-.]+\')', contents)
         faces = []
         for texture in textures:
             face_reference = UReference.from_string(texture)
-            image_path = os.path.join(
-                build_directory,
-                relative_package_directory,
+            image_path = catalog.find_object_file(
+                face_reference.package_name,
                 face_reference.type_name,
-                f'{face_reference.object_name}.tga'
+                face_reference.object_name,
+                '.tga'
             )
-            faces.append(image_path)
+            if image_path is None:
+                # Not indexed, so assume that the face was exported alongside the cube map.
+                image_path = os.path.join(
+                    relative_package_directory,
+                    face_reference.type_name,
+                    f'{face_reference.object_name}.tga'
+                )
+            faces.append(os.path.join(build_directory, image_path))
+        if len(faces) != CUBE_MAP_FACE_COUNT:
+            raise ValueError(f'Expected {CUBE_MAP_FACE_COUNT} faces, got {len(faces)} ({cubemap_file})')
+        return faces
+
+
+def write_cube_map_jobs(cubemap_files: List[str], build_directory: str) -> Tuple[str, Dict[str, str], Dict[str, str]]:
+    # Writes the jobs of a cube map session to a temporary file, and returns its path, the cube map of each output and
+    # the error of each cube map that can't be rendered (e.g., because a face is missing), which is left out of the jobs.
+    jobs = []
+    cubemap_files_by_output_path = {}
+    errors = {}
+    for cubemap_file in cubemap_files:
         output_path = os.path.join(build_directory, cubemap_file.replace('.props.txt', '.tga'))
+        try:
+            faces = get_cube_map_faces(cubemap_file, build_directory)
+        except (OSError, ValueError) as e:
+            errors[cubemap_file] = str(e)
+            continue
+        jobs.append({'faces': faces, 'output': output_path})
+        cubemap_files_by_output_path[output_path] = cubemap_file
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(jobs, f)
+        return f.name, cubemap_files_by_output_path, errors
+
+
+async def build_cube_map_batch(cubemap_files: List[str], build_directory: str,
+                               on_result: Callable[[str, bool, Optional[float]], None]):
+    # Renders all the cube maps in a single Blender session, calling `on_result` (on the process engine) with the result
+    # and duration (if it was reported) of each one as it finishes.
+    jobs_path, cubemap_files_by_output_path, errors = await asyncio.to_thread(write_cube_map_jobs, cubemap_files,
+                                                                              build_directory)
+    for cubemap_file, error in errors.items():
+        with job_logs.open(cubemap_file, 'cubemap', Path(cubemap_file).parent.parent.name) as log:
+            log.write(f'{error}\n')
+            job_logs.add_failure(log)
+        on_result(cubemap_file, False, None)
+    if not cubemap_files_by_output_path:
+        os.remove(jobs_path)
+        return
+    # The cube maps are rendered in order, so the output up to the result of one is logged as its own (starting with
+    # that of Blender starting up, for the first one).
+    logs = deque(job_logs.open(x, 'cubemap', Path(x).parent.parent.name) for x in cubemap_files_by_output_path.values())
+
+    def on_output(line: str):
+        if not line.startswith(CUBEMAP_RESULT_PREFIX):
+            if logs:
+                logs[0].write(line)
+            return
+        result = json.loads(line[len(CUBEMAP_RESULT_PREFIX):])
+        cubemap_file = cubemap_files_by_output_path.pop(result['output'])
+        if logs and logs[0].name == cubemap_file:
+            log = logs.popleft()
+            log.close()
+            if not result['success']:
+                job_logs.add_failure(log)
+        if 'start' in result:
+            tracer.add_span('cubemap', 'blender', result['start'], result['duration'], cube_map=cubemap_file)
+        on_result(cubemap_file, result['success'], result.get('duration', None))
+
+    try:
         args = [
             os.environ['BLENDER_PATH'],
             './blender/cube2sphere.blend',
             '--background',
             '--python',
             './blender/cube2sphere.py',
-            '--']
-
-        args.extend(faces)
-        args.extend(['--output', output_path])
-        completed_process = subprocess.run(args, stdout=open(os.devnull, 'wb'))
-        return cubemap_file, completed_process.returncode
-
-
-def build_cube_maps(clean: bool = False, name_filter: str = None):
-    manifest = BuildManifest.load()
-
-    pattern = '**/Cubemap/*.props.txt'
-    build_directory = Path(os.environ['BUILD_DIRECTORY']).resolve()
-    cubemap_file_paths = []
-    for cubemap_file_path in glob(pattern, root_dir=build_directory, recursive=True):
-        cubemap_file_paths.append(cubemap_file_path)
+            '--',
+            '--jobs',
+            jobs_path
+        ]
+        timeout = process_limits.get_timeout(CUBEMAP_TIMEOUT_BASE, CUBEMAP_TIMEOUT_PER_CUBE_MAP,
+                                             len(cubemap_files_by_output_path))
+        async with memory_gate.admit_async(BLENDER_MEMORY_ESTIMATE):
+            with tracer.span('cubemap_batch', count=len(cubemap_files_by_output_path)):
+                await run_process_async(args, timeout, on_output)
+    finally:
+        os.remove(jobs_path)
+        for log in logs:
+            log.close()
+
+    # Anything the session didn't get to (e.g., because Blender crashed or was killed) has failed. It is built again
+    # by the next run. Only the cube map that the session was rendering has output to show.
+    if logs:
+        job_logs.add_failure(logs[0])
+    for cubemap_file in cubemap_files_by_output_path.values():
+        on_result(cubemap_file, False, None)
+
+
+def build_cube_map_numpy(cubemap_file: str, build_directory: str) -> bool:
+    # Converts the cube map without Blender. See `cubemap.py`.
+    from cubemap import convert_cube_map
+    output_path = os.path.join(build_directory, cubemap_file.replace('.props.txt', '.tga'))
+    with job_logs.open(cubemap_file, 'cubemap', Path(cubemap_file).parent.parent.name) as log:
+        try:
+            with tracer.span('cubemap', cube_map=cubemap_file):
+                convert_cube_map(get_cube_map_faces(cubemap_file, build_directory), output_path)
+        except (OSError, ValueError) as e:
+            log.write(f'{e}\n')
+            job_logs.add_failure(log)
+            return False
+    return True
+
+
+async def build_cube_map_group(cubemap_files: List[str], build_directory: str, engine: str = 'blender') -> List[Tuple[str, bool, Optional[float]]]:
+    # Builds the cube maps one after another (in a single session for Blender) and returns their results and durations.
+    results = []
+    if engine == 'numpy':
+        for cubemap_file in cubemap_files:
+            start = time.monotonic()
+            success = await asyncio.to_thread(build_cube_map_numpy, cubemap_file, build_directory)
+            results.append((cubemap_file, success, time.monotonic() - start))
+    else:
+        await build_cube_map_batch(cubemap_files, build_directory, lambda *result: results.append(result))
+    return results
+
+
+def complete_cube_map(manifest: BuildManifest, cubemap_file: str, success: bool, duration: Optional[float]):
+    # Records the result of building a cube map in the manifest.
+    if not success:
+        print(f'Failed to build cubemap: {cubemap_file}')
+        return
+    if duration is not None and cubemap_file in manifest.cube_maps:
+        manifest.cube_maps[cubemap_file]['duration'] = round(duration, 3)
+    manifest.mark_cubemap_as_built(cubemap_file)
+
+
+def split_into_batches(items: List[str], batch_count: int, get_cost: Callable[[str], float]) -> List[List[str]]:
+    # Splits the items into batches of about the same total cost, by adding the costliest remaining item to the
+    # cheapest batch.
+    batches = [[] for _ in range(batch_count)]
+    batch_costs = [0.0] * batch_count
+    for item in sorted(items, key=lambda x: (-get_cost(x), x)):
+        i = min(range(batch_count), key=lambda x: (batch_costs[x], x))
+        batches[i].append(item)
+        batch_costs[i] += get_cost(item)
+    return batches
+
+
+def find_cube_maps(catalog: Catalog, package_path: Optional[str] = None) -> List[str]:
+    # Returns the paths (relative to the build directory) of the exported cube maps, optionally of a single package.
+    return [
+        file.path for cube_map in catalog.get_objects(package_path, class_name='Cubemap')
+        for file in cube_map.files if file.path.endswith('.props.txt')
+    ]
 
-    print(f'Found {len(cubemap_file_paths)} cubemap(s)')
 
-    # Filter out cube maps that have already been built
+def find_cube_maps_to_build(manifest: BuildManifest, cubemap_file_paths: List[str], build_directory: str,
+                            clean: bool = False, name_filter: Optional[str] = None) -> List[str]:
+    # Filter out cube maps that have already been built.
+    # Cube maps whose stats changed are hashed and only rebuilt if their contents changed.
+    cubemap_file_paths_to_hash = []
     cubemap_file_paths_to_build = []
     for cubemap_file_path in cubemap_file_paths:
         if name_filter is not None:
@@ -274,130 +610,570 @@ def build_cube_maps(clean: bool = False, name_filter: str = None):
         size = os.path.getsize(file_path)
         if cubemap_file_path in manifest.cube_maps:
             file = manifest.cube_maps[cubemap_file_path]
-            if clean or mtime != file['last_modified_time'] or size != file['size'] or not file['is_built']:
-                # Update the file stats in the manifest.
-                file['last_modified_time'] = mtime
-                file['size'] = size
+            is_stat_changed = mtime != file['last_modified_time'] or size != file['size']
+            if clean or not file['is_built'] or (is_stat_changed and file.get('hash', None) is None):
                 cubemap_file_paths_to_build.append(cubemap_file_path)
+            elif not is_stat_changed and file.get('hash', None) is not None:
+                continue
         else:
             # New file, load it into the manifest.
             file = BuildManifest.File()
-            file.last_modified_time = mtime
-            file.size = size
-            file.is_built = False
             manifest.cube_maps[cubemap_file_path] = file
+            cubemap_file_paths_to_build.append(cubemap_file_path)
 
+        # Update the file stats in the manifest.
+        file['last_modified_time'] = mtime
+        file['size'] = size
+        cubemap_file_paths_to_hash.append(cubemap_file_path)
+
+    file_paths = [os.path.join(build_directory, x) for x in cubemap_file_paths_to_hash]
+    for cubemap_file_path, file_hash in zip(cubemap_file_paths_to_hash, hash_files(file_paths).values()):
+        file = manifest.cube_maps[cubemap_file_path]
+        previous_hash = file.get('hash', None)
+        file['hash'] = file_hash
+        # Built cube maps whose stats changed are only rebuilt if their contents changed too.
+        if previous_hash is not None and previous_hash != file_hash and cubemap_file_path not in cubemap_file_paths_to_build:
             cubemap_file_paths_to_build.append(cubemap_file_path)
 
+    for cubemap_file_path in cubemap_file_paths_to_build:
+        manifest.cube_maps[cubemap_file_path]['is_built'] = False
+
+    return cubemap_file_paths_to_build
+
+
+def build_cube_maps(clean: bool = False, name_filter: str = None, engine: str = 'blender', jobs: Union[int, str] = 'auto',
+                    package_paths: Optional[Iterable[str]] = None):
+    # Builds the cube maps of every package, or only those of `package_paths`.
+    manifest = BuildManifest.load()
+    catalog = Catalog.load()
+    catalog.ensure_indexed(manifest.files)
+
+    build_directory = Path(os.environ['BUILD_DIRECTORY']).resolve()
+    if package_paths is None:
+        cubemap_file_paths = find_cube_maps(catalog)
+    else:
+        cubemap_file_paths = [x for package_path in sorted(package_paths) for x in find_cube_maps(catalog, package_path)]
+
+    print(f'Found {len(cubemap_file_paths)} cubemap(s)')
+
+    cubemap_file_paths_to_build = find_cube_maps_to_build(manifest, cubemap_file_paths, str(build_directory), clean, name_filter)
+
     print(f'{len(cubemap_file_paths_to_build)} cubemap(s) marked for rebuilding')
 
-    with tqdm.tqdm(total=len(cubemap_file_paths_to_build)) as pbar:
-        jobs = []
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            for cubemap_file in cubemap_file_paths_to_build:
-                jobs.append(executor.submit(build_cube_map, cubemap_file, build_directory))
+    manifest.save()
+
+    cost_model = CostModel(manifest)
+    costs = {x: cost_model.estimate_cube_map(x) for x in cubemap_file_paths_to_build}
+
+    with CostProgressBar() as pbar:
+        for cubemap_file in cubemap_file_paths_to_build:
+            pbar.add(costs[cubemap_file])
+        lock = threading.Lock()
+
+        def on_result(cubemap_file: str, success: bool, duration: Optional[float]):
+            with lock:
+                complete_cube_map(manifest, cubemap_file, success, duration)
+                pbar.update(costs[cubemap_file])
+
+        job_count = get_cube_map_job_count(jobs, engine)
+        if engine == 'numpy':
+            semaphore = asyncio.Semaphore(job_count)
+            jobs = [
+                process_engine.submit(bounded(semaphore, build_cube_map_group, [x], str(build_directory), engine))
+                for x in sorted(cubemap_file_paths_to_build, key=lambda x: (-costs[x], x))
+            ]
+            for future in as_completed(jobs):
+                for result in future.result():
+                    on_result(*result)
+        else:
+            # Blender startup dominates the time it takes to render a cube map, so they are rendered in a few long
+            # sessions of about the same length.
+            batch_count = min(job_count, len(cubemap_file_paths_to_build))
+            batches = split_into_batches(cubemap_file_paths_to_build, batch_count, lambda x: costs[x])
+            jobs = [process_engine.submit(build_cube_map_batch(batch, str(build_directory), on_result)) for batch in batches]
+            for future in as_completed(jobs):
+                future.result()
+    job_logs.print_failures()
+
+
+class TranscodeResult(NamedTuple):
+    transcoded_count: int
+    failed_count: int
+    # The sizes of the exported files that were transcoded, and of their full-size PNG files.
+    input_size: int
+    output_size: int
+
+
+def get_package_textures(catalog: Catalog, package_path: str) -> List[Tuple[str, str, str]]:
+    # Returns the exported TGA files of the package, the paths (without their suffix) of their transcoded versions and
+    # the hashes of the exported files.
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    package_directory = os.path.splitext(os.path.join(build_directory, package_path))[0]
+    texture_directory = get_texture_directory(package_path)
+    textures = []
+    for asset in catalog.get_objects(package_path):
+        # Cube map images are rendered by the build, and aren't referenced by libraries.
+        if asset.class_name == 'Cubemap':
+            continue
+        for file in asset.files:
+            if file.path.lower().endswith('.tga'):
+                source_path = os.path.join(build_directory, file.path)
+                relative_path = os.path.relpath(source_path, package_directory)
+                textures.append((source_path, os.path.join(texture_directory, os.path.splitext(relative_path)[0]),
+                                 file.hash))
+    return textures
+
+
+def get_textures_fingerprint(file: Dict) -> Optional[str]:
+    # Textures are transcoded again when the package exports different files.
+    output_fingerprint = file.get('output_fingerprint', None)
+    return f'{TEXTURE_VERSION}-{output_fingerprint}' if output_fingerprint is not None else None
+
+
+def are_textures_up_to_date(file: Dict) -> bool:
+    return file.get('textures_fingerprint', None) == get_textures_fingerprint(file)
+
+
+async def transcode_package_textures(package_path: str, clean: bool = False) -> TranscodeResult:
+    # Transcodes the textures of the package that changed since they were last transcoded (or all of them, if `clean`
+    # is set), in the processes of the transcoder's pool, and removes those of textures that it no longer exports.
+    # Runs on the process engine.
+    textures = await asyncio.to_thread(get_package_textures, Catalog.load(), package_path)
+    stale_textures = [x for x in textures if clean or not is_texture_up_to_date(x[0], x[1])]
+    results = await asyncio.gather(*(texture_transcoder.transcode(*x) for x in stale_textures), return_exceptions=True)
+    await asyncio.to_thread(remove_stale_textures, get_texture_directory(package_path), [x[1] for x in textures])
+
+    failures = [(texture, x) for texture, x in zip(stale_textures, results) if isinstance(x, BaseException)]
+    if failures:
+        with job_logs.open(package_path, 'textures') as log:
+            for (source_path, _, _), e in failures:
+                log.write(f'Failed to transcode {source_path}: {e}\n')
+        job_logs.add_failure(log)
+    sizes = [x for x in results if not isinstance(x, BaseException)]
+    return TranscodeResult(len(sizes), len(failures), sum(x[0] for x in sizes), sum(x[1] for x in sizes))
+
+
+def complete_transcode(manifest: BuildManifest, package_path: str, result: TranscodeResult):
+    # Records that the textures of the package are up-to-date. Textures that failed are transcoded again next time, and
+    # libraries keep referencing their exported files until then.
+    if result.failed_count == 0 and package_path in manifest.files:
+        file = manifest.files[package_path]
+        file['textures_fingerprint'] = get_textures_fingerprint(file)
+
+
+def update_package_textures(manifest: BuildManifest, package_path: str):
+    # Transcodes the textures of a single package if they are out-of-date (e.g., when it is blended by the pipeline,
+    # which doesn't have a stage for it). Recorded along with `is_built` by the caller.
+    file = manifest.files.get(package_path, None)
+    if file is None or are_textures_up_to_date(file):
+        return
+    with tracer.span('transcode_textures', package=package_path):
+        Catalog.load().ensure_indexed([package_path])
+        complete_transcode(manifest, package_path, process_engine.run(transcode_package_textures(package_path)))
+
+
+def transcode_textures(manifest: BuildManifest, package_paths: List[str], clean: bool = False):
+    # Transcodes the textures of the packages that are about to be blended, so that their libraries can reference the
+    # variant chosen with `--textures`. Every texture is queued at once, keeping the whole pool busy.
+    package_paths = [
+        x for x in package_paths if x in manifest.files and (clean or not are_textures_up_to_date(manifest.files[x]))
+    ]
+
+    print(f'{len(package_paths)} package(s) with textures to transcode')
+
+    if len(package_paths) == 0:
+        return
+
+    Catalog.load().ensure_indexed(package_paths)
+    transcoded_count = 0
+    input_size = 0
+    output_size = 0
+    with tracer.span('transcode_textures', count=len(package_paths)), tqdm.tqdm(total=len(package_paths)) as pbar:
+        jobs = {process_engine.submit(transcode_package_textures(x, clean)): x for x in package_paths}
         for future in as_completed(jobs):
-            cubemap_file, return_code = future.result()
-            if return_code == 0:
-                manifest.mark_cubemap_as_built(cubemap_file)
-            else:
-                print(f'Failed to build cubemap: {cubemap_file}')
+            package_path = jobs[future]
+            result = future.result()
+            complete_transcode(manifest, package_path, result)
+            manifest.commit_file(package_path)
+            transcoded_count += result.transcoded_count
+            input_size += result.input_size
+            output_size += result.output_size
             pbar.update(1)
+    job_logs.print_failures()
+    print(f'Transcoded {transcoded_count} texture(s) ({input_size / MB:.1f} MB to {output_size / MB:.1f} MB at full size)')
 
-    manifest.save()
 
+def get_blend_output_path(package_path: str) -> str:
+    if os.path.splitext(package_path)[1] == '.rom':
+        root_directory = os.environ['MAPS_DIRECTORY']
+    else:
+        root_directory = os.environ['LIBRARY_DIRECTORY']
+    output_path = os.path.join(root_directory, Path(package_path).with_suffix('.blend'))
+    return str(Path(output_path).resolve())
 
-def build_assets(
-        mod: Optional[str] = None,
-        dry: bool = False,
-        clean: bool = False,
-        no_export: bool = False,
-        no_cubemaps: bool = False,
-        name_filter: Optional[str] = None):
 
-    # First export the assets.
-    if not no_export:
-        export_assets(mod, dry, clean)
+def get_preview_cache_directory() -> str:
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    return os.path.join(build_directory, PREVIEW_CACHE_DIRECTORY_NAME, f'v{PREVIEW_CACHE_VERSION}')
 
-    # Build the cube maps.
-    if not no_cubemaps:
-        build_cube_maps(clean, name_filter)
 
+def get_asset_hashes(catalog: Catalog, package_path: str) -> Dict[str, str]:
+    # Returns the hash of everything each asset was built from, keyed by `<class>/<name>`. An asset (and its preview)
+    # only has to be built again when it or something it references (e.g., a texture of a material) changed.
+    return {f'{class_name}/{name}': input_hash for (class_name, name), input_hash in catalog.get_input_hashes(package_path).items()}
+
+
+@lru_cache(maxsize=None)
+def get_blend_version() -> str:
+    # Libraries that reference transcoded textures are told apart from those that reference the exported ones.
+    texture_variant = f'-{texture_transcoder.variant}' if texture_transcoder.is_enabled else ''
+    return f'{BLEND_VERSION}-{hash_file("./blender/blend.py")}{texture_variant}'
+
+
+def get_library_update(file: Optional[Dict], asset_hashes: Dict[str, str], output_path: str) -> Optional[Dict]:
+    # Returns the assets to remove from and (re-)import into the existing library, or None if it must be built from
+    # scratch because it doesn't exist or was built by another version of the tools.
+    if file is None or 'assets' not in file or file.get('blend_version', None) != get_blend_version() or \
+            not os.path.isfile(output_path):
+        return None
+    built_asset_hashes = file['assets']
+    return {
+        'changed': sorted(x for x, asset_hash in asset_hashes.items() if built_asset_hashes.get(x, None) != asset_hash),
+        'removed': sorted(x for x in built_asset_hashes if x not in asset_hashes)
+    }
+
+
+def blend_package(pool: BlenderWorkerPool, package_path: str, defer_previews: bool = False) -> Optional[bool]:
+    # Returns None if the package was skipped because it has not been exported.
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    input_directory = os.path.splitext(os.path.join(build_directory, package_path))[0]
+
+    if not os.path.isdir(input_directory):
+        print(f'Input directory does not exist: {input_directory}, skipping')
+        return None
+
+    job = {
+        'input_directory': input_directory,
+        'output_path': get_blend_output_path(package_path),
+        'preview_cache_directory': get_preview_cache_directory(),
+        'defer_previews': defer_previews
+    }
+
+    manifest = BuildManifest.load()
+
+    if texture_transcoder.is_enabled:
+        update_package_textures(manifest, package_path)
+        job['textures'] = {'directory': get_texture_directory(package_path), 'suffix': texture_transcoder.suffix}
+
+    # List the files to import from the catalog, so that Blender doesn't have to walk the directory.
+    # The catalog also tells which assets changed since the library was built, so that only those are imported again.
+    asset_hashes = None
+    input_size = 0
+    catalog = Catalog.load()
+    if catalog.is_package_indexed(package_path):
+        input_size = catalog.get_package_size(package_path)
+        job['files'] = [
+            os.path.relpath(os.path.join(build_directory, file.path), input_directory)
+            for asset in catalog.get_objects(package_path) for file in asset.files if file.path.endswith('.props.txt')
+        ]
+        asset_hashes = get_asset_hashes(catalog, package_path)
+        job['previews'] = asset_hashes
+        update = get_library_update(manifest.files.get(package_path, None), asset_hashes, job['output_path'])
+        if update is not None:
+            job['update'] = update
+
+    # A library that was built from the same inputs with the same tools (e.g., on another machine) is copied instead.
+    artifact_key = None
+    if artifact_cache.is_enabled and asset_hashes is not None:
+        artifact_key = get_blend_key(package_path, catalog.get_output_fingerprint(package_path), asset_hashes,
+                                     get_blend_version())
+        with tracer.span('restore_blend', package=package_path):
+            if artifact_cache.restore_blend(artifact_key, job['output_path']):
+                if package_path in manifest.files:
+                    manifest.files[package_path].update(has_previews=True, assets=asset_hashes,
+                                                        blend_version=get_blend_version(),
+                                                        textures=texture_transcoder.variant)
+                return True
+
+    timeout = process_limits.get_timeout(BLEND_TIMEOUT_BASE, BLEND_TIMEOUT_PER_MB, input_size / MB)
+    with tracer.span('blend', package=package_path, update='update' in job), job_logs.open(package_path, 'blend') as log:
+        start = time.monotonic()
+        # Only jobs whose worker died are retried, since errors reported by the build script would happen again.
+        result = retry(lambda: pool.run(job, timeout, log.write), lambda x: x.get('crashed', False),
+                       f'blend of {package_path}')
+        duration = time.monotonic() - start
+    if not result['success']:
+        job_logs.add_failure(log)
+
+    # These are committed along with `is_built` by the caller.
+    if result['success'] and package_path in manifest.files:
+        file = manifest.files[package_path]
+        record_duration(file, BLEND, duration)
+        file['textures'] = texture_transcoder.variant
+        # Assets that weren't imported again keep the previews they had.
+        file['has_previews'] = result.get('missing_preview_count', 0) == 0 and \
+            ('update' not in job or file.get('has_previews', True))
+        if asset_hashes is not None:
+            # Assets that failed to import are left out, so that they are imported again next time.
+            failed_assets = set(result.get('failed_assets', []))
+            file['assets'] = {x: asset_hash for x, asset_hash in asset_hashes.items() if x not in failed_assets}
+            file['blend_version'] = get_blend_version()
+        else:
+            file.pop('assets', None)
+
+    # Only complete libraries are shared, since a library restored from the cache is never updated to fill in what
+    # is missing.
+    if result['success'] and artifact_key is not None and not result.get('failed_assets', []) and \
+            result.get('missing_preview_count', 0) == 0 and manifest.files.get(package_path, {}).get('has_previews', True):
+        with tracer.span('store_blend', package=package_path):
+            artifact_cache.store_blend(artifact_key, job['output_path'])
+
+    return result['success']
+
+
+def complete_blend(manifest: BuildManifest, package_path: str, success: bool):
+    # Records the result of blending a package in the manifest.
+    if success:
+        manifest.mark_file_as_built(package_path)
+        manifest.clear_failures(package_path)
+        return
+    print('BUILD FAILED FOR ' + os.path.basename(package_path))
+    file = manifest.files.get(package_path, None)
+    record_failure(manifest, package_path, file['hash'] if file is not None else None, 'blend')
+
+
+def find_packages_missing_previews(manifest: BuildManifest, name_filter: Optional[str] = None) -> List[str]:
+    package_paths = [x for x, file in manifest.files.items() if file['is_built'] and not file.get('has_previews', True)]
+    return filter_packages_to_blend(package_paths, name_filter)
+
+
+def generate_package_previews(pool: BlenderWorkerPool, package_path: str) -> bool:
+    catalog = Catalog.load()
+    job = {
+        'type': 'previews',
+        'blend_path': get_blend_output_path(package_path),
+        'previews': get_asset_hashes(catalog, package_path),
+        'preview_cache_directory': get_preview_cache_directory()
+    }
+    timeout = process_limits.get_timeout(BLEND_TIMEOUT_BASE, BLEND_TIMEOUT_PER_MB, catalog.get_package_size(package_path) / MB)
+    with tracer.span('previews', package=package_path), job_logs.open(package_path, 'previews') as log:
+        success = pool.run(job, timeout, log.write)['success']
+    if not success:
+        job_logs.add_failure(log)
+    return success
+
+
+def build_previews(name_filter: Optional[str] = None, jobs: Union[int, str] = 1):
+    # Generates the previews that were deferred when packages were blended. This runs at a low priority, so that it
+    # can run alongside other work once the libraries themselves are usable.
     manifest = BuildManifest.load()
+    package_paths = find_packages_missing_previews(manifest, name_filter)
+
+    print(f'{len(package_paths)} package(s) missing previews')
+
+    if len(package_paths) == 0:
+        return
+
+    job_count = get_blend_job_count(jobs)
+    with BlenderWorkerPool(job_count, low_priority=True) as pool, tqdm.tqdm(total=len(package_paths)) as pbar:
+        with ThreadPoolExecutor(max_workers=job_count) as executor:
+            jobs = {executor.submit(generate_package_previews, pool, x): x for x in package_paths}
+            for future in as_completed(jobs):
+                package_path = jobs[future]
+                if future.result():
+                    manifest.files[package_path]['has_previews'] = True
+                    manifest.commit_file(package_path)
+                else:
+                    print(f'Failed to generate previews for {package_path}')
+                pbar.update(1)
+    job_logs.print_failures()
+
+
+# Order the packages so that texture packages are built first when nothing else decides between them.
+# NOTE: It's possible for non-UTX packages to have textures in them.
+BLEND_EXTENSION_ORDER = ['.rom', '.usx', '.utx', '.u']
+
+
+def get_package_priority(package_path: str):
+    try:
+        return -BLEND_EXTENSION_ORDER.index(os.path.splitext(package_path)[1]), package_path
+    except ValueError as e:
+        return 1, package_path
 
-    # TODO: TQDM this once we sort all the errors
+
+def filter_packages_to_blend(package_paths: List[str], name_filter: Optional[str] = None) -> List[str]:
+    if name_filter is not None:
+        package_paths = fnmatch.filter(package_paths, name_filter)
+
+    return list(filter(lambda x: os.path.splitext(x)[1] in BLEND_EXTENSION_ORDER, package_paths))
+
+
+def find_packages_to_blend(manifest: BuildManifest, clean: bool = False, name_filter: Optional[str] = None) -> List[str]:
     # TODO: we need to exclude cubemaps from this!
     # Build a list of packages that have been exported but haven't been built yet.
     package_paths_to_build = []
+    # Quarantined packages are left out until they are exported again or released.
+    # Libraries that reference another variant of their textures (see `--textures`) are built again as well.
     for file_path, file in manifest.files.items():
-        if not file['is_built'] or clean:
+        is_built = file['is_built'] and file.get('textures', 'tga') == texture_transcoder.variant
+        if (not is_built or clean) and not manifest.is_quarantined(file_path):
             package_paths_to_build.append(file_path)
 
+    return filter_packages_to_blend(package_paths_to_build, name_filter)
+
+
+def get_quarantined_packages(manifest: BuildManifest, name_filter: Optional[str] = None) -> List[str]:
+    package_paths = sorted(x for x in manifest.quarantine if manifest.is_quarantined(x))
     if name_filter is not None:
-        package_paths_to_build = fnmatch.filter(package_paths_to_build, name_filter)
+        package_paths = fnmatch.filter(package_paths, name_filter)
+    return package_paths
 
-    if len(package_paths_to_build) == 0:
-        print('No packages marked to be built')
 
-    # Order the packages so that texture packages are built first.
-    # NOTE: It's possible for non-UTX packages to have textures in them.
-    ext_order = [ '.rom', '.usx', '.utx', '.u']
-    package_paths_to_build = list(filter(lambda x: os.path.splitext(x)[1] in ext_order, package_paths_to_build))
+def print_quarantined_packages(name_filter: Optional[str] = None):
+    manifest = BuildManifest.load()
+    package_paths = get_quarantined_packages(manifest, name_filter)
+    print(f'{len(package_paths)} quarantined package(s)')
+    for package_path in package_paths:
+        entry = manifest.quarantine[package_path]
+        print(f'{package_path} (failed to {entry["stage"]} {entry["failure_count"]} times)')
 
-    def package_extension_sort_key_cb(path: str):
-        try:
-            return ext_order.index(os.path.splitext(path)[1])
-        except ValueError as e:
-            return -1
 
-    package_paths_to_build.sort(key=package_extension_sort_key_cb, reverse=True)
+def release_quarantined_packages(name_filter: Optional[str] = None):
+    # Lets the quarantined packages be built again by the next build.
+    manifest = BuildManifest.load()
+    package_paths = get_quarantined_packages(manifest, name_filter)
+    for package_path in package_paths:
+        manifest.clear_failures(package_path)
+    print(f'{len(package_paths)} package(s) released from quarantine')
+
 
-    print('Build order:')
-    for p in package_paths_to_build:
-        print(p)
+def select_shard(manifest: BuildManifest, shard: Shard, packages_to_export: List[str], clean: bool = False,
+                 name_filter: Optional[str] = None) -> Set[str]:
+    # Returns the packages (relative to the root directory) that the shard exports and blends, out of every package
+    # that is out-of-date. Every shard must start from the same manifest and exported files to agree on this.
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    package_paths = set(os.path.relpath(x, root_directory) for x in packages_to_export)
+    package_paths.update(find_packages_to_blend(manifest, clean, name_filter))
+    catalog = Catalog.load()
+    catalog.ensure_indexed(package_paths)
+    # Packages that weren't exported before are partitioned by the imports in their headers.
+    return select_shard_packages(shard, package_paths,
+                                 lambda x: build_dependency_graph(x, build_directory, catalog, root_directory),
+                                 CostModel(manifest).estimate_build)
+
+
+def blend_packages(manifest: BuildManifest, pool: BlenderWorkerPool, package_paths: List[str], job_count: int,
+                   defer_previews: bool = False, verbose: bool = True) -> Tuple[int, int]:
+    # Blends the packages with the workers of the pool, and returns how many succeeded and failed.
+    # Packages must be built after the packages they reference (e.g., a static mesh package after the texture
+    # packages its materials come from), so that the assets they link to already exist.
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    catalog = Catalog.load()
+    catalog.ensure_indexed(package_paths)
+    graph = build_dependency_graph(package_paths, build_directory, catalog)
+    cycles = find_cycles(graph)
+    for cycle in cycles:
+        print(f'Dependency cycle detected, these packages will be built in no particular order: {", ".join(cycle)}')
+    graph = break_cycles(graph, cycles)
+    # Of the packages that are ready, the ones that hold up the longest expected chain of work are started first.
+    cost_model = CostModel(manifest)
+    critical_path_costs = get_critical_path_costs(graph, lambda x: cost_model.estimate(BLEND, x))
+    scheduler = DependencyScheduler(graph, priority_key=lambda x: (-critical_path_costs[x], get_package_priority(x)))
+
+    if verbose:
+        print('Build order:')
+        for p in scheduler.static_order():
+            print(p)
 
     success_count = 0
     failure_count = 0
+    for package_path, result in scheduler.run(lambda x: blend_package(pool, x, defer_previews), max_workers=job_count):
+        if result is None:
+            continue
+        complete_blend(manifest, package_path, result)
+        if result:
+            success_count += 1
+        else:
+            failure_count += 1
+    job_logs.print_failures()
+    return success_count, failure_count
 
-    # Now blend the assets.
-    for package_path in package_paths_to_build:
-        package_name = os.path.basename(package_path)
-        package_build_path = str(Path(os.path.join(os.environ['BUILD_DIRECTORY'], package_path)).resolve())
 
-        script_path = './blender/blend.py'
+def build_assets(
+        mod: Optional[str] = None,
+        dry: bool = False,
+        clean: bool = False,
+        no_export: bool = False,
+        no_cubemaps: bool = False,
+        name_filter: Optional[str] = None,
+        cubemap_engine: str = 'blender',
+        export_jobs: Union[int, str] = 'auto',
+        cubemap_jobs: Union[int, str] = 'auto',
+        blend_jobs: Union[int, str] = 'auto',
+        worker_max_jobs: int = 100,
+        worker_max_memory: Optional[int] = None,
+        pipeline: bool = False,
+        queue_size: int = 64,
+        defer_previews: bool = False,
+        shard: Optional[Shard] = None):
+
+    # A shard of the build only builds its share of the packages, and records them in its own manifest fragment.
+    if shard is not None:
+        use_fragment(shard)
+
+    if pipeline and not dry:
+        from pipeline import build_assets_pipelined
+        build_assets_pipelined(mod, clean, no_export, no_cubemaps, name_filter, cubemap_engine, export_jobs,
+                               cubemap_jobs, blend_jobs, worker_max_jobs, worker_max_memory, queue_size, defer_previews,
+                               shard)
+        texture_transcoder.close()
+        if defer_previews:
+            build_previews(name_filter)
+        return
+
+    manifest = BuildManifest.load()
 
-        input_directory = os.path.splitext(package_build_path)[0]
+    packages_to_export, pending_updates = [], {}
+    if not no_export:
+        packages_to_export, pending_updates = find_packages_to_export(manifest, mod, dry, clean)
 
-        if not os.path.isdir(input_directory):
-            print(f'Input directory does not exist: {input_directory}, skipping')
-            continue
+    shard_package_paths = None
+    if shard is not None:
+        shard_package_paths = select_shard(manifest, shard, packages_to_export, clean, name_filter)
+        root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+        packages_to_export = [x for x in packages_to_export if os.path.relpath(x, root_directory) in shard_package_paths]
 
-        if os.path.splitext(package_path)[1] == '.rom':
-            root_directory = os.environ['MAPS_DIRECTORY']
-        else:
-            root_directory = os.environ['LIBRARY_DIRECTORY']
+    # First export the assets.
+    if not no_export and not dry:
+        export_packages(manifest, packages_to_export, pending_updates, export_jobs)
+
+    # Build the cube maps.
+    if not no_cubemaps:
+        build_cube_maps(clean, name_filter, engine=cubemap_engine, jobs=cubemap_jobs, package_paths=shard_package_paths)
 
-        output_path = os.path.join(root_directory, Path(package_path).with_suffix('.blend'))
-        output_path = str(Path(output_path).resolve())
+    package_paths_to_build = find_packages_to_blend(manifest, clean, name_filter)
+    if shard_package_paths is not None:
+        package_paths_to_build = [x for x in package_paths_to_build if x in shard_package_paths]
 
-        script_args = ['build', input_directory, '--output_path', output_path]
+    if len(package_paths_to_build) == 0:
+        print('No packages marked to be built')
 
-        args = [
-                   os.environ['BLENDER_PATH'],
-                   '--background',
-                   './blender/build_template.blend',
-                   '--python',
-                   script_path,
-                   '--'
-               ] + script_args
-
-        if subprocess.call(args) == 0:
-            manifest.mark_file_as_built(package_path)
-            success_count += 1
-        else:
-            print('BUILD FAILED FOR ' + package_name)
-            failure_count += 1
+    # Transcode the textures of the packages to blend, so that their libraries can reference them.
+    if texture_transcoder.is_enabled and not dry:
+        transcode_textures(manifest, package_paths_to_build, clean)
+        texture_transcoder.close()
 
-    manifest.save()
+    # Now blend the assets.
+    blend_job_count = get_blend_job_count(blend_jobs)
+    with BlenderWorkerPool(blend_job_count, max_jobs=worker_max_jobs, max_memory=worker_max_memory) as pool:
+        success_count, failure_count = blend_packages(manifest, pool, package_paths_to_build, blend_job_count,
+                                                      defer_previews)
 
     print(f'{success_count} Succeeded | {failure_count} Failed')
+    if not dry:
+        artifact_cache.trim()
+        trim_content_store()
+
+    if defer_previews:
+        build_previews(name_filter)
@@ -0,0 +1,287 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, Dict, List, Set, Tuple, NamedTuple, Iterable
+
+import xxhash
+
+from bdk import UReference
+from hashing import hash_files
+from scheduler import REFERENCE_PATTERN
+
+CATALOG_FILENAME = '.bdkcatalog'
+
+_catalogs: Dict[str, 'Catalog'] = {}
+_catalogs_lock = threading.Lock()
+
+
+class CatalogFile(NamedTuple):
+    path: str
+    size: int
+    hash: str
+
+
+class CatalogObject(NamedTuple):
+    package: str
+    group_name: Optional[str]
+    class_name: str
+    name: str
+    files: List[CatalogFile]
+
+
+def get_catalog_path() -> str:
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    return os.path.join(build_directory, CATALOG_FILENAME)
+
+
+def get_package_name(package_path: str) -> str:
+    # Package names are case-insensitive in Unreal, so they are stored in lower-case.
+    return os.path.splitext(os.path.basename(package_path))[0].lower()
+
+
+def _scan_files(directory: str) -> List[Tuple[str, int]]:
+    files = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir():
+                files += _scan_files(entry.path)
+            else:
+                files.append((entry.path, entry.stat().st_size))
+    return files
+
+
+def _read_references(path: str) -> List[UReference]:
+    with open(path, 'r', errors='ignore') as f:
+        references = [UReference.from_string(x) for x in REFERENCE_PATTERN.findall(f.read())]
+    return [x for x in references if x is not None]
+
+
+# An index of every exported object, kept in an SQLite database in the build directory. It maps each object to the
+# files it was exported to, and records the objects that it references.
+# Packages are keyed by their path relative to the root directory (as in the build manifest), and file paths are
+# relative to the build directory.
+class Catalog:
+
+    def __init__(self, path: str):
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS packages (
+                path TEXT PRIMARY KEY,
+                name TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+            CREATE TABLE IF NOT EXISTS objects (
+                id INTEGER PRIMARY KEY,
+                package TEXT NOT NULL,
+                group_name TEXT,
+                class TEXT NOT NULL,
+                name TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS objects_package ON objects (package);
+            CREATE INDEX IF NOT EXISTS objects_name ON objects (name COLLATE NOCASE);
+            CREATE TABLE IF NOT EXISTS files (
+                object_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_object ON files (object_id);
+            CREATE TABLE IF NOT EXISTS refs (
+                object_id INTEGER NOT NULL,
+                class TEXT NOT NULL,
+                package_name TEXT NOT NULL,
+                name TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS refs_object ON refs (object_id);
+            CREATE INDEX IF NOT EXISTS refs_package_name ON refs (package_name);
+            CREATE INDEX IF NOT EXISTS refs_name ON refs (name COLLATE NOCASE);
+        ''')
+
+    @staticmethod
+    def load(path: Optional[str] = None) -> 'Catalog':
+        if path is None:
+            path = get_catalog_path()
+        with _catalogs_lock:
+            if path not in _catalogs:
+                _catalogs[path] = Catalog(path)
+            return _catalogs[path]
+
+    def _delete_package(self, package_path: str):
+        self._connection.execute('DELETE FROM files WHERE object_id IN (SELECT id FROM objects WHERE package = ?)', (package_path,))
+        self._connection.execute('DELETE FROM refs WHERE object_id IN (SELECT id FROM objects WHERE package = ?)', (package_path,))
+        self._connection.execute('DELETE FROM objects WHERE package = ?', (package_path,))
+        self._connection.execute('DELETE FROM packages WHERE path = ?', (package_path,))
+
+    def index_package(self, package_path: str):
+        # (Re-)indexes the exported objects of the package. umodel exports each object to
+        # `<package>/[<group>/...]<class>/<name>.<extension>`.
+        build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+        package_directory = os.path.splitext(os.path.join(build_directory, package_path))[0]
+
+        files = _scan_files(package_directory) if os.path.isdir(package_directory) else []
+        hashes = hash_files([x[0] for x in files])
+
+        objects: Dict[Tuple[str, str], List[CatalogFile]] = {}
+        for path, size in files:
+            directory, filename = os.path.split(path)
+            object_name = filename.split('.')[0]
+            relative_path = os.path.relpath(path, build_directory)
+            objects.setdefault((directory, object_name), []).append(CatalogFile(relative_path, size, hashes[path]))
+
+        references = {}
+        for (directory, object_name), object_files in objects.items():
+            references[(directory, object_name)] = [
+                reference for file in object_files if file.path.endswith('.props.txt')
+                for reference in _read_references(os.path.join(build_directory, file.path))
+            ]
+
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._delete_package(package_path)
+                self._connection.execute('INSERT INTO packages (path, name) VALUES (?, ?)', (package_path, get_package_name(package_path)))
+                for (directory, object_name), object_files in objects.items():
+                    parts = Path(os.path.relpath(directory, package_directory)).parts
+                    class_name = parts[-1] if parts else ''
+                    group_name = '.'.join(parts[:-1]) if len(parts) > 1 else None
+                    cursor = self._connection.execute(
+                        'INSERT INTO objects (package, group_name, class, name) VALUES (?, ?, ?, ?)',
+                        (package_path, group_name, class_name, object_name))
+                    object_id = cursor.lastrowid
+                    self._connection.executemany(
+                        'INSERT INTO files (object_id, path, size, hash) VALUES (?, ?, ?, ?)',
+                        [(object_id, x.path, x.size, x.hash) for x in object_files])
+                    self._connection.executemany(
+                        'INSERT INTO refs (object_id, class, package_name, name) VALUES (?, ?, ?, ?)',
+                        [(object_id, x.type_name, x.package_name.lower(), x.object_name) for x in references[(directory, object_name)]])
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def remove_package(self, package_path: str):
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._delete_package(package_path)
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def is_package_indexed(self, package_path: str) -> bool:
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM packages WHERE path = ?', (package_path,)).fetchone() is not None
+
+    def ensure_indexed(self, package_paths: Iterable[str]):
+        # Indexes the packages that were exported before the catalog existed.
+        build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+        with self._lock:
+            indexed_package_paths = set(x[0] for x in self._connection.execute('SELECT path FROM packages'))
+        for package_path in package_paths:
+            if package_path not in indexed_package_paths and \
+                    os.path.isdir(os.path.splitext(os.path.join(build_directory, package_path))[0]):
+                self.index_package(package_path)
+
+    def get_objects(self, package_path: Optional[str] = None, class_name: Optional[str] = None) -> List[CatalogObject]:
+        query = 'SELECT o.id, o.package, o.group_name, o.class, o.name, f.path, f.size, f.hash ' \
+                'FROM objects o LEFT JOIN files f ON f.object_id = o.id WHERE 1'
+        parameters = []
+        if package_path is not None:
+            query += ' AND o.package = ?'
+            parameters.append(package_path)
+        if class_name is not None:
+            query += ' AND o.class = ?'
+            parameters.append(class_name)
+        query += ' ORDER BY o.id'
+        objects: Dict[int, CatalogObject] = {}
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        for object_id, package, group_name, class_, name, path, size, file_hash in rows:
+            if object_id not in objects:
+                objects[object_id] = CatalogObject(package, group_name, class_, name, [])
+            if path is not None:
+                objects[object_id].files.append(CatalogFile(path, size, file_hash))
+        return list(objects.values())
+
+    def find_object_file(self, package_name: str, class_name: str, object_name: str, extension: str) -> Optional[str]:
+        # Returns the path (relative to the build directory) of the file the object was exported to.
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT f.path FROM objects o '
+                'JOIN packages p ON p.path = o.package '
+                'JOIN files f ON f.object_id = o.id '
+                'WHERE p.name = ? AND o.class = ? AND o.name = ? COLLATE NOCASE AND f.path LIKE ? '
+                'LIMIT 1',
+                (package_name.lower(), class_name, object_name, '%' + extension)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_package_size(self, package_path: str) -> int:
+        # Returns the total size of the files exported for the package.
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT SUM(f.size) FROM objects o JOIN files f ON f.object_id = o.id WHERE o.package = ?',
+                (package_path,)).fetchone()
+        return row[0] or 0
+
+    def get_input_hashes(self, package_path: str) -> Dict[Tuple[str, str], str]:
+        # Returns a hash of everything each object of the package was built from (its own exported files and those of
+        # the objects it references), keyed by `(class, name)`.
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT o.class, o.name, f.hash FROM objects o JOIN files f ON f.object_id = o.id WHERE o.package = ? '
+                'UNION ALL '
+                'SELECT o.class, o.name, f.hash FROM objects o '
+                'JOIN refs r ON r.object_id = o.id '
+                'JOIN packages p ON p.name = r.package_name '
+                'JOIN objects t ON t.package = p.path AND t.class = r.class AND t.name = r.name COLLATE NOCASE '
+                'JOIN files f ON f.object_id = t.id '
+                'WHERE o.package = ?',
+                (package_path, package_path)).fetchall()
+        hashes_by_object: Dict[Tuple[str, str], List[str]] = {}
+        for class_name, name, file_hash in rows:
+            hashes_by_object.setdefault((class_name, name), []).append(file_hash)
+        return {key: xxhash.xxh3_64_hexdigest(''.join(sorted(hashes)).encode()) for key, hashes in hashes_by_object.items()}
+
+    def get_output_fingerprint(self, package_path: str) -> str:
+        # Returns a hash of everything umodel exported for the package. Cube map images are left out, since they are
+        # rendered into the export directory by the build itself.
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT f.path, f.hash FROM objects o JOIN files f ON f.object_id = o.id '
+                'WHERE o.package = ? AND NOT (o.class = \'Cubemap\' AND f.path LIKE \'%.tga\') ORDER BY f.path',
+                (package_path,)).fetchall()
+        hasher = xxhash.xxh3_64()
+        for path, file_hash in rows:
+            hasher.update(f'{path}:{file_hash}\n'.encode())
+        return hasher.hexdigest()
+
+    def get_file_hashes(self) -> Set[str]:
+        # Returns the hashes of every exported file, which is what the content store keeps (see `dedup.py`).
+        with self._lock:
+            return set(x[0] for x in self._connection.execute('SELECT DISTINCT hash FROM files'))
+
+    def get_referenced_package_names(self, package_path: str) -> Set[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT DISTINCT r.package_name FROM refs r JOIN objects o ON o.id = r.object_id WHERE o.package = ?',
+                (package_path,)).fetchall()
+        return set(x[0] for x in rows)
+
+    def find_referencing_packages(self, package_name: Optional[str] = None, object_name: Optional[str] = None) -> List[Tuple[str, int]]:
+        # Returns the packages that reference the package (or an object in it), with their number of references.
+        query = 'SELECT o.package, COUNT(*) FROM refs r JOIN objects o ON o.id = r.object_id WHERE 1'
+        parameters = []
+        if package_name is not None:
+            query += ' AND r.package_name = ?'
+            parameters.append(package_name.lower())
+        if object_name is not None:
+            query += ' AND r.name = ? COLLATE NOCASE'
+            parameters.append(object_name)
+        query += ' GROUP BY o.package ORDER BY o.package'
+        with self._lock:
+            return self._connection.execute(query, parameters).fetchall()
@@ -0,0 +1,106 @@
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import tqdm
+
+from manifest import BuildManifest
+from resources import MB
+
+EXPORT = 'export'
+CUBEMAP = 'cubemap'
+BLEND = 'blend'
+
+# Packages that haven't been built before are estimated to take `overhead + rate * size (MB)` seconds. The rate is
+# fitted to the packages that have been measured, and these are used until there are any.
+DEFAULT_RATES = {EXPORT: 1.0, BLEND: 5.0}
+OVERHEADS = {EXPORT: 0.5, BLEND: 1.0}
+DEFAULT_CUBEMAP_COST = 5.0
+
+
+def record_duration(entry: Dict, stage: str, duration: float):
+    # Records how long a stage took in a manifest entry. It is committed along with the rest of the entry.
+    entry.setdefault('durations', {})[stage] = round(duration, 3)
+
+
+# Estimates how long each package takes to export and blend (and each cube map to build) from the durations that
+# were measured by earlier builds.
+class CostModel:
+
+    def __init__(self, manifest: BuildManifest):
+        self.manifest = manifest
+        self.root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+        self._rates = {stage: self._fit_rate(stage) for stage in (EXPORT, BLEND)}
+        cubemap_durations = [x['duration'] for x in manifest.cube_maps.values() if 'duration' in x]
+        self._cubemap_cost = sum(cubemap_durations) / len(cubemap_durations) if cubemap_durations else DEFAULT_CUBEMAP_COST
+
+    def _fit_rate(self, stage: str) -> float:
+        total_duration, total_size = 0.0, 0.0
+        for file in self.manifest.files.values():
+            duration = file.get('durations', {}).get(stage, None)
+            if duration is not None and file['size'] > 0:
+                total_duration += max(0.0, duration - OVERHEADS[stage])
+                total_size += file['size'] / MB
+        return total_duration / total_size if total_size > 0 else DEFAULT_RATES[stage]
+
+    def get_size(self, package_path: str) -> int:
+        file = self.manifest.files.get(package_path, None)
+        if file is not None and file['size'] > 0:
+            return file['size']
+        # The manifest only records the size of packages once they have been exported.
+        try:
+            return os.path.getsize(os.path.join(self.root_directory, package_path))
+        except OSError:
+            return 0
+
+    def estimate(self, stage: str, package_path: str) -> float:
+        # Returns the expected duration (in seconds) of the stage for the package (relative to the root directory).
+        file = self.manifest.files.get(package_path, None)
+        if file is not None:
+            duration = file.get('durations', {}).get(stage, None)
+            if duration is not None:
+                return duration
+        return OVERHEADS[stage] + self._rates[stage] * self.get_size(package_path) / MB
+
+    def estimate_cube_map(self, cubemap_file: str) -> float:
+        file = self.manifest.cube_maps.get(cubemap_file, None)
+        if file is not None and 'duration' in file:
+            return file['duration']
+        return self._cubemap_cost
+
+    def estimate_build(self, package_path: str) -> float:
+        return self.estimate(EXPORT, package_path) + self.estimate(BLEND, package_path)
+
+
+# A progress bar whose progress (and therefore ETA) is measured in expected seconds of work instead of jobs, so that a
+# few large packages left at the end don't make the estimate wildly optimistic. The job count is shown alongside.
+class CostProgressBar:
+
+    def __init__(self, desc: Optional[str] = None, position: Optional[int] = None):
+        self.count = 0
+        self.total_count = 0
+        self.bar = tqdm.tqdm(total=0, desc=desc, position=position, postfix=['0/0'],
+                             bar_format='{l_bar}{bar}| {postfix[0]} [{elapsed}<{remaining}]')
+
+    def _refresh(self):
+        self.bar.postfix[0] = f'{self.count}/{self.total_count}'
+        self.bar.refresh()
+
+    def add(self, cost: float, count: int = 1):
+        self.bar.total += cost
+        self.total_count += count
+        self._refresh()
+
+    def update(self, cost: float, count: int = 1):
+        self.count += count
+        self.bar.update(cost)
+        self._refresh()
+
+    def close(self):
+        self.bar.close()
+
+    def __enter__(self) -> 'CostProgressBar':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,163 @@
+import struct
+from functools import lru_cache
+from typing import List, Tuple, Optional
+
+import numpy as np
+
+# The faces are in the order they are listed in a Cubemap's `Faces` property, using the names from
+# `blender/cube2sphere.blend`. For each face, this gives the axis it faces, and the axes that point right and down
+# in its image (X is forward, Y is right and Z is up in the equirectangular output). These follow the UVs of the cube
+# in `cube2sphere.blend`, which rotate most faces.
+FACE_AXES = [
+    # front
+    ((1, 0, 0), (0, 0, -1), (0, -1, 0)),
+    # back
+    ((-1, 0, 0), (0, 0, 1), (0, -1, 0)),
+    # right
+    ((0, 1, 0), (1, 0, 0), (0, 0, 1)),
+    # left
+    ((0, -1, 0), (1, 0, 0), (0, 0, -1)),
+    # top
+    ((0, 0, 1), (1, 0, 0), (0, -1, 0)),
+    # bottom
+    ((0, 0, -1), (1, 0, 0), (0, 1, 0)),
+]
+
+TGA_TYPE_TRUE_COLOR = 2
+TGA_TYPE_GRAYSCALE = 3
+TGA_TYPE_RLE_TRUE_COLOR = 10
+TGA_TYPE_RLE_GRAYSCALE = 11
+
+
+def read_tga(path: str) -> np.ndarray:
+    # Returns the image as a (height, width, channels) array with the first row at the top. Color channels are kept in
+    # the order they are stored in (BGR or BGRA).
+    with open(path, 'rb') as f:
+        data = f.read()
+    id_length, color_map_type, image_type = struct.unpack_from('<BBB', data, 0)
+    color_map_length, color_map_entry_size = struct.unpack_from('<HB', data, 5)
+    width, height, bits_per_pixel, descriptor = struct.unpack_from('<HHBB', data, 12)
+
+    if color_map_type != 0 and image_type not in (TGA_TYPE_TRUE_COLOR, TGA_TYPE_RLE_TRUE_COLOR):
+        raise ValueError(f'Color-mapped TGA files are not supported ({path})')
+    if image_type not in (TGA_TYPE_TRUE_COLOR, TGA_TYPE_GRAYSCALE, TGA_TYPE_RLE_TRUE_COLOR, TGA_TYPE_RLE_GRAYSCALE):
+        raise ValueError(f'Unsupported TGA image type {image_type} ({path})')
+    if bits_per_pixel not in (8, 24, 32):
+        raise ValueError(f'Unsupported TGA pixel depth {bits_per_pixel} ({path})')
+
+    channels = bits_per_pixel // 8
+    offset = 18 + id_length + (color_map_length * ((color_map_entry_size + 7) // 8) if color_map_type else 0)
+    pixel_count = width * height
+
+    if image_type in (TGA_TYPE_RLE_TRUE_COLOR, TGA_TYPE_RLE_GRAYSCALE):
+        pixels = bytearray(pixel_count * channels)
+        i = 0
+        while i < len(pixels):
+            header = data[offset]
+            offset += 1
+            count = (header & 0x7F) + 1
+            if header & 0x80:
+                pixels[i:i + count * channels] = data[offset:offset + channels] * count
+                offset += channels
+            else:
+                pixels[i:i + count * channels] = data[offset:offset + count * channels]
+                offset += count * channels
+            i += count * channels
+        image = np.frombuffer(bytes(pixels), dtype=np.uint8)
+    else:
+        image = np.frombuffer(data, dtype=np.uint8, count=pixel_count * channels, offset=offset)
+
+    image = image.reshape((height, width, channels))
+
+    # Rows are stored bottom-to-top unless bit 5 of the descriptor is set, and right-to-left if bit 4 is set.
+    if not descriptor & 0x20:
+        image = image[::-1]
+    if descriptor & 0x10:
+        image = image[:, ::-1]
+
+    return image
+
+
+def write_tga(path: str, image: np.ndarray):
+    # Writes an uncompressed, top-to-bottom TGA file from a (height, width, channels) array in BGR(A) order.
+    height, width, channels = image.shape
+    image_type = TGA_TYPE_GRAYSCALE if channels == 1 else TGA_TYPE_TRUE_COLOR
+    alpha_bits = 8 if channels == 4 else 0
+    header = struct.pack('<BBBHHBHHHHBB', 0, 0, image_type, 0, 0, 0, 0, 0, width, height, channels * 8, 0x20 | alpha_bits)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+
+
+@lru_cache(maxsize=16)
+def get_projection_tables(face_size: int, width: int, height: int) -> Tuple[np.ndarray, ...]:
+    # For every pixel of the equirectangular output, returns the face it samples from and the indices and weights of
+    # the four face pixels that are blended together. These only depend on the sizes, so they are cached.
+    longitude = (np.arange(width, dtype=np.float64) + 0.5) / width * 2.0 * np.pi - np.pi
+    latitude = np.pi / 2.0 - (np.arange(height, dtype=np.float64) + 0.5) / height * np.pi
+    longitude, latitude = np.meshgrid(longitude, latitude)
+    directions = np.stack([
+        np.cos(latitude) * np.cos(longitude),
+        np.cos(latitude) * np.sin(longitude),
+        np.sin(latitude)
+    ], axis=-1)
+
+    axes = np.array(FACE_AXES, dtype=np.float64)  # (face, [normal, right, down], xyz)
+    face = np.argmax(directions @ axes[:, 0].T, axis=-1)
+    face_axes = axes[face]
+    depth = np.einsum('hwi,hwi->hw', directions, face_axes[..., 0, :])
+    u = np.einsum('hwi,hwi->hw', directions, face_axes[..., 1, :]) / depth
+    v = np.einsum('hwi,hwi->hw', directions, face_axes[..., 2, :]) / depth
+
+    # Convert from [-1, 1] to pixel coordinates, where pixel centers are at half-integers.
+    x = np.clip((u + 1.0) * 0.5 * face_size - 0.5, 0.0, face_size - 1)
+    y = np.clip((v + 1.0) * 0.5 * face_size - 0.5, 0.0, face_size - 1)
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    x1 = np.minimum(x0 + 1, face_size - 1)
+    y1 = np.minimum(y0 + 1, face_size - 1)
+    fx = (x - x0)[..., np.newaxis].astype(np.float32)
+    fy = (y - y0)[..., np.newaxis].astype(np.float32)
+
+    tables = (face, x0, x1, y0, y1, fx, fy)
+    for table in tables:
+        table.setflags(write=False)
+    return tables
+
+
+def _normalize_channels(faces: List[np.ndarray]) -> np.ndarray:
+    # Faces can be a mix of grayscale, BGR and BGRA images.
+    channels = max(x.shape[2] for x in faces)
+    normalized = []
+    for face in faces:
+        if face.shape[2] == 1 and channels > 1:
+            face = np.repeat(face, 3, axis=2)
+        if face.shape[2] == 3 and channels == 4:
+            face = np.concatenate([face, np.full(face.shape[:2] + (1,), 255, dtype=np.uint8)], axis=2)
+        normalized.append(face)
+    return np.stack(normalized).astype(np.float32)
+
+
+def cube_to_equirectangular(faces: List[np.ndarray], width: Optional[int] = None, height: Optional[int] = None) -> np.ndarray:
+    if len(faces) != len(FACE_AXES):
+        raise ValueError(f'Expected {len(FACE_AXES)} faces, got {len(faces)}')
+    face_size = faces[0].shape[0]
+    for face in faces:
+        if face.shape[0] != face_size or face.shape[1] != face_size:
+            raise ValueError('Cube map faces must be square and of the same size')
+    if width is None:
+        width = face_size * 4
+    if height is None:
+        height = width // 2
+
+    stack = _normalize_channels(faces)
+    face, x0, x1, y0, y1, fx, fy = get_projection_tables(face_size, width, height)
+    top = stack[face, y0, x0] * (1.0 - fx) + stack[face, y0, x1] * fx
+    bottom = stack[face, y1, x0] * (1.0 - fx) + stack[face, y1, x1] * fx
+    image = top * (1.0 - fy) + bottom * fy
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8)
+
+
+def convert_cube_map(face_paths: List[str], output_path: str):
+    faces = [read_tga(x) for x in face_paths]
+    write_tga(output_path, cube_to_equirectangular(faces))
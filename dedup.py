@@ -0,0 +1,159 @@
+import errno
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Optional, Iterable, Tuple, Set
+
+from resources import MB
+
+CONTENT_STORE_DIRECTORY_NAME = '.bdkstore'
+DEDUP_METHODS = ['hardlink', 'reflink']
+# Smaller files are left alone, since they take up a block (and an inode) either way.
+MIN_DEDUPLICATED_SIZE = 4096
+# The `FICLONE` ioctl of Linux, which makes a file share the blocks of another until either of them is written to.
+FICLONE = 0x40049409
+# Raised when the file system can't clone files (or the files are on different file systems).
+REFLINK_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS)
+
+
+def get_content_store_directory() -> str:
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    return os.path.join(build_directory, CONTENT_STORE_DIRECTORY_NAME)
+
+
+def reflink(source_path: str, destination_path: str):
+    import fcntl
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+
+def detach_files(directory: str):
+    # Removes the files in the directory that are hardlinked to the content store. umodel and the artifact cache
+    # overwrite existing files in place, which would change every copy of the file, so this is done before exporting
+    # a package into its directory again (whether or not the store is enabled, since it may have been before).
+    for path, _, filenames in os.walk(directory):
+        for filename in filenames:
+            file_path = os.path.join(path, filename)
+            try:
+                if os.lstat(file_path).st_nlink > 1:
+                    os.remove(file_path)
+            except OSError:
+                pass
+
+
+# A content-addressed store of exported files in the build directory, keyed by their hash in the catalog. Mods ship
+# copies of retail packages and share textures, so many packages export identical files: each of them is replaced by a
+# hardlink (or a reflink, where the file system supports it) to the single stored copy, which saves the disk space and
+# lets identical files share the page cache (hardlinks only, since reflinks are separate files).
+# Files are keyed by their (64-bit) hash, and only linked to stored files of the same size.
+class ContentStore:
+
+    def __init__(self, method: Optional[str] = None):
+        self.method = method
+        self.linked_count = 0
+        self.saved_size = 0
+        self._lock = threading.Lock()
+        self._is_reflink_supported = True
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.method is not None
+
+    @staticmethod
+    def _get_path(key: str) -> str:
+        return os.path.join(get_content_store_directory(), key[:2], key)
+
+    def _link(self, source_path: str, destination_path: str):
+        # Replaces the destination with a link to the source. The link is made under a temporary name and renamed
+        # into place, so that the destination is never missing.
+        temporary_path = os.path.join(os.path.dirname(destination_path), f'.{uuid.uuid4().hex}.tmp')
+        try:
+            if self.method == 'reflink' and self._is_reflink_supported:
+                try:
+                    reflink(source_path, temporary_path)
+                except OSError as e:
+                    if e.errno not in REFLINK_UNSUPPORTED_ERRORS:
+                        raise
+                    print(f'Reflinks are not supported in {get_content_store_directory()} ({e}), hardlinking instead')
+                    self._is_reflink_supported = False
+                    os.remove(temporary_path)
+            if not os.path.exists(temporary_path):
+                os.link(source_path, temporary_path)
+            os.replace(temporary_path, destination_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def add(self, path: str, key: str) -> bool:
+        # Makes the file share the stored copy of the same content, or stores it if there is none yet. Returns whether
+        # the file was deduplicated.
+        store_path = self._get_path(key)
+        stat = os.stat(path)
+        try:
+            store_stat = os.stat(store_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            self._link(path, store_path)
+            return False
+        if (store_stat.st_dev, store_stat.st_ino) == (stat.st_dev, stat.st_ino) or store_stat.st_size != stat.st_size:
+            return False
+        self._link(store_path, path)
+        with self._lock:
+            self.linked_count += 1
+            self.saved_size += stat.st_size
+        return True
+
+    def restore(self, key: str, path: str) -> bool:
+        # Links the stored file into place, and returns whether it was in the store.
+        store_path = self._get_path(key)
+        if not os.path.isfile(store_path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            self._link(store_path, path)
+        except FileNotFoundError:
+            # Removed by `trim` in the meantime.
+            return False
+        return True
+
+    def deduplicate(self, files: Iterable[Tuple[str, int, str]]) -> int:
+        # Adds the files (paths, sizes and hashes) to the store, and returns how many of them were deduplicated.
+        linked_count = 0
+        for path, size, file_hash in files:
+            if size < MIN_DEDUPLICATED_SIZE:
+                continue
+            try:
+                linked_count += self.add(path, file_hash)
+            except OSError as e:
+                print(f'Failed to deduplicate {path}: {e}')
+        return linked_count
+
+    def trim(self, file_hashes: Set[str]):
+        # Removes the stored files whose content no package exports anymore (files derived from them, e.g.,
+        # transcoded textures, are keyed by `<hash>.<suffix>`), and reports what the build deduplicated.
+        if not self.is_enabled:
+            return
+        removed_count = 0
+        stored_count = 0
+        for path, _, filenames in os.walk(get_content_store_directory()):
+            for filename in filenames:
+                if filename.split('.')[0] in file_hashes:
+                    stored_count += 1
+                    continue
+                try:
+                    os.remove(os.path.join(path, filename))
+                except OSError:
+                    continue
+                removed_count += 1
+        message = f'Content store: {self.linked_count} deduplicated ({self.saved_size / MB:.0f} MB saved)'
+        if removed_count > 0:
+            message += f' | {removed_count} removed'
+        print(f'{message} | {stored_count} stored')
+        self.linked_count = 0
+        self.saved_size = 0
+
+
+# Shared by every stage, and set from the command line. It is disabled until a method is set.
+content_store = ContentStore()
@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Dict
+
+import xxhash
+
+# Files are hashed in chunks so that large packages don't have to be read into memory at once.
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    hasher = xxhash.xxh3_64()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_files(paths: Iterable[str], max_workers: int = 8) -> Dict[str, str]:
+    # Hashes the files in parallel. xxhash releases the GIL while hashing, so threads are enough to keep cores busy.
+    paths = list(paths)
+    if len(paths) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(hash_file, paths)))
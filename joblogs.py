@@ -0,0 +1,135 @@
+import glob
+import gzip
+import os
+import sys
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Optional, List
+
+JOB_LOG_DIRECTORY_NAME = '.bdklogs'
+# Lines of output kept in memory for each job, which are printed if it fails.
+DEFAULT_TAIL_LINES = 20
+
+
+def get_job_log_directory() -> str:
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    return os.path.join(build_directory, JOB_LOG_DIRECTORY_NAME)
+
+
+def get_job_log_path(name: str, stage: str) -> str:
+    # Logs are stored by the path of what the job built (e.g., the package, relative to the root directory), so that
+    # each job replaces the log of the last one that built the same thing.
+    return os.path.join(get_job_log_directory(), f'{name}.{stage}.log.gz')
+
+
+# The output of a job (e.g., exporting a package), written to a compressed log file instead of the console, where the
+# output of parallel jobs would be interleaved (and printing it would hold the jobs up). The last lines are kept in
+# memory, so that only those are printed if the job fails.
+class JobLog:
+
+    def __init__(self, name: str, stage: str, package_name: Optional[str] = None, tail_lines: int = DEFAULT_TAIL_LINES,
+                 echo: bool = False):
+        self.name = name
+        self.stage = stage
+        # The package that the job built something of (see `bdk logs`).
+        self.package_name = package_name if package_name is not None else Path(name).stem
+        self.path = get_job_log_path(name, stage)
+        self.echo = echo
+        self.tail = deque(maxlen=tail_lines)
+        self._file = None
+        self._is_closed = False
+
+    def _open(self):
+        # The file is only opened once there is output, since a cube map session has a log open for each of its cube
+        # maps.
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = gzip.open(self.path, 'wt', compresslevel=1, encoding='utf-8', errors='replace')
+
+    def write(self, text: str):
+        if self._is_closed:
+            return
+        if self._file is None:
+            self._open()
+        self._file.write(text)
+        self.tail.extend(text.splitlines())
+        if self.echo:
+            sys.stdout.write(text)
+
+    def close(self):
+        if self._is_closed:
+            return
+        self._is_closed = True
+        # A job without output still replaces the log of the last one.
+        if self._file is None:
+            self._open()
+        self._file.close()
+        self._file = None
+
+    def __enter__(self) -> 'JobLog':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Creates the logs of the jobs, and collects those of the jobs that failed until the end of the stage, when their
+# tails are printed together.
+class JobLogs:
+
+    def __init__(self, tail_lines: int = DEFAULT_TAIL_LINES, echo: bool = False):
+        self.tail_lines = tail_lines
+        # Whether the output of the jobs is printed to the console as well (e.g., with `--verbose`).
+        self.echo = echo
+        self._lock = threading.Lock()
+        self._failed_logs: List[JobLog] = []
+
+    def open(self, name: str, stage: str, package_name: Optional[str] = None) -> JobLog:
+        return JobLog(name, stage, package_name, self.tail_lines, self.echo)
+
+    def add_failure(self, log: JobLog):
+        with self._lock:
+            self._failed_logs.append(log)
+
+    def print_failures(self):
+        with self._lock:
+            failed_logs = self._failed_logs
+            self._failed_logs = []
+        if len(failed_logs) == 0:
+            return
+        print(f'{len(failed_logs)} job(s) failed:')
+        for log in failed_logs:
+            print(f'--- {log.stage} of {log.name} (see `bdk logs {log.package_name}` for the full log) ---')
+            if len(log.tail) == 0:
+                print('(no output)')
+            for line in log.tail:
+                print(line)
+
+
+# Shared by every stage.
+job_logs = JobLogs()
+
+
+def find_job_logs(package_path: str, stage: Optional[str] = None) -> List[str]:
+    # Returns the logs of the jobs that built the package (given relative to the root directory), including those of
+    # the cube maps that were exported from it.
+    stage_pattern = glob.escape(stage) if stage is not None else '*'
+    base_path = os.path.join(get_job_log_directory(), glob.escape(package_path))
+    paths = glob.glob(f'{base_path}.{stage_pattern}.log.gz')
+    paths += glob.glob(os.path.join(os.path.splitext(base_path)[0], '**', f'*.{stage_pattern}.log.gz'), recursive=True)
+    return sorted(paths, key=os.path.getmtime)
+
+
+def print_job_log(path: str, tail_lines: Optional[int] = None):
+    print(f'--- {os.path.relpath(path, get_job_log_directory())} ---')
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+            if tail_lines is None:
+                for line in f:
+                    sys.stdout.write(line)
+            else:
+                for line in deque(f, maxlen=tail_lines):
+                    sys.stdout.write(line)
+    except (OSError, EOFError) as e:
+        # The log of a job that is still running (or was killed) may not have been written completely.
+        print(f'Failed to read {path}: {e}')
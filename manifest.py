@@ -0,0 +1,281 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, Dict
+
+from tracing import tracer
+
+MANIFEST_FILENAME = '.bdkmanifest'
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# Packages that failed this many runs in a row are quarantined: they are skipped until they change or are released.
+QUARANTINE_FAILURE_COUNT = 3
+
+# Manifests are shared by every build stage in the process, keyed by their path.
+_manifests: Dict[str, 'BuildManifest'] = {}
+_manifests_lock = threading.Lock()
+
+# Sharded builds use a fragment of the manifest instead of the manifest itself (see `sharding.py`).
+_fragment_name: Optional[str] = None
+
+
+def set_manifest_fragment(fragment_name: Optional[str]):
+    global _fragment_name
+    _fragment_name = fragment_name
+
+
+def get_manifest_path() -> str:
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    filename = MANIFEST_FILENAME if _fragment_name is None else f'{MANIFEST_FILENAME}.{_fragment_name}'
+    return str(Path(os.path.join(build_directory, filename)).resolve())
+
+
+# The build manifest is kept in memory as a dictionary and backed by an SQLite database. Individual entries are
+# committed as soon as the job that changed them finishes, so an interrupted build keeps the work it completed.
+class BuildManifest(dict):
+
+    class File(dict):
+        def __init__(self):
+            dict.__init__(self, last_modified_time=0.0, size=0, hash=None, is_built=False)
+
+        @property
+        def last_modified_time(self) -> float:
+            return self['last_modified_time']
+
+        @property
+        def size(self) -> int:
+            return self['size']
+
+        @property
+        def is_built(self) -> bool:
+            return self['is_built']
+
+        @is_built.setter
+        def is_built(self, value: bool):
+            self['is_built'] = value
+
+        @property
+        def hash(self) -> Optional[str]:
+            return self['hash']
+
+        @hash.setter
+        def hash(self, value: Optional[str]):
+            self['hash'] = value
+
+        @last_modified_time.setter
+        def last_modified_time(self, value: float):
+            self['last_modified_time'] = value
+
+        @size.setter
+        def size(self, value: int):
+            self['size'] = value
+
+    def __init__(self, files: Optional[Dict] = None, cube_maps: Optional[Dict] = None, quarantine: Optional[Dict] = None,
+                 path: Optional[str] = None):
+        dict.__init__(self, files=files if files is not None else {}, cube_maps=cube_maps if cube_maps is not None else {},
+                      quarantine=quarantine if quarantine is not None else {})
+        self._lock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._connection = BuildManifest._connect(path)
+
+    @property
+    def files(self) -> Dict[str, File]:
+        return self['files']
+
+    @property
+    def cube_maps(self) -> Dict[str, File]:
+        return self['cube_maps']
+
+    @property
+    def quarantine(self) -> Dict[str, Dict]:
+        # The consecutive failures of each package, keyed like `files`. Each entry records the hash of the package that
+        # failed, so that a package is released as soon as it changes.
+        return self['quarantine']
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                section TEXT NOT NULL,
+                path TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (section, path)
+            ) WITHOUT ROWID
+        ''')
+        return connection
+
+    def _write(self, rows):
+        if self._connection is None:
+            return
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._connection.executemany('INSERT OR REPLACE INTO entries (section, path, data) VALUES (?, ?, ?)', rows)
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def _delete(self, section: str, file: str):
+        if self._connection is None:
+            return
+        with self._lock:
+            self._connection.execute('DELETE FROM entries WHERE section = ? AND path = ?', (section, file))
+
+    def commit_file(self, file: str):
+        if file in self.files:
+            self._write([('files', file, json.dumps(self.files[file]))])
+
+    def commit_cube_map(self, file: str):
+        if file in self.cube_maps:
+            self._write([('cube_maps', file, json.dumps(self.cube_maps[file]))])
+
+    def remove_file(self, file: str):
+        self.files.pop(file, None)
+        self._delete('files', file)
+
+    def remove_cube_map(self, file: str):
+        self.cube_maps.pop(file, None)
+        self._delete('cube_maps', file)
+
+    def mark_file_as_built(self, file: str):
+        if file in self.files:
+            self.files[file]['is_built'] = True
+            self.commit_file(file)
+
+    def mark_cubemap_as_built(self, file: str):
+        if file in self.cube_maps:
+            self.cube_maps[file]['is_built'] = True
+            self.commit_cube_map(file)
+
+    def record_failure(self, file: str, file_hash: Optional[str], stage: str) -> bool:
+        # Returns True if the package was quarantined by this failure.
+        entry = self.quarantine.get(file, None)
+        if entry is None or entry['hash'] != file_hash:
+            entry = {'hash': file_hash, 'failure_count': 0}
+            self.quarantine[file] = entry
+        entry['failure_count'] += 1
+        entry['stage'] = stage
+        self._write([('quarantine', file, json.dumps(entry))])
+        return entry['failure_count'] == QUARANTINE_FAILURE_COUNT
+
+    def clear_failures(self, file: str, stage: Optional[str] = None):
+        # Clears the failures of the package, or only those of a stage (e.g., an export that succeeded doesn't mean
+        # the package stopped failing to blend).
+        entry = self.quarantine.get(file, None)
+        if entry is not None and (stage is None or entry['stage'] == stage):
+            self.quarantine.pop(file)
+            self._delete('quarantine', file)
+
+    def is_quarantined(self, file: str, file_hash: Optional[str] = None) -> bool:
+        # If a hash is given, packages that changed since they were quarantined are not.
+        entry = self.quarantine.get(file, None)
+        if entry is None or entry['failure_count'] < QUARANTINE_FAILURE_COUNT:
+            return False
+        return file_hash is None or entry['hash'] == file_hash
+
+    def replace(self, files: Dict, cube_maps: Dict, quarantine: Dict):
+        # Replaces every entry in a single transaction.
+        with self._lock:
+            self.files.clear()
+            self.files.update(files)
+            self.cube_maps.clear()
+            self.cube_maps.update(cube_maps)
+            self.quarantine.clear()
+            self.quarantine.update(quarantine)
+            if self._connection is not None:
+                self._connection.execute('BEGIN')
+                try:
+                    self._connection.execute('DELETE FROM entries')
+                    self._connection.executemany('INSERT INTO entries (section, path, data) VALUES (?, ?, ?)', self._rows())
+                    self._connection.execute('COMMIT')
+                except BaseException:
+                    self._connection.execute('ROLLBACK')
+                    raise
+
+    def backup(self, connection: sqlite3.Connection):
+        # Copies the database to another one (e.g., to start a manifest fragment).
+        with self._lock:
+            self._connection.backup(connection)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def clear(self):
+        self.files.clear()
+        self.cube_maps.clear()
+        self.quarantine.clear()
+        if self._connection is not None:
+            with self._lock:
+                self._connection.execute('DELETE FROM entries')
+
+    @staticmethod
+    def _read_legacy(path: str) -> Optional[Dict]:
+        # Manifests used to be written as a single JSON document.
+        with open(path, 'rb') as file:
+            if file.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+                return None
+        with open(path, 'r') as file:
+            try:
+                return json.load(file)
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                print(e)
+                return {}
+
+    @staticmethod
+    def load(path: Optional[str] = None) -> 'BuildManifest':
+        if path is None:
+            path = get_manifest_path()
+
+        with _manifests_lock:
+            if path in _manifests:
+                return _manifests[path]
+
+            legacy_data = None
+            if os.path.isfile(path):
+                legacy_data = BuildManifest._read_legacy(path)
+                if legacy_data is not None:
+                    # Keep the old manifest around and convert it.
+                    os.replace(path, path + '.json.bak')
+                    print('Build manifest converted from JSON')
+                else:
+                    print('Build manifest loaded')
+            else:
+                print('Build manifest file not found')
+
+            with tracer.span('manifest_load'):
+                manifest = BuildManifest(path=path)
+
+                if legacy_data is not None:
+                    manifest.files.update(legacy_data.get('files', {}))
+                    manifest.cube_maps.update(legacy_data.get('cube_maps', {}))
+                    manifest.save()
+                else:
+                    manifest.read_entries()
+
+            _manifests[path] = manifest
+            return manifest
+
+    def read_entries(self):
+        for section, file, data in self._connection.execute('SELECT section, path, data FROM entries'):
+            self[section][file] = json.loads(data)
+
+    def _rows(self):
+        rows = [('files', file, json.dumps(data)) for file, data in self.files.items()]
+        rows += [('cube_maps', file, json.dumps(data)) for file, data in self.cube_maps.items()]
+        rows += [('quarantine', file, json.dumps(data)) for file, data in self.quarantine.items()]
+        return rows
+
+    def save(self):
+        # Writes every entry in a single transaction.
+        with tracer.span('manifest_save'):
+            self._write(self._rows())
@@ -0,0 +1,198 @@
+import mmap
+import os
+import struct
+from typing import NamedTuple, List, Optional, Set
+
+# Reads the tables at the start of Unreal Engine 2 packages (names, imports and exports), which tell what a package
+# contains and references without exporting it. Object data is never read: the package is memory-mapped, so only the
+# pages holding the tables are loaded.
+
+PACKAGE_TAG = 0x9E2A83C1
+# Packages before this version store names as null-terminated strings instead of length-prefixed ones.
+NAME_LENGTH_VERSION = 64
+
+HEADER = struct.Struct('<IHHIiiiiii')
+INT32 = struct.Struct('<i')
+UINT32 = struct.Struct('<I')
+
+
+class PackageError(ValueError):
+    pass
+
+
+class PackageImport(NamedTuple):
+    class_package: str
+    class_name: str
+    # The object that contains this one (see `Package.get_object`), or 0 for top-level packages.
+    outer: int
+    name: str
+
+
+class PackageExport(NamedTuple):
+    # The class of the object (see `Package.get_object`), or 0 for classes.
+    class_index: int
+    super_index: int
+    outer: int
+    name: str
+    flags: int
+    serial_size: int
+    serial_offset: int
+
+
+def _read_compact_index(data, offset: int):
+    # Compact indices store a sign bit and 6 bits in the first byte, followed by 7 bits per byte while the
+    # continuation bit is set.
+    first = data[offset]
+    offset += 1
+    if first < 0x40:
+        return first, offset
+    value = first & 0x3F
+    if first & 0x40:
+        shift = 6
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+    return (-value if first & 0x80 else value), offset
+
+
+class Package:
+
+    def __init__(self, version: int, licensee_version: int, flags: int, names: List[str],
+                 imports: List[PackageImport], exports: List[PackageExport]):
+        self.version = version
+        self.licensee_version = licensee_version
+        self.flags = flags
+        self.names = names
+        self.imports = imports
+        self.exports = exports
+
+    def get_object(self, index: int):
+        # Object references are 0 for none, -1 - i for the ith import and 1 + i for the ith export.
+        if index < 0:
+            return self.imports[-index - 1]
+        if index > 0:
+            return self.exports[index - 1]
+        return None
+
+    def get_object_path(self, index: int) -> str:
+        # Returns the full name of the object, e.g., `Package.Group.Name`.
+        parts = []
+        while index != 0:
+            obj = self.get_object(index)
+            parts.append(obj.name)
+            index = obj.outer
+        return '.'.join(reversed(parts))
+
+    def get_outermost_name(self, index: int) -> str:
+        try:
+            obj = self.get_object(index)
+            # Outers can't be nested deeper than there are objects, unless the package is corrupt.
+            for _ in range(len(self.imports) + len(self.exports)):
+                if obj.outer == 0:
+                    return obj.name
+                obj = self.get_object(obj.outer)
+        except IndexError:
+            pass
+        raise PackageError(f'invalid outer of object {index}')
+
+    def get_export_class_name(self, export: PackageExport) -> str:
+        return self.get_object(export.class_index).name if export.class_index != 0 else 'Class'
+
+    def get_referenced_package_names(self) -> Set[str]:
+        # Returns the (lower-case) names of the packages that assets are imported from. Classes (e.g., from `Engine`)
+        # are left out, since they don't make a package depend on the assets of another one.
+        package_names = set()
+        for i, package_import in enumerate(self.imports):
+            if package_import.class_name in ('Package', 'Class'):
+                continue
+            package_names.add(self.get_outermost_name(-i - 1).lower())
+        return package_names
+
+
+def _read_name(data, offset: int, version: int):
+    if version < NAME_LENGTH_VERSION:
+        end = data.find(b'\0', offset)
+        if end < 0:
+            raise PackageError('unterminated name')
+        return data[offset:end].decode('latin-1'), end + 1
+    length, offset = _read_compact_index(data, offset)
+    if length < 0:
+        end = offset - length * 2
+        return data[offset:end].decode('utf-16-le').rstrip('\0'), end
+    end = offset + length
+    return data[offset:end].decode('latin-1').rstrip('\0'), end
+
+
+def parse_package(data, read_exports: bool = True) -> Package:
+    # Parses the tables of a package from a buffer that holds (at least) the start of it.
+    try:
+        tag, version, licensee_version, flags, name_count, name_offset, export_count, export_offset, import_count, \
+            import_offset = HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise PackageError('truncated header')
+    if tag != PACKAGE_TAG:
+        raise PackageError('not an Unreal package')
+
+    try:
+        names = []
+        offset = name_offset
+        for _ in range(name_count):
+            length = data[offset]
+            if length < 0x40 and version >= NAME_LENGTH_VERSION:
+                # Most names are short enough for their length to fit in a single byte.
+                offset += 1 + length
+                names.append(data[offset - length:offset].decode('latin-1').rstrip('\0'))
+            else:
+                name, offset = _read_name(data, offset, version)
+                names.append(name)
+            offset += 4  # Flags.
+
+        imports = []
+        offset = import_offset
+        for _ in range(import_count):
+            class_package, offset = _read_compact_index(data, offset)
+            class_name, offset = _read_compact_index(data, offset)
+            outer = INT32.unpack_from(data, offset)[0]
+            object_name, offset = _read_compact_index(data, offset + 4)
+            imports.append(PackageImport(names[class_package], names[class_name], outer, names[object_name]))
+
+        exports = []
+        if read_exports:
+            offset = export_offset
+            for _ in range(export_count):
+                class_index, offset = _read_compact_index(data, offset)
+                super_index, offset = _read_compact_index(data, offset)
+                outer = INT32.unpack_from(data, offset)[0]
+                object_name, offset = _read_compact_index(data, offset + 4)
+                object_flags = UINT32.unpack_from(data, offset)[0]
+                serial_size, offset = _read_compact_index(data, offset + 4)
+                serial_offset = 0
+                if serial_size > 0:
+                    serial_offset, offset = _read_compact_index(data, offset)
+                exports.append(PackageExport(class_index, super_index, outer, names[object_name], object_flags,
+                                             serial_size, serial_offset))
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise PackageError('truncated or corrupt tables')
+
+    return Package(version, licensee_version, flags, names, imports, exports)
+
+
+def read_package(path: str, read_exports: bool = True) -> Package:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise PackageError('empty file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse_package(data, read_exports)
+
+
+def read_referenced_package_names(path: str) -> Optional[Set[str]]:
+    # Returns the names of the packages that the package imports assets from, or None if it can't be read (e.g., it
+    # isn't an Unreal package).
+    try:
+        return read_package(path, read_exports=False).get_referenced_package_names()
+    except (OSError, PackageError):
+        return None
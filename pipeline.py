@@ -0,0 +1,326 @@
+import heapq
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from pathlib import Path
+from typing import Optional, Dict, Set, List, Union, Collection
+
+from artifacts import artifact_cache
+from build import BuildManifest, ExportResult, find_packages_to_export, export_package_to_build_directory, \
+    complete_export, find_cube_maps, find_cube_maps_to_build, build_cube_map_group, complete_cube_map, \
+    find_packages_to_blend, filter_packages_to_blend, get_package_priority, blend_package, complete_blend, \
+    get_export_job_count, get_cube_map_job_count, get_blend_job_count, select_shard, trim_content_store
+from catalog import Catalog
+from costs import CostModel, CostProgressBar, EXPORT, CUBEMAP, BLEND
+from joblogs import job_logs
+from processes import process_engine
+from scheduler import get_package_paths_by_name, get_package_dependencies, find_cycles, break_cycles, \
+    get_critical_path_costs
+from sharding import Shard
+from workers import BlenderWorkerPool
+
+
+# Builds packages as a stream instead of running each stage to completion before starting the next one.
+# A package moves on as soon as its export finishes: its cube maps are queued right away, and it is blended once its
+# cube maps and every package it references (that is also being built) have been built.
+class BuildPipeline:
+
+    def __init__(self,
+                 manifest: BuildManifest,
+                 clean: bool = False,
+                 name_filter: Optional[str] = None,
+                 no_cubemaps: bool = False,
+                 cubemap_engine: str = 'blender',
+                 export_jobs: int = 8,
+                 cubemap_jobs: int = 4,
+                 blend_jobs: int = 1,
+                 worker_max_jobs: int = 100,
+                 worker_max_memory: Optional[int] = None,
+                 queue_size: int = 64,
+                 defer_previews: bool = False,
+                 package_paths: Optional[Collection[str]] = None):
+        self.manifest = manifest
+        self.clean = clean
+        self.name_filter = name_filter
+        self.no_cubemaps = no_cubemaps
+        self.cubemap_engine = cubemap_engine
+        self.export_jobs = export_jobs
+        self.cubemap_jobs = cubemap_jobs
+        self.blend_jobs = blend_jobs
+        self.worker_max_jobs = worker_max_jobs
+        self.worker_max_memory = worker_max_memory
+        # The maximum number of packages that have been exported but not yet blended. Exporting is paused while the
+        # blend stage is this far behind, unless the blend stage would otherwise sit idle.
+        self.queue_size = queue_size
+        self.defer_previews = defer_previews
+        # If set, only these packages are blended and have their cube maps built (e.g., the share of a shard).
+        self.package_paths = set(package_paths) if package_paths is not None else None
+        self.root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+        self.build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+        self.catalog = Catalog.load()
+        self.cost_model = CostModel(manifest)
+        self.critical_path_costs: Dict[str, float] = {}
+        # The expected cost of each job, which is what the progress bars count.
+        self.export_costs: Dict[str, float] = {}
+        self.cubemap_costs: Dict[str, float] = {}
+        self.blend_costs: Dict[str, float] = {}
+
+        self.export_queue = deque()
+        self.pending_updates: Dict[str, Dict] = {}
+        self.cubemap_queue = deque()
+        self.blend_ready = []
+        # Packages that will be blended, and the reasons they can't be yet.
+        self.unblended: Set[str] = set()
+        self.awaiting_export: Set[str] = set()
+        self.outstanding_cube_maps: Dict[str, int] = {}
+        self.queued_for_blend: Set[str] = set()
+        self.dependencies: Dict[str, Set[str]] = {}
+        self.package_paths_by_name: Dict[str, List[str]] = {}
+        self.package_paths_by_directory: Dict[str, str] = {}
+        self.running: Dict[Future, tuple] = {}
+        self.running_counts = {EXPORT: 0, CUBEMAP: 0, BLEND: 0}
+        self.success_count = 0
+        self.failure_count = 0
+
+    def _relative_path(self, package_path: str) -> str:
+        return os.path.relpath(package_path, self.root_directory)
+
+    def _package_for_cube_map(self, cubemap_file: str) -> Optional[str]:
+        # Cube maps are exported to `<package>/Cubemap/<name>.props.txt`.
+        package_directory = str(Path(cubemap_file).parent.parent)
+        return self.package_paths_by_directory.get(package_directory, None)
+
+    def _queue_cube_maps(self, cubemap_files: List[str]):
+        cubemap_files = find_cube_maps_to_build(self.manifest, cubemap_files, self.build_directory, self.clean, self.name_filter)
+        groups: Dict[Optional[str], List[str]] = {}
+        for cubemap_file in cubemap_files:
+            self.manifest.commit_cube_map(cubemap_file)
+            groups.setdefault(self._package_for_cube_map(cubemap_file), []).append(cubemap_file)
+        for package_path, group in groups.items():
+            if package_path in self.unblended:
+                self.outstanding_cube_maps[package_path] = self.outstanding_cube_maps.get(package_path, 0) + len(group)
+            self.cubemap_queue.append((package_path, group))
+            for cubemap_file in group:
+                self.cubemap_costs[cubemap_file] = self.cost_model.estimate_cube_map(cubemap_file)
+                self.cubemap_bar.add(self.cubemap_costs[cubemap_file])
+
+    def _resolve_dependencies(self, package_path: str):
+        self.dependencies[package_path] = get_package_dependencies(package_path, self.package_paths_by_name, self.build_directory, self.catalog)
+
+    def _is_ready(self, package_path: str) -> bool:
+        return package_path not in self.awaiting_export and \
+            self.outstanding_cube_maps.get(package_path, 0) == 0 and \
+            package_path in self.dependencies and \
+            len(self.dependencies[package_path] & self.unblended) == 0
+
+    def _update_ready(self, package_paths):
+        for package_path in package_paths:
+            if package_path in self.unblended and package_path not in self.queued_for_blend and self._is_ready(package_path):
+                self.queued_for_blend.add(package_path)
+                heapq.heappush(self.blend_ready, (self._get_blend_priority(package_path), package_path))
+
+    def _get_blend_priority(self, package_path: str):
+        # Packages that hold up the longest expected chain of work are blended first.
+        critical_path_cost = self.critical_path_costs.get(package_path, self.cost_model.estimate(BLEND, package_path))
+        return -critical_path_cost, get_package_priority(package_path)
+
+    def _get_export_priority(self, package_path: str):
+        relative_path = self._relative_path(package_path)
+        critical_path_cost = self.critical_path_costs.get(relative_path, 0.0)
+        return -(self.cost_model.estimate(EXPORT, relative_path) + critical_path_cost), get_package_priority(relative_path)
+
+    def _update_blend_bar(self, package_path: str):
+        self.blend_bar.update(self.blend_costs[package_path])
+
+    def _finish_blend(self, package_path: str):
+        self.unblended.discard(package_path)
+        # Only the packages that reference this one can have become ready.
+        self._update_ready([x for x in self.unblended if package_path in self.dependencies.get(x, ())])
+
+    def _break_cycles(self):
+        # Everything has stalled, so the remaining packages must be waiting on each other.
+        graph = {x: self.dependencies.get(x, set()) & self.unblended for x in self.unblended}
+        cycles = find_cycles(graph)
+        for cycle in cycles:
+            print(f'Dependency cycle detected, these packages will be built in no particular order: {", ".join(cycle)}')
+        for package_path, dependencies in break_cycles(graph, cycles).items():
+            self.dependencies[package_path] = dependencies
+        self._update_ready(list(self.unblended))
+        if not self.blend_ready:
+            # Should not happen, but never hang.
+            for package_path in list(self.unblended):
+                self.dependencies[package_path] = set()
+                self.outstanding_cube_maps[package_path] = 0
+            self._update_ready(list(self.unblended))
+
+    def _submit(self, stage: str, key, future: Future):
+        self.running[future] = (stage, key)
+        self.running_counts[stage] += 1
+
+    def _on_export(self, package_path: str, result: ExportResult):
+        relative_path = self._relative_path(package_path)
+        self.awaiting_export.discard(relative_path)
+        self.export_bar.update(self.export_costs[package_path])
+        if not complete_export(self.manifest, package_path, self.pending_updates[package_path], result):
+            if relative_path in self.unblended:
+                self.failure_count += 1
+                self._update_blend_bar(relative_path)
+                self._finish_blend(relative_path)
+            return
+        if not self.no_cubemaps:
+            self._queue_cube_maps(find_cube_maps(self.catalog, relative_path))
+        if relative_path in self.unblended and self.manifest.files[relative_path]['is_built'] and not self.clean:
+            # The package exported the same files as before, so its library is up-to-date.
+            self._update_blend_bar(relative_path)
+            self._finish_blend(relative_path)
+            return
+        if relative_path in self.unblended:
+            self._resolve_dependencies(relative_path)
+            self._update_ready([relative_path])
+
+    def _on_cube_maps(self, package_path: Optional[str], results):
+        for cubemap_file, success, duration in results:
+            complete_cube_map(self.manifest, cubemap_file, success, duration)
+            self.cubemap_bar.update(self.cubemap_costs[cubemap_file])
+        if package_path in self.outstanding_cube_maps:
+            self.outstanding_cube_maps[package_path] -= len(results)
+            self._update_ready([package_path])
+
+    def _on_blend(self, package_path: str, result: Optional[bool]):
+        self._update_blend_bar(package_path)
+        if result is not None:
+            complete_blend(self.manifest, package_path, result)
+            if result:
+                self.success_count += 1
+            else:
+                self.failure_count += 1
+        self._finish_blend(package_path)
+
+    def run(self, packages_to_export: List[str], pending_updates: Dict[str, Dict]):
+        self.pending_updates = pending_updates
+        exported_package_paths = [self._relative_path(x) for x in packages_to_export]
+
+        # Packages that were exported by an earlier run but not blended yet are blended as well.
+        blend_package_paths = set(find_packages_to_blend(self.manifest, self.clean, self.name_filter))
+        blend_package_paths.update(filter_packages_to_blend(exported_package_paths, self.name_filter))
+        if self.package_paths is not None:
+            blend_package_paths &= self.package_paths
+        self.unblended = set(blend_package_paths)
+        self.awaiting_export = set(exported_package_paths) & self.unblended
+        self.package_paths_by_name = get_package_paths_by_name(blend_package_paths)
+        self.package_paths_by_directory = {str(Path(x).with_suffix('')): x for x in self.manifest.files}
+        self.catalog.ensure_indexed(set(self.manifest.files) - set(exported_package_paths))
+
+        # The dependencies of packages that are exported again are taken from their previous export and the imports in
+        # their headers, which is good enough to prioritize them.
+        graph = {
+            x: get_package_dependencies(x, self.package_paths_by_name, self.build_directory, self.catalog, self.root_directory)
+            for x in self.unblended
+        }
+        graph = break_cycles(graph, find_cycles(graph))
+        self.critical_path_costs = get_critical_path_costs(graph, lambda x: self.cost_model.estimate(BLEND, x))
+        self.export_queue = deque(sorted(packages_to_export, key=self._get_export_priority))
+
+        self.export_bar = CostProgressBar(desc='export', position=0)
+        for package_path in packages_to_export:
+            self.export_costs[package_path] = self.cost_model.estimate(EXPORT, self._relative_path(package_path))
+            self.export_bar.add(self.export_costs[package_path])
+        self.cubemap_bar = CostProgressBar(desc='cubemap', position=1)
+        self.blend_bar = CostProgressBar(desc='blend', position=2)
+        for package_path in self.unblended:
+            self.blend_costs[package_path] = self.cost_model.estimate(BLEND, package_path)
+            self.blend_bar.add(self.blend_costs[package_path])
+
+        # Cube maps of packages that aren't being exported again can be built straight away.
+        if not self.no_cubemaps:
+            exported_directories = set(str(Path(x).with_suffix('')) for x in exported_package_paths)
+            cubemap_files = find_cube_maps(self.catalog) if self.package_paths is None else \
+                [x for package_path in sorted(self.package_paths) for x in find_cube_maps(self.catalog, package_path)]
+            self._queue_cube_maps([x for x in cubemap_files if str(Path(x).parent.parent) not in exported_directories])
+
+        for package_path in self.unblended - self.awaiting_export:
+            self._resolve_dependencies(package_path)
+        self._update_ready(list(self.unblended))
+
+        pool = BlenderWorkerPool(self.blend_jobs, max_jobs=self.worker_max_jobs, max_memory=self.worker_max_memory)
+        try:
+            # Exports and cube maps run on the process engine, and blends in threads that hand their jobs to workers.
+            with ThreadPoolExecutor(max_workers=self.blend_jobs) as executor:
+                while True:
+                    is_blend_idle = self.running_counts[BLEND] == 0 and not self.blend_ready
+                    backlog = len(self.unblended - self.awaiting_export)
+                    while self.export_queue and self.running_counts[EXPORT] < self.export_jobs and \
+                            (backlog < self.queue_size or is_blend_idle):
+                        package_path = self.export_queue.popleft()
+                        self._submit(EXPORT, package_path, process_engine.submit(
+                            export_package_to_build_directory(package_path, self.pending_updates[package_path])))
+                    while self.cubemap_queue and self.running_counts[CUBEMAP] < self.cubemap_jobs:
+                        package_path, group = self.cubemap_queue.popleft()
+                        self._submit(CUBEMAP, (package_path, group), process_engine.submit(
+                            build_cube_map_group(group, self.build_directory, self.cubemap_engine)))
+                    while self.blend_ready and self.running_counts[BLEND] < self.blend_jobs:
+                        _, package_path = heapq.heappop(self.blend_ready)
+                        self._submit(BLEND, package_path,
+                                     executor.submit(blend_package, pool, package_path, self.defer_previews))
+
+                    if not self.running:
+                        if self.unblended:
+                            self._break_cycles()
+                            continue
+                        break
+
+                    done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage, key = self.running.pop(future)
+                        self.running_counts[stage] -= 1
+                        if stage == EXPORT:
+                            self._on_export(key, future.result())
+                        elif stage == CUBEMAP:
+                            self._on_cube_maps(key[0], future.result())
+                        else:
+                            self._on_blend(key, future.result())
+        finally:
+            pool.close()
+            for bar in (self.export_bar, self.cubemap_bar, self.blend_bar):
+                bar.close()
+
+        job_logs.print_failures()
+        print(f'{self.success_count} Succeeded | {self.failure_count} Failed')
+        artifact_cache.trim()
+        trim_content_store()
+
+
+def build_assets_pipelined(
+        mod: Optional[str] = None,
+        clean: bool = False,
+        no_export: bool = False,
+        no_cubemaps: bool = False,
+        name_filter: Optional[str] = None,
+        cubemap_engine: str = 'blender',
+        export_jobs: Union[int, str] = 'auto',
+        cubemap_jobs: Union[int, str] = 'auto',
+        blend_jobs: Union[int, str] = 'auto',
+        worker_max_jobs: int = 100,
+        worker_max_memory: Optional[int] = None,
+        queue_size: int = 64,
+        defer_previews: bool = False,
+        shard: Optional[Shard] = None):
+    manifest = BuildManifest.load()
+
+    packages_to_export, pending_updates = [], {}
+    if not no_export:
+        packages_to_export, pending_updates = find_packages_to_export(manifest, mod, clean=clean)
+
+    package_paths = None
+    if shard is not None:
+        package_paths = select_shard(manifest, shard, packages_to_export, clean, name_filter)
+        root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+        packages_to_export = [x for x in packages_to_export if os.path.relpath(x, root_directory) in package_paths]
+
+    pipeline = BuildPipeline(manifest, clean=clean, name_filter=name_filter, no_cubemaps=no_cubemaps,
+                             cubemap_engine=cubemap_engine, export_jobs=get_export_job_count(export_jobs),
+                             cubemap_jobs=get_cube_map_job_count(cubemap_jobs, cubemap_engine),
+                             blend_jobs=get_blend_job_count(blend_jobs), worker_max_jobs=worker_max_jobs,
+                             worker_max_memory=worker_max_memory, queue_size=queue_size, defer_previews=defer_previews,
+                             package_paths=package_paths)
+    pipeline.run(packages_to_export, pending_updates)
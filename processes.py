@@ -0,0 +1,323 @@
+import asyncio
+import atexit
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional, List, Callable, TypeVar, Awaitable, Coroutine, Any, Dict
+
+from resources import get_process_cpu_time
+
+T = TypeVar('T')
+
+# Lines of output longer than this are dropped, since they can't be buffered. Results reported by Blender (e.g.,
+# `BDK_WORKER_RESULT:` lines) are far shorter.
+STREAM_LIMIT = 16 * 1024 * 1024
+
+
+# Limits for the child processes of the build. Timeouts are `base + rate * amount` (e.g., seconds per MB of input)
+# multiplied by `timeout_scale`, so that large packages get more time. A process is also considered hung when it
+# produced no output and used no CPU time for `hang_timeout` seconds.
+class ProcessLimits:
+
+    def __init__(self, timeout_scale: float = 1.0, hang_timeout: Optional[float] = 300.0, retries: int = 2,
+                 retry_backoff: float = 5.0):
+        self.timeout_scale = timeout_scale
+        self.hang_timeout = hang_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+    def get_timeout(self, base: float, rate: float = 0.0, amount: float = 0.0) -> Optional[float]:
+        if not self.timeout_scale:
+            return None
+        return (base + rate * amount) * self.timeout_scale
+
+    def get_retry_delay(self, attempt: int) -> float:
+        # Exponential backoff, in seconds, before the `attempt`th retry (starting at 1).
+        return self.retry_backoff * 2 ** (attempt - 1)
+
+
+# Shared by every stage, and set from the command line.
+process_limits = ProcessLimits()
+
+EXPORT_TIMEOUT_BASE = 300.0
+EXPORT_TIMEOUT_PER_MB = 30.0
+BLEND_TIMEOUT_BASE = 600.0
+BLEND_TIMEOUT_PER_MB = 30.0
+CUBEMAP_TIMEOUT_BASE = 300.0
+CUBEMAP_TIMEOUT_PER_CUBE_MAP = 60.0
+
+
+def get_process_group_arguments(low_priority: bool = False) -> dict:
+    # Returns the arguments (for `subprocess.Popen` or `asyncio.create_subprocess_exec`) that start the process in its
+    # own process group, so that the whole tree can be killed, and optionally at a lower priority than the build's
+    # other jobs.
+    if os.name == 'nt':
+        creationflags = subprocess.CREATE_NEW_PROCESS_GROUP
+        if low_priority:
+            creationflags |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        return {'creationflags': creationflags}
+    arguments = {'start_new_session': True}
+    if low_priority:
+        arguments['preexec_fn'] = lambda: os.nice(10)
+    return arguments
+
+
+def kill_process_tree(process):
+    # Kills the process (a `subprocess.Popen` or an asyncio process) and everything it started. The process must have
+    # been started with the arguments from `get_process_group_arguments`. This is safe to call from any thread.
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == 'nt':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (OSError, subprocess.SubprocessError):
+        try:
+            os.kill(process.pid, signal.SIGKILL if os.name != 'nt' else signal.SIGTERM)
+        except OSError:
+            pass
+
+
+# Runs every child process of the build (umodel, Blender sessions and workers) on a single asyncio event loop in a
+# background thread, which starts them, streams their output and reaps them without a thread per child. Stages submit
+# coroutines with `submit` (bounding how many run at once with `bounded`) and wait for the futures from any thread.
+# Children run in their own process groups, so they don't receive the terminal's Ctrl+C. `kill_all` kills them all
+# (see `handle_interrupts`), and stops new ones from being started.
+class ProcessEngine:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._processes: Dict[int, asyncio.subprocess.Process] = {}
+        self.is_cancelled = False
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                if os.name != 'nt' and sys.version_info < (3, 12) and hasattr(os, 'pidfd_open'):
+                    # Reaps children as their process descriptors become readable, instead of waiting for each one in
+                    # a thread of its own (which is the default before Python 3.12).
+                    watcher = asyncio.PidfdChildWatcher()
+                    watcher.attach_loop(loop)
+                    asyncio.set_child_watcher(watcher)
+                threading.Thread(target=loop.run_forever, name='ProcessEngine', daemon=True).start()
+                atexit.register(self.kill_all)
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> 'Future[T]':
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        # Runs the coroutine on the engine and waits for its result. It is cancelled (killing the processes it started)
+        # if the wait is interrupted.
+        future = self.submit(coroutine)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    async def start_process(self, args: List[str], low_priority: bool = False, **kwargs) -> asyncio.subprocess.Process:
+        if self.is_cancelled:
+            raise asyncio.CancelledError('the build was interrupted')
+        process = await asyncio.create_subprocess_exec(*args, limit=STREAM_LIMIT,
+                                                       **get_process_group_arguments(low_priority), **kwargs)
+        self._processes[process.pid] = process
+        asyncio.get_running_loop().create_task(self._forget(process))
+        return process
+
+    async def _forget(self, process: asyncio.subprocess.Process):
+        await process.wait()
+        self._processes.pop(process.pid, None)
+
+    def _cancel_tasks(self):
+        for task in asyncio.all_tasks(self._loop):
+            task.cancel()
+
+    def kill_all(self):
+        # Kills every running child and its process tree, and cancels whatever is waiting to start one. This is safe
+        # to call from a signal handler.
+        self.is_cancelled = True
+        for process in list(self._processes.values()):
+            kill_process_tree(process)
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._cancel_tasks)
+
+    def handle_interrupts(self):
+        # Kills the children as soon as Ctrl+C is pressed, so that stages that are waiting on them wind down straight
+        # away instead of leaving them running (or waiting for them to finish).
+        def on_interrupt(signal_number, frame):
+            self.kill_all()
+            signal.default_int_handler(signal_number, frame)
+
+        signal.signal(signal.SIGINT, on_interrupt)
+
+
+# Shared by every stage.
+process_engine = ProcessEngine()
+
+
+async def bounded(semaphore: asyncio.Semaphore, func: Callable[..., Awaitable[T]], *args) -> T:
+    # Runs `func` once the semaphore admits it. Jobs are admitted in the order they were submitted.
+    async with semaphore:
+        return await func(*args)
+
+
+async def read_line(stream: asyncio.StreamReader) -> Optional[str]:
+    # Returns the next line of output, an empty string once the stream ends, or None for a line that was too long
+    # (see `STREAM_LIMIT`).
+    try:
+        line = await stream.readline()
+    except ValueError:
+        return None
+    return line.decode(errors='replace')
+
+
+# Kills a process once it runs past its deadline, or once it stops producing output and using CPU time.
+# Long-running processes (e.g., Blender workers) can be given a new deadline for each job with `start_job`. The
+# watchdog runs on the process engine, and its methods can be called from any thread.
+class ProcessWatchdog:
+
+    def __init__(self, process, limits: ProcessLimits = process_limits, poll_interval: float = 1.0):
+        self.process = process
+        self.limits = limits
+        self.poll_interval = poll_interval
+        self.reason: Optional[str] = None
+        self._lock = threading.Lock()
+        self._deadline: Optional[float] = None
+        self._is_active = False
+        self._last_progress_time = time.monotonic()
+        self._last_cpu_time: Optional[float] = None
+        self._future: Optional[Future] = None
+
+    def start_job(self, timeout: Optional[float]):
+        with self._lock:
+            self._deadline = time.monotonic() + timeout if timeout is not None else None
+            self._last_progress_time = time.monotonic()
+            self._last_cpu_time = None
+            self._is_active = True
+
+    def end_job(self):
+        # Idle workers wait for their next job and are neither timed out nor considered hung.
+        with self._lock:
+            self._is_active = False
+
+    def notify_output(self):
+        with self._lock:
+            self._last_progress_time = time.monotonic()
+
+    def _check(self) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            if not self._is_active:
+                return None
+            if self._deadline is not None and now > self._deadline:
+                return 'timed out'
+            if self.limits.hang_timeout is None:
+                return None
+            cpu_time = get_process_cpu_time(self.process.pid)
+            if cpu_time is None:
+                # Without a way to tell if the process is busy, only the deadline applies.
+                return None
+            if cpu_time != self._last_cpu_time:
+                self._last_cpu_time = cpu_time
+                self._last_progress_time = now
+            if now - self._last_progress_time > self.limits.hang_timeout:
+                return 'hung'
+        return None
+
+    async def _watch(self):
+        while self.process.returncode is None:
+            await asyncio.sleep(self.poll_interval)
+            reason = self._check()
+            if reason is not None:
+                self.reason = reason
+                kill_process_tree(self.process)
+                return
+
+    def start(self):
+        self._future = process_engine.submit(self._watch())
+
+    def stop(self):
+        if self._future is not None:
+            self._future.cancel()
+
+    def __enter__(self) -> 'ProcessWatchdog':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+async def run_process_async(args: List[str], timeout: Optional[float] = None,
+                            on_output: Optional[Callable[[str], None]] = None, limits: ProcessLimits = process_limits,
+                            stderr: Optional[int] = asyncio.subprocess.STDOUT) -> subprocess.CompletedProcess:
+    # Runs the process to completion on the process engine, forwarding its output line by line (to stdout by
+    # default), and kills its whole process tree if it times out, hangs, or is cancelled. A process that was killed by
+    # the watchdog returns a non-zero code, and the reason is stored in `stderr` and reported through `on_output`.
+    if on_output is None:
+        on_output = sys.stdout.write
+    process = await process_engine.start_process(args, stdout=asyncio.subprocess.PIPE, stderr=stderr)
+    try:
+        with ProcessWatchdog(process, limits) as watchdog:
+            watchdog.start_job(timeout)
+            while True:
+                line = await read_line(process.stdout)
+                if line == '':
+                    break
+                watchdog.notify_output()
+                if line is not None:
+                    on_output(line)
+            return_code = await process.wait()
+    except BaseException:
+        kill_process_tree(process)
+        raise
+    if watchdog.reason is not None:
+        on_output(f'Killed {os.path.basename(args[0])} ({watchdog.reason}): {" ".join(args[1:])}\n')
+        return subprocess.CompletedProcess(args, return_code or -1, stderr=watchdog.reason)
+    return subprocess.CompletedProcess(args, return_code)
+
+
+def run_process(args: List[str], timeout: Optional[float] = None, on_output: Optional[Callable[[str], None]] = None,
+                limits: ProcessLimits = process_limits) -> subprocess.CompletedProcess:
+    # Like `run_process_async`, for callers that aren't running on the process engine.
+    return process_engine.run(run_process_async(args, timeout, on_output, limits))
+
+
+def retry(func: Callable[[], T], should_retry: Callable[[T], bool], description: str,
+          limits: ProcessLimits = process_limits) -> T:
+    # Calls `func` until `should_retry` is false for its result or it has been retried `limits.retries` times, backing
+    # off between attempts, and returns the last result.
+    result = func()
+    for attempt in range(1, limits.retries + 1):
+        if not should_retry(result):
+            break
+        delay = limits.get_retry_delay(attempt)
+        print(f'Retrying {description} in {delay:.0f}s (attempt {attempt + 1} of {limits.retries + 1})')
+        time.sleep(delay)
+        result = func()
+    return result
+
+
+async def retry_async(func: Callable[[], Awaitable[T]], should_retry: Callable[[T], bool], description: str,
+                      limits: ProcessLimits = process_limits) -> T:
+    # Like `retry`, for coroutines running on the process engine.
+    result = await func()
+    for attempt in range(1, limits.retries + 1):
+        if not should_retry(result):
+            break
+        delay = limits.get_retry_delay(attempt)
+        print(f'Retrying {description} in {delay:.0f}s (attempt {attempt + 1} of {limits.retries + 1})')
+        await asyncio.sleep(delay)
+        result = await func()
+    return result
@@ -0,0 +1,149 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional, Union, Dict, Tuple
+
+MB = 1024 * 1024
+
+# Rough peak memory usage of the child processes, used to decide how many can run at once.
+UMODEL_MEMORY_ESTIMATE = 512 * MB
+BLENDER_MEMORY_ESTIMATE = 2048 * MB
+NUMPY_CUBEMAP_MEMORY_ESTIMATE = 128 * MB
+TEXTURE_MEMORY_ESTIMATE = 256 * MB
+
+DEFAULT_MEMORY_HEADROOM = 1024 * MB
+
+
+def _read_meminfo(key: str) -> Optional[int]:
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_available_memory() -> Optional[int]:
+    # Returns the memory available for new processes in bytes, or None if it can't be determined on this platform.
+    return _read_meminfo('MemAvailable')
+
+
+def get_process_memory_usage(pid: int) -> Optional[int]:
+    # Returns the resident set size of the process in bytes, or None if it can't be determined on this platform.
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_process_cpu_time(pid: int) -> Optional[float]:
+    # Returns the CPU time (in seconds) used by the process and the children it waited for, or None if it can't be
+    # determined on this platform.
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # The command name can contain spaces, so the fields are counted from the end of it.
+            fields = f.read().rsplit(')', 1)[1].split()
+        return sum(int(x) for x in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# Admits new child processes only while the observed available memory leaves enough headroom for them.
+# Processes that were started recently may not have allocated their memory yet, so their estimates are held back
+# for `settle_time` seconds, or until they are released (after which their memory is either in use, and observed, or
+# freed). A process is always admitted when no other admitted process is running, so that a busy machine slows the
+# build down instead of stalling it.
+class MemoryGate:
+
+    def __init__(self, headroom: int = DEFAULT_MEMORY_HEADROOM, settle_time: float = 5.0):
+        self.headroom = headroom
+        self.settle_time = settle_time
+        self._condition = threading.Condition()
+        self._running_count = 0
+        # Admission times and estimates, keyed by admission (in the order they were admitted).
+        self._recent_admissions: Dict[int, Tuple[float, int]] = {}
+        self._admission_ids = itertools.count()
+
+    def _get_recently_admitted_memory(self) -> int:
+        now = time.monotonic()
+        for admission, (admission_time, _) in list(self._recent_admissions.items()):
+            if now - admission_time <= self.settle_time:
+                break
+            del self._recent_admissions[admission]
+        return sum(x[1] for x in self._recent_admissions.values())
+
+    def _has_room(self, estimate: int) -> bool:
+        if self._running_count == 0:
+            return True
+        available = get_available_memory()
+        if available is None:
+            return True
+        return available - self.headroom - self._get_recently_admitted_memory() >= estimate
+
+    def _admit(self, estimate: int) -> int:
+        admission = next(self._admission_ids)
+        self._running_count += 1
+        self._recent_admissions[admission] = (time.monotonic(), estimate)
+        return admission
+
+    def acquire(self, estimate: int) -> int:
+        # Returns the admission, which is passed to `release`.
+        with self._condition:
+            while not self._has_room(estimate):
+                self._condition.wait(timeout=0.5)
+            return self._admit(estimate)
+
+    async def acquire_async(self, estimate: int) -> int:
+        # Like `acquire`, without blocking the event loop that the caller runs on (see `processes.ProcessEngine`).
+        while True:
+            with self._condition:
+                if self._has_room(estimate):
+                    return self._admit(estimate)
+            await asyncio.sleep(0.5)
+
+    def release(self, admission: int):
+        with self._condition:
+            self._running_count -= 1
+            self._recent_admissions.pop(admission, None)
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, estimate: int):
+        admission = self.acquire(estimate)
+        try:
+            yield
+        finally:
+            self.release(admission)
+
+    @asynccontextmanager
+    async def admit_async(self, estimate: int):
+        admission = await self.acquire_async(estimate)
+        try:
+            yield
+        finally:
+            self.release(admission)
+
+
+# Shared by every stage, since they all compete for the memory of the same machine.
+memory_gate = MemoryGate()
+
+
+def get_job_count(jobs: Union[int, str], memory_estimate: int, cpu_share: float = 1.0) -> int:
+    # Resolves a `--*_jobs` value. In `auto` mode, the count is sized from the number of CPUs (scaled by `cpu_share`
+    # for programs that are multithreaded themselves) and capped by how many processes fit in the available memory.
+    if jobs != 'auto':
+        return max(1, int(jobs))
+    job_count = max(1, int((os.cpu_count() or 1) * cpu_share))
+    available = get_available_memory()
+    if available is not None:
+        job_count = min(job_count, max(1, (available - memory_gate.headroom) // memory_estimate))
+    return job_count
@@ -0,0 +1,85 @@
+import fnmatch
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import NamedTuple, Iterable, Dict, List, Tuple
+
+
+class ScannedFile(NamedTuple):
+    path: str
+    last_modified_time: float
+    size: int
+
+
+# Matches paths against all the patterns of a .bdkignore file at once.
+class IgnoreMatcher:
+
+    def __init__(self, patterns: Iterable[str]):
+        patterns = [os.path.normcase(x) for x in patterns if x]
+        self._file_regex = None
+        self._directory_regex = None
+        if patterns:
+            self._file_regex = re.compile('|'.join(fnmatch.translate(x) for x in patterns))
+        # A pattern that ends with a wildcard matches every file below a directory if the rest of the pattern matches
+        # the start of the directory's path, since the wildcard also matches path separators. Those directories
+        # don't need to be scanned at all.
+        prefixes = [x.rstrip('*') for x in patterns if x.endswith('*')]
+        if prefixes:
+            # `fnmatch.translate` anchors the pattern at the end, which is removed here to match prefixes.
+            self._directory_regex = re.compile('|'.join(fnmatch.translate(x).removesuffix(r'\Z') for x in prefixes))
+
+    def is_ignored(self, path: str) -> bool:
+        return self._file_regex is not None and self._file_regex.match(os.path.normcase(path)) is not None
+
+    def is_directory_ignored(self, path: str) -> bool:
+        return self._directory_regex is not None and \
+            self._directory_regex.match(os.path.normcase(path + os.sep)) is not None
+
+
+def _scan_directory(path: str, suffixes: Tuple[str], matcher: IgnoreMatcher) -> Tuple[List[ScannedFile], List[str]]:
+    files = []
+    directories = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not matcher.is_directory_ignored(entry.path):
+                        directories.append(entry.path)
+                elif os.path.splitext(entry.name)[1] in suffixes and not matcher.is_ignored(entry.path):
+                    stat = entry.stat()
+                    files.append(ScannedFile(entry.path, stat.st_mtime, stat.st_size))
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return files, directories
+
+
+def scan(directories: Iterable[str], suffixes: Iterable[str], ignore_patterns: Iterable[str] = (),
+         max_workers: int = 16) -> Dict[str, ScannedFile]:
+    # Recursively finds the files with matching suffixes in the directories, stat-ing each of them exactly once.
+    # Directories are listed in parallel, which matters most on network drives where each listing has high latency.
+    matcher = IgnoreMatcher(ignore_patterns)
+    suffixes = tuple(suffixes)
+    files: Dict[str, ScannedFile] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for directory in set(directories):
+            if not matcher.is_directory_ignored(directory):
+                pending.add(executor.submit(_scan_directory, directory, suffixes, matcher))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                scanned_files, subdirectories = future.result()
+                for file in scanned_files:
+                    files[file.path] = file
+                for subdirectory in subdirectories:
+                    pending.add(executor.submit(_scan_directory, subdirectory, suffixes, matcher))
+    return files
+
+
+def read_ignore_patterns(root_directory: str) -> List[str]:
+    # Read ignore patterns from the .bdkignore file in the root directory.
+    bdkignore_path = os.path.join(root_directory, '.bdkignore')
+    if not os.path.isfile(bdkignore_path):
+        return []
+    with open(bdkignore_path, 'r') as f:
+        return [x.strip() for x in f.readlines()]
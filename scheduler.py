@@ -0,0 +1,199 @@
+import heapq
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from glob import glob
+from typing import Dict, Set, List, Callable, Any, Iterator, Tuple, Optional, Iterable, TYPE_CHECKING
+
+from bdk import UReference
+from packages import read_referenced_package_names
+
+if TYPE_CHECKING:
+    from catalog import Catalog
+
+REFERENCE_PATTERN = re.compile(r'\w+\'[\w\.\d\-\_]+\'')
+
+
+def get_package_references(input_directory: str) -> Set[str]:
+    # Returns the (lower-case) names of all packages referenced by the exported objects in the directory.
+    package_names = set()
+    for file in glob('**/*.props.txt', root_dir=input_directory, recursive=True):
+        with open(os.path.join(input_directory, file), 'r', errors='ignore') as f:
+            for string in REFERENCE_PATTERN.findall(f.read()):
+                reference = UReference.from_string(string)
+                if reference is not None:
+                    package_names.add(reference.package_name.lower())
+    return package_names
+
+
+def get_package_paths_by_name(package_paths: Iterable[str]) -> Dict[str, List[str]]:
+    # Package names are case-insensitive in Unreal, so they are matched in lower-case.
+    package_paths_by_name: Dict[str, List[str]] = {}
+    for package_path in package_paths:
+        package_name = os.path.splitext(os.path.basename(package_path))[0].lower()
+        package_paths_by_name.setdefault(package_name, []).append(package_path)
+    return package_paths_by_name
+
+
+def get_package_dependencies(package_path: str, package_paths_by_name: Dict[str, List[str]], build_directory: str,
+                             catalog: Optional['Catalog'] = None, root_directory: Optional[str] = None) -> Set[str]:
+    # Returns the package paths (from `package_paths_by_name`) that the exported package references.
+    # The references are read from the catalog if the package is indexed in it, and from the exported files otherwise.
+    # If `root_directory` is set, the packages imported by the package itself (according to its header) are included
+    # as well, which are known before it is exported (again).
+    input_directory = os.path.splitext(os.path.join(build_directory, package_path))[0]
+    package_names = set()
+    if catalog is not None and catalog.is_package_indexed(package_path):
+        package_names = catalog.get_referenced_package_names(package_path)
+    elif os.path.isdir(input_directory):
+        package_names = get_package_references(input_directory)
+    if root_directory is not None:
+        package_names = package_names | (read_referenced_package_names(os.path.join(root_directory, package_path)) or set())
+    dependencies = set()
+    for package_name in package_names:
+        dependencies.update(package_paths_by_name.get(package_name, []))
+    dependencies.discard(package_path)
+    return dependencies
+
+
+def build_dependency_graph(package_paths: List[str], build_directory: str, catalog: Optional['Catalog'] = None,
+                           root_directory: Optional[str] = None) -> Dict[str, Set[str]]:
+    # Maps each package path to the set of package paths (from the same list) that it references.
+    package_paths_by_name = get_package_paths_by_name(package_paths)
+    return {x: get_package_dependencies(x, package_paths_by_name, build_directory, catalog, root_directory) for x in package_paths}
+
+
+def find_cycles(graph: Dict[str, Set[str]]) -> List[List[str]]:
+    # Returns the strongly connected components of the graph that contain more than one node (Tarjan's algorithm).
+    # This is written iteratively because dependency chains can be deeper than the recursion limit.
+    index_counter = 0
+    indices: Dict[str, int] = {}
+    low_links: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack: Set[str] = set()
+    cycles = []
+
+    for root in graph:
+        if root in indices:
+            continue
+        work = [(root, iter(graph[root]))]
+        indices[root] = low_links[root] = index_counter
+        index_counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in graph:
+                    continue
+                if child not in indices:
+                    indices[child] = low_links[child] = index_counter
+                    index_counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(graph[child])))
+                elif child in on_stack:
+                    low_links[node] = min(low_links[node], indices[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low_links[parent] = min(low_links[parent], low_links[node])
+            if low_links[node] == indices[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1:
+                    cycles.append(sorted(component))
+    return cycles
+
+
+def break_cycles(graph: Dict[str, Set[str]], cycles: List[List[str]]) -> Dict[str, Set[str]]:
+    # Returns a copy of the graph with the edges between members of the same cycle removed, so that the members of a
+    # cycle can be scheduled once everything else they depend on is built.
+    component_by_node = {}
+    for i, cycle in enumerate(cycles):
+        for node in cycle:
+            component_by_node[node] = i
+    acyclic_graph = {}
+    for node, dependencies in graph.items():
+        component = component_by_node.get(node, None)
+        acyclic_graph[node] = set(
+            dependency for dependency in dependencies
+            if dependency in graph and (component is None or component_by_node.get(dependency, None) != component)
+        )
+    return acyclic_graph
+
+
+# Runs a job for every node of an acyclic dependency graph, only starting a node once all of its dependencies have
+# finished. Ready nodes are started in order of `priority_key`.
+class DependencyScheduler:
+
+    def __init__(self, graph: Dict[str, Set[str]], priority_key: Optional[Callable[[str], Any]] = None):
+        self.graph = graph
+        self.priority_key = priority_key if priority_key is not None else lambda x: x
+        self.dependents: Dict[str, Set[str]] = {node: set() for node in graph}
+        for node, dependencies in graph.items():
+            for dependency in dependencies:
+                self.dependents[dependency].add(node)
+
+    def _initial_state(self) -> Tuple[Dict[str, int], List]:
+        remaining = {node: len(dependencies) for node, dependencies in self.graph.items()}
+        ready = []
+        for node, count in remaining.items():
+            if count == 0:
+                heapq.heappush(ready, (self.priority_key(node), node))
+        return remaining, ready
+
+    def _complete(self, node: str, remaining: Dict[str, int], ready: List):
+        for dependent in self.dependents[node]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                heapq.heappush(ready, (self.priority_key(dependent), dependent))
+
+    def static_order(self) -> List[str]:
+        remaining, ready = self._initial_state()
+        order = []
+        while ready:
+            _, node = heapq.heappop(ready)
+            order.append(node)
+            self._complete(node, remaining, ready)
+        return order
+
+    def run(self, func: Callable[[str], Any], max_workers: int = 1) -> Iterator[Tuple[str, Any]]:
+        # Yields `(node, result)` pairs as jobs complete.
+        remaining, ready = self._initial_state()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+            while ready or running:
+                while ready and len(running) < max_workers:
+                    _, node = heapq.heappop(ready)
+                    running[executor.submit(func, node)] = node
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    self._complete(node, remaining, ready)
+                    yield node, future.result()
+
+
+def get_critical_path_costs(graph: Dict[str, Set[str]], get_cost: Callable[[str], float]) -> Dict[str, float]:
+    # Returns the cost of each node plus that of the costliest chain of nodes that (transitively) depend on it.
+    # Starting the nodes with the costliest remaining chain first keeps the end of the build from waiting on a single
+    # long job or chain of jobs. Nodes in cycles (see `break_cycles`) are only given their own cost.
+    dependents: Dict[str, Set[str]] = {node: set() for node in graph}
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            if dependency in dependents:
+                dependents[dependency].add(node)
+    costs = {}
+    for node in reversed(DependencyScheduler(graph).static_order()):
+        costs[node] = get_cost(node) + max((costs[x] for x in dependents[node] if x in costs), default=0.0)
+    for node in graph:
+        if node not in costs:
+            costs[node] = get_cost(node)
+    return costs
@@ -0,0 +1,214 @@
+import glob
+import json
+import os
+import re
+import sqlite3
+from pathlib import Path
+from typing import NamedTuple, Dict, Set, List, Iterable, Optional, Callable
+
+import xxhash
+
+from manifest import BuildManifest, get_manifest_path, set_manifest_fragment, MANIFEST_FILENAME
+
+FRAGMENT_PREFIX = 'shard-'
+
+
+# A share of a build that is split across several machines, e.g., `2/4` is the second of four shards.
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+    @staticmethod
+    def from_string(value: str) -> 'Shard':
+        index, count = (int(x) for x in value.split('/'))
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError(f'shard must be K/N with 1 <= K <= N (got {value})')
+        return Shard(index, count)
+
+    @property
+    def fragment_name(self) -> str:
+        return f'{FRAGMENT_PREFIX}{self.index}-of-{self.count}'
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+
+def get_dependency_groups(graph: Dict[str, Set[str]]) -> List[List[str]]:
+    # Returns the sets of packages that are connected by references (in either direction), each sorted.
+    parents = {x: x for x in graph}
+
+    def find(x: str) -> str:
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    for package_path, dependencies in graph.items():
+        for dependency in dependencies:
+            if dependency in parents:
+                a, b = find(package_path), find(dependency)
+                if a != b:
+                    parents[max(a, b)] = min(a, b)
+    groups: Dict[str, List[str]] = {}
+    for package_path in sorted(graph):
+        groups.setdefault(find(package_path), []).append(package_path)
+    return list(groups.values())
+
+
+def partition(graph: Dict[str, Set[str]], get_weight: Callable[[str], float], count: int) -> List[List[str]]:
+    # Splits the packages of the dependency graph into `count` shards of about the same total weight, keeping packages
+    # that reference each other in the same shard so that they are blended in the right order. Groups that are heavier
+    # than a whole shard (e.g., everything that uses a common texture package) are split up, since they would
+    # otherwise leave the other machines idle.
+    # Ties are broken by path, so that every machine computes the same partition from the same manifest.
+    groups = get_dependency_groups(graph)
+    total_weight = sum(get_weight(x) for x in graph)
+    target_weight = total_weight / count
+    weighted_groups = []
+    for group in groups:
+        weight = sum(get_weight(x) for x in group)
+        if weight > target_weight and len(group) > 1:
+            weighted_groups += [(get_weight(x), [x]) for x in group]
+        else:
+            weighted_groups.append((weight, group))
+    # Longest-processing-time-first: the heaviest group goes to the lightest shard.
+    weighted_groups.sort(key=lambda x: (-x[0], x[1][0]))
+    shards = [[] for _ in range(count)]
+    shard_weights = [0.0] * count
+    for weight, group in weighted_groups:
+        i = min(range(count), key=lambda x: (shard_weights[x], x))
+        shards[i] += group
+        shard_weights[i] += weight
+    return [sorted(x) for x in shards]
+
+
+def get_fallback_shard(package_path: str, count: int) -> int:
+    # Packages that weren't partitioned (e.g., ones that became out-of-date after the partition was made) are assigned
+    # by a hash of their path, which doesn't depend on the state of any machine.
+    return xxhash.xxh3_64_intdigest(package_path.encode()) % count + 1
+
+
+def use_fragment(shard: Shard):
+    # Makes the build use the shard's fragment of the manifest. A new fragment starts as a copy of the manifest, so
+    # that the shard only builds what is out-of-date.
+    main_path = get_manifest_path()
+    set_manifest_fragment(shard.fragment_name)
+    fragment_path = get_manifest_path()
+    if os.path.isfile(fragment_path):
+        print(f'Resuming shard {shard} from {fragment_path}')
+        return
+    if os.path.isfile(main_path):
+        main_manifest = BuildManifest.load(main_path)
+        connection = sqlite3.connect(fragment_path)
+        try:
+            main_manifest.backup(connection)
+        finally:
+            connection.close()
+    print(f'Building shard {shard} into {fragment_path}')
+
+
+def _connect(fragment_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(fragment_path, isolation_level=None)
+    connection.execute('CREATE TABLE IF NOT EXISTS shard (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    return connection
+
+
+def _read_partition(fragment_path: str) -> Optional[Dict]:
+    connection = _connect(fragment_path)
+    try:
+        row = connection.execute('SELECT value FROM shard WHERE key = \'partition\'').fetchone()
+    finally:
+        connection.close()
+    return json.loads(row[0]) if row is not None else None
+
+
+def _write_partition(fragment_path: str, value: Dict):
+    connection = _connect(fragment_path)
+    try:
+        connection.execute('INSERT OR REPLACE INTO shard (key, value) VALUES (\'partition\', ?)', (json.dumps(value),))
+    finally:
+        connection.close()
+
+
+def select_shard_packages(shard: Shard, package_paths: Iterable[str], get_graph: Callable[[List[str]], Dict[str, Set[str]]],
+                          get_weight: Callable[[str], float]) -> Set[str]:
+    # Returns the packages (of those that are out-of-date) that this shard builds. The partition is stored in the
+    # fragment, so that a shard that is resumed keeps building the same packages after some of them were built.
+    package_paths = sorted(set(package_paths))
+    fragment_path = get_manifest_path()
+    stored = _read_partition(fragment_path)
+    if stored is not None and stored['count'] == shard.count:
+        assignments = stored['assignments']
+    else:
+        shards = partition(get_graph(package_paths), get_weight, shard.count)
+        assignments = {x: i + 1 for i, shard_package_paths in enumerate(shards) for x in shard_package_paths}
+        _write_partition(fragment_path, {'index': shard.index, 'count': shard.count, 'assignments': assignments})
+        for i, shard_package_paths in enumerate(shards):
+            weight = sum(get_weight(x) for x in shard_package_paths)
+            print(f'Shard {i + 1}/{shard.count}: {len(shard_package_paths)} package(s) (weight {weight:.0f})')
+    selected = set(
+        x for x in package_paths
+        if assignments.get(x, None) == shard.index or (x not in assignments and get_fallback_shard(x, shard.count) == shard.index)
+    )
+    print(f'Shard {shard} builds {len(selected)} of {len(package_paths)} out-of-date package(s)')
+    return selected
+
+
+def find_fragment_paths() -> List[str]:
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    paths = glob.glob(os.path.join(build_directory, f'{MANIFEST_FILENAME}.{FRAGMENT_PREFIX}*-of-*'))
+    return sorted(x for x in paths if re.fullmatch(r'.*-of-\d+', x))
+
+
+def _get_package_directory(package_path: str) -> str:
+    return str(Path(package_path).with_suffix(''))
+
+
+def merge_manifests(fragment_paths: Optional[List[str]] = None, keep: bool = False):
+    # Combines the fragments written by the shards of a build into the manifest. Each shard's entries are taken for
+    # the packages (and their cube maps) it was assigned. Other entries are kept, unless every shard removed them
+    # (e.g., because the package was deleted).
+    if fragment_paths is None:
+        fragment_paths = find_fragment_paths()
+    if len(fragment_paths) == 0:
+        print('No manifest fragments found')
+        return
+
+    fragments = []
+    for fragment_path in fragment_paths:
+        # A shard that was interrupted before it was partitioned wasn't assigned anything.
+        stored = _read_partition(fragment_path) or {'index': None, 'assignments': {}}
+        assigned = set(x for x, i in stored['assignments'].items() if i == stored['index'])
+        manifest = BuildManifest(path=fragment_path)
+        manifest.read_entries()
+        fragments.append((assigned, set(_get_package_directory(x) for x in assigned), manifest))
+        print(f'{fragment_path}: {len(assigned)} assigned package(s), {len(manifest.files)} package(s)')
+
+    main_manifest = BuildManifest.load(get_manifest_path())
+    sections = {}
+    for section in ('files', 'cube_maps', 'quarantine'):
+        keys = set(main_manifest[section]).union(*(x[2][section] for x in fragments))
+        merged = {}
+        for key in sorted(keys):
+            if section == 'cube_maps':
+                owners = [x[2] for x in fragments if str(Path(key).parent.parent) in x[1]]
+            else:
+                owners = [x[2] for x in fragments if key in x[0]]
+            if owners:
+                if key in owners[0][section]:
+                    merged[key] = owners[0][section][key]
+                continue
+            present = [x[2] for x in fragments if key in x[2][section]]
+            if present:
+                merged[key] = present[0][section][key]
+        sections[section] = merged
+    main_manifest.replace(**sections)
+    print(f'Merged {len(fragments)} fragment(s) into {get_manifest_path()} ({len(main_manifest.files)} package(s))')
+
+    for _, _, manifest in fragments:
+        manifest.close()
+    if not keep:
+        for fragment_path in fragment_paths:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.isfile(fragment_path + suffix):
+                    os.remove(fragment_path + suffix)
@@ -0,0 +1,49 @@
+import asyncio
+import json
+import os
+
+from build import build_cube_map_batch, write_cube_map_jobs
+from joblogs import job_logs
+
+FACE_NAMES = ['Front', 'Back', 'Right', 'Left', 'Top', 'Bottom']
+
+
+def write_cube_map(build_directory, name: str, face_count: int) -> str:
+    cubemap_file = os.path.join('Sky', 'Cubemap', f'{name}.props.txt')
+    os.makedirs(build_directory / 'Sky' / 'Cubemap', exist_ok=True)
+    with open(build_directory / cubemap_file, 'w') as f:
+        for i, face_name in enumerate(FACE_NAMES[:face_count]):
+            f.write(f"Faces[{i}] = Texture'Sky.{name}{face_name}'\n")
+    return cubemap_file
+
+
+def test_cube_map_with_missing_face_is_not_rendered(tmp_path, monkeypatch):
+    monkeypatch.setenv('BUILD_DIRECTORY', str(tmp_path))
+    complete = write_cube_map(tmp_path, 'Complete', 6)
+    incomplete = write_cube_map(tmp_path, 'Incomplete', 5)
+
+    jobs_path, cubemap_files_by_output_path, errors = write_cube_map_jobs([complete, incomplete], str(tmp_path))
+    try:
+        with open(jobs_path, 'r') as f:
+            jobs = json.load(f)
+    finally:
+        os.remove(jobs_path)
+
+    assert len(jobs) == 1
+    assert len(jobs[0]['faces']) == 6
+    assert list(cubemap_files_by_output_path.values()) == [complete]
+    assert list(errors) == [incomplete]
+    assert 'got 5' in errors[incomplete]
+
+
+def test_batch_reports_cube_map_with_missing_face_as_failed(tmp_path, monkeypatch):
+    monkeypatch.setenv('BUILD_DIRECTORY', str(tmp_path))
+    incomplete = write_cube_map(tmp_path, 'Incomplete', 5)
+    results = []
+
+    # Blender is not started, since there is nothing left to render.
+    monkeypatch.delenv('BLENDER_PATH', raising=False)
+    asyncio.run(build_cube_map_batch([incomplete], str(tmp_path), lambda *result: results.append(result)))
+    job_logs.print_failures()
+
+    assert results == [(incomplete, False, None)]
@@ -0,0 +1,26 @@
+import sqlite3
+
+import pytest
+
+from catalog import Catalog
+
+
+def test_failed_remove_package_rolls_back(tmp_path, monkeypatch):
+    monkeypatch.setenv('BUILD_DIRECTORY', str(tmp_path))
+    catalog = Catalog(str(tmp_path / '.bdkcatalog'))
+    catalog.index_package('Textures/Foo.utx')
+
+    def fail(package_path: str):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    with monkeypatch.context() as m:
+        m.setattr(catalog, '_delete_package', fail)
+        with pytest.raises(sqlite3.OperationalError):
+            catalog.remove_package('Textures/Foo.utx')
+
+    # The transaction was rolled back, so later ones can start.
+    assert not catalog._connection.in_transaction
+    catalog.index_package('Textures/Bar.utx')
+    catalog.remove_package('Textures/Foo.utx')
+    assert not catalog.is_package_indexed('Textures/Foo.utx')
+    assert catalog.is_package_indexed('Textures/Bar.utx')
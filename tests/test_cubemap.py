@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+
+from cubemap import FACE_AXES, cube_to_equirectangular, read_tga, write_tga
+
+FACE_SIZE = 32
+WIDTH = FACE_SIZE * 4
+HEIGHT = WIDTH // 2
+
+FRONT, BACK, RIGHT, LEFT, TOP, BOTTOM = range(6)
+
+# The quads of the cube in `blender/cube2sphere.blend`, by face, as corners in Blender's coordinates and their UVs.
+# Blender's equirectangular camera looks down +X with +Z up, so +Y is on the left of the output (the converter's
+# right is Blender's -Y), and UVs start at the bottom left of the image.
+CUBE2SPHERE_QUADS = {
+    FRONT: [((1, 1, -1), (1, 0)), ((1, 1, 1), (0, 0)), ((1, -1, 1), (0, 1)), ((1, -1, -1), (1, 1))],
+    BACK: [((-1, -1, -1), (0, 1)), ((-1, -1, 1), (1, 1)), ((-1, 1, 1), (1, 0)), ((-1, 1, -1), (0, 0))],
+    RIGHT: [((1, -1, -1), (1, 1)), ((1, -1, 1), (1, 0)), ((-1, -1, 1), (0, 0)), ((-1, -1, -1), (0, 1))],
+    LEFT: [((-1, 1, -1), (0, 0)), ((-1, 1, 1), (0, 1)), ((1, 1, 1), (1, 1)), ((1, 1, -1), (1, 0))],
+    TOP: [((1, -1, 1), (1, 1)), ((1, 1, 1), (1, 0)), ((-1, 1, 1), (0, 0)), ((-1, -1, 1), (0, 1))],
+    BOTTOM: [((1, 1, -1), (1, 1)), ((1, -1, -1), (1, 0)), ((-1, -1, -1), (0, 0)), ((-1, 1, -1), (0, 1))],
+}
+
+FACE_COLORS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]
+
+
+def solid_faces():
+    return [np.full((FACE_SIZE, FACE_SIZE, 3), color, dtype=np.uint8) for color in FACE_COLORS]
+
+
+def gradient_faces():
+    # The first two channels give the column and row of the face pixel, and the third tells the faces apart.
+    coordinates = ((np.arange(FACE_SIZE) + 0.5) / FACE_SIZE * 255).astype(np.uint8)
+    faces = []
+    for i in range(6):
+        face = np.empty((FACE_SIZE, FACE_SIZE, 3), dtype=np.uint8)
+        face[:, :, 0] = coordinates[np.newaxis, :]
+        face[:, :, 1] = coordinates[:, np.newaxis]
+        face[:, :, 2] = 20 + 40 * i
+        faces.append(face)
+    return faces
+
+
+def get_pixel(longitude: float, latitude: float):
+    # Returns the output pixel that looks in the direction (in degrees, with longitude increasing to the right).
+    column = int((longitude + 180.0) / 360.0 * WIDTH)
+    row = int((90.0 - latitude) / 180.0 * HEIGHT)
+    return min(row, HEIGHT - 1), min(column, WIDTH - 1)
+
+
+def get_direction(row: int, column: int) -> np.ndarray:
+    longitude = (column + 0.5) / WIDTH * 2.0 * np.pi - np.pi
+    latitude = np.pi / 2.0 - (row + 0.5) / HEIGHT * np.pi
+    return np.array([np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude), np.sin(latitude)])
+
+
+def sample_cube2sphere(direction: np.ndarray):
+    # Returns the face and the image coordinates (in [0, 1], from the top left) that Blender renders in the direction.
+    direction = direction * np.array([1, -1, 1])
+    for face, quad in CUBE2SPHERE_QUADS.items():
+        corners = np.array([x[0] for x in quad], dtype=np.float64)
+        uvs = np.array([x[1] for x in quad], dtype=np.float64)
+        normal = corners.mean(axis=0)
+        if direction @ normal <= np.max(np.abs(direction)) - 1e-9:
+            continue
+        point = direction / (direction @ normal)
+        # The UVs of a square face are an affine function of the position on it.
+        origin, uv_origin = corners[0], uvs[0]
+        edges = np.array([corners[1] - origin, corners[3] - origin])
+        weights = np.linalg.lstsq(edges.T, point - origin, rcond=None)[0]
+        u, v = uv_origin + weights @ np.array([uvs[1] - uv_origin, uvs[3] - uv_origin])
+        return face, u, 1.0 - v
+    raise AssertionError('direction hits no face')
+
+
+@pytest.mark.parametrize('longitude, latitude, face', [
+    (0, 0, FRONT),
+    (-180, 0, BACK),
+    (179.9, 0, BACK),
+    (90, 0, RIGHT),
+    (-90, 0, LEFT),
+    (0, 89.9, TOP),
+    (0, -89.9, BOTTOM),
+    (45, 60, TOP),
+    (-135, -60, BOTTOM),
+])
+def test_direction_samples_face(longitude, latitude, face):
+    image = cube_to_equirectangular(solid_faces())
+    assert image.shape == (HEIGHT, WIDTH, 3)
+    assert tuple(image[get_pixel(longitude, latitude)]) == FACE_COLORS[face]
+
+
+def test_poles_and_seam():
+    image = cube_to_equirectangular(solid_faces())
+    assert np.all(image[0] == FACE_COLORS[TOP])
+    assert np.all(image[-1] == FACE_COLORS[BOTTOM])
+    # Both edges of the output look backwards, so the seam joins the two halves of the back face.
+    middle = slice(HEIGHT // 2 - 4, HEIGHT // 2 + 4)
+    assert np.all(image[middle, 0] == FACE_COLORS[BACK])
+    assert np.all(image[middle, -1] == FACE_COLORS[BACK])
+    # ...without a jump in the image of the back face across it.
+    image = cube_to_equirectangular(gradient_faces()).astype(np.float64)
+    assert np.all(np.abs(image[middle, 0, :2] - image[middle, -1, :2]) <= 255 / FACE_SIZE)
+
+
+@pytest.mark.parametrize('face', range(6))
+def test_face_orientation(face):
+    # Moving along the right and down axes of a face moves right and down in its image.
+    image = cube_to_equirectangular(gradient_faces()).astype(np.float64)
+    normal, right, down = (np.array(x, dtype=np.float64) for x in FACE_AXES[face])
+    for offset, channel in ((right, 0), (down, 1)):
+        samples = []
+        for sign in (-0.5, 0.5):
+            direction = normal + sign * offset
+            longitude = np.degrees(np.arctan2(direction[1], direction[0]))
+            latitude = np.degrees(np.arcsin(direction[2] / np.linalg.norm(direction)))
+            pixel = image[get_pixel(longitude, latitude)]
+            assert round((pixel[2] - 20) / 40) == face
+            samples.append(pixel[channel])
+        assert samples[0] < 100 < 155 < samples[1]
+
+
+def test_matches_cube2sphere_layout():
+    image = cube_to_equirectangular(gradient_faces()).astype(np.float64)
+    for row in range(0, HEIGHT, 3):
+        for column in range(0, WIDTH, 3):
+            face, u, v = sample_cube2sphere(get_direction(row, column))
+            # Pixels next to the edges of a face are blended with the next face.
+            if min(u, v, 1.0 - u, 1.0 - v) < 1.5 / FACE_SIZE:
+                continue
+            pixel = image[row, column]
+            assert round((pixel[2] - 20) / 40) == face, (row, column)
+            assert abs(pixel[0] - u * 255) <= 4 and abs(pixel[1] - v * 255) <= 4, (row, column, face)
+
+
+def test_tga_round_trip(tmp_path):
+    image = gradient_faces()[0]
+    path = str(tmp_path / 'face.tga')
+    write_tga(path, image)
+    assert np.array_equal(read_tga(path), image)
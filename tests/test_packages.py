@@ -0,0 +1,151 @@
+import struct
+
+import pytest
+
+from packages import HEADER, PACKAGE_TAG, NAME_LENGTH_VERSION, PackageError, PackageImport, PackageExport, \
+    parse_package, read_package, read_referenced_package_names, _read_compact_index
+
+# Enough names for name indices that don't fit in a single byte.
+FILLER_NAME_COUNT = 70
+LONG_NAME = 'Long' * 20
+UNICODE_NAME = 'Fenêtre☺'
+
+
+def compact_index(value: int) -> bytes:
+    magnitude = abs(value)
+    first = (0x80 if value < 0 else 0) | (magnitude & 0x3F)
+    magnitude >>= 6
+    if magnitude == 0:
+        return bytes([first])
+    data = bytearray([first | 0x40])
+    while True:
+        byte = magnitude & 0x7F
+        magnitude >>= 7
+        data.append(byte | (0x80 if magnitude else 0))
+        if not magnitude:
+            return bytes(data)
+
+
+def encode_name(name: str, version: int) -> bytes:
+    if version < NAME_LENGTH_VERSION:
+        data = name.encode('latin-1') + b'\0'
+    else:
+        try:
+            encoded = name.encode('latin-1') + b'\0'
+            data = compact_index(len(encoded)) + encoded
+        except UnicodeEncodeError:
+            encoded = name.encode('utf-16-le') + b'\0\0'
+            data = compact_index(-(len(encoded) // 2)) + encoded
+    return data + struct.pack('<I', 0)  # Flags.
+
+
+def build_package(version: int) -> bytes:
+    names = ['Core', 'Engine', 'Package', 'Class', 'Texture', 'Textures', 'Rock', 'MyLevel', LONG_NAME]
+    if version >= NAME_LENGTH_VERSION:
+        names.append(UNICODE_NAME)
+    names += [f'Filler{i}' for i in range(FILLER_NAME_COUNT)]
+    names += ['Sky', 'StaticMesh']
+    index = {x: i for i, x in enumerate(names)}
+
+    imports = [
+        # The package of the texture, its texture and the class of the texture (in the `Engine` package).
+        (index['Core'], index['Package'], 0, index['Textures']),
+        (index['Engine'], index['Texture'], -1, index['Rock']),
+        (index['Core'], index['Package'], 0, index['Engine']),
+        (index['Core'], index['Class'], -3, index['Texture']),
+    ]
+    exports = [
+        (0, 0, 0, index['Sky'], 0x70004, 0, 0),
+        (-4, 0, 1, index[LONG_NAME], 0x4, 100000, 1234567),
+    ]
+
+    name_table = b''.join(encode_name(x, version) for x in names)
+    import_table = b''.join(compact_index(a) + compact_index(b) + struct.pack('<i', c) + compact_index(d)
+                            for a, b, c, d in imports)
+    export_table = b''
+    for class_index, super_index, outer, name, flags, serial_size, serial_offset in exports:
+        export_table += compact_index(class_index) + compact_index(super_index) + struct.pack('<i', outer)
+        export_table += compact_index(name) + struct.pack('<I', flags) + compact_index(serial_size)
+        if serial_size > 0:
+            export_table += compact_index(serial_offset)
+
+    name_offset = HEADER.size
+    import_offset = name_offset + len(name_table)
+    export_offset = import_offset + len(import_table)
+    header = HEADER.pack(PACKAGE_TAG, version, 0, 1, len(names), name_offset, len(exports), export_offset,
+                         len(imports), import_offset)
+    return header + name_table + import_table + export_table
+
+
+@pytest.mark.parametrize('version', [NAME_LENGTH_VERSION - 1, 128])
+def test_parse_package(version):
+    package = parse_package(build_package(version))
+
+    assert package.version == version
+    assert package.names[:9] == ['Core', 'Engine', 'Package', 'Class', 'Texture', 'Textures', 'Rock', 'MyLevel',
+                                 LONG_NAME]
+    assert package.names[-2:] == ['Sky', 'StaticMesh']
+    if version >= NAME_LENGTH_VERSION:
+        assert package.names[9] == UNICODE_NAME
+    assert package.imports == [
+        PackageImport('Core', 'Package', 0, 'Textures'),
+        PackageImport('Engine', 'Texture', -1, 'Rock'),
+        PackageImport('Core', 'Package', 0, 'Engine'),
+        PackageImport('Core', 'Class', -3, 'Texture'),
+    ]
+    assert package.exports == [
+        PackageExport(0, 0, 0, 'Sky', 0x70004, 0, 0),
+        PackageExport(-4, 0, 1, LONG_NAME, 0x4, 100000, 1234567),
+    ]
+    assert package.get_object_path(-2) == 'Textures.Rock'
+    assert package.get_object_path(2) == f'Sky.{LONG_NAME}'
+    assert package.get_export_class_name(package.exports[0]) == 'Class'
+    assert package.get_export_class_name(package.exports[1]) == 'Texture'
+    # The `Engine` class is left out, since it is not an asset.
+    assert package.get_referenced_package_names() == {'textures'}
+
+
+@pytest.mark.parametrize('value', [0, 1, -1, 63, -63, 64, -64, 8191, 8192, -100000, 2 ** 30])
+def test_compact_index(value):
+    data = compact_index(value) + b'\xff'
+    assert _read_compact_index(data, 0) == (value, len(data) - 1)
+
+
+def test_skip_exports():
+    package = parse_package(build_package(128), read_exports=False)
+    assert len(package.imports) == 4
+    assert package.exports == []
+
+
+def test_invalid_packages():
+    data = build_package(128)
+    with pytest.raises(PackageError, match='truncated header'):
+        parse_package(data[:HEADER.size - 1])
+    with pytest.raises(PackageError, match='not an Unreal package'):
+        parse_package(b'\0' * 4 + data[4:])
+    with pytest.raises(PackageError, match='truncated or corrupt tables'):
+        parse_package(data[:-4])
+    with pytest.raises(PackageError, match='unterminated name'):
+        parse_package(build_package(NAME_LENGTH_VERSION - 1)[:HEADER.size + 2])
+
+
+def test_invalid_outer():
+    package = parse_package(build_package(128))
+    package.imports[0] = package.imports[0]._replace(outer=-100)
+    with pytest.raises(PackageError, match='invalid outer'):
+        package.get_referenced_package_names()
+
+
+def test_read_package(tmp_path):
+    path = tmp_path / 'MyLevel.ut2'
+    path.write_bytes(build_package(128))
+    assert read_referenced_package_names(str(path)) == {'textures'}
+
+    path.write_bytes(b'')
+    with pytest.raises(PackageError, match='empty file'):
+        read_package(str(path))
+    assert read_referenced_package_names(str(path)) is None
+
+    path.write_bytes(build_package(128)[:100])
+    assert read_referenced_package_names(str(path)) is None
+    assert read_referenced_package_names(str(tmp_path / 'Missing.ut2')) is None
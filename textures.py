@@ -0,0 +1,202 @@
+import asyncio
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple, List, Iterable
+
+import numpy as np
+
+from cubemap import read_tga
+from dedup import content_store
+
+# Transcodes the TGA files that umodel exports to compressed PNG files, along with smaller proxies of them, so that
+# libraries can reference images that are far quicker to load (e.g., when opening a map in Blender).
+
+TEXTURE_DIRECTORY_NAME = '.bdktextures'
+# Bump this to transcode every texture again (e.g., when the output changes).
+TEXTURE_VERSION = 1
+
+# The versions of the textures that libraries can reference instead of the exported TGA files, by the suffix of their
+# files and how many times smaller they are.
+TEXTURE_VARIANTS = {
+    'png': ('.png', 1),
+    'half': ('.half.png', 2),
+    'quarter': ('.quarter.png', 4),
+}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+# Textures are mostly smooth, so each row is stored as its difference from the row above it.
+PNG_FILTER_UP = 2
+PNG_COMPRESSION_LEVEL = 6
+
+
+def get_texture_directory(package_path: str) -> str:
+    # Returns where the transcoded textures of the package (relative to the root directory) are written, which is laid
+    # out like its export directory.
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    return os.path.splitext(os.path.join(build_directory, TEXTURE_DIRECTORY_NAME, package_path))[0]
+
+
+def _write_png_chunk(f, chunk_type: bytes, data: bytes):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def write_png(path: str, image: np.ndarray):
+    # Writes a (height, width, channels) array in BGR(A) order (see `cubemap.read_tga`) as an 8-bit PNG file.
+    height, width, channels = image.shape
+    if channels >= 3:
+        # PNG stores RGB(A).
+        image = image[:, :, [2, 1, 0, 3][:channels]]
+    rows = np.ascontiguousarray(image).reshape(height, width * channels)
+    filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+    filtered[:, 0] = PNG_FILTER_UP
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        _write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0))
+        _write_png_chunk(f, b'IDAT', zlib.compress(filtered.tobytes(), PNG_COMPRESSION_LEVEL))
+        _write_png_chunk(f, b'IEND', b'')
+
+
+def downscale(image: np.ndarray) -> np.ndarray:
+    # Halves the size of the image by averaging each 2x2 block of pixels. Odd rows and columns at the edge are dropped,
+    # and images that are one pixel wide or high aren't scaled down in that direction.
+    height, width, channels = image.shape
+    if height > 1:
+        image = image[:height - height % 2]
+        image = (image[0::2].astype(np.uint16) + image[1::2]) // 2
+    if width > 1:
+        image = image[:, :width - width % 2]
+        image = (image[:, 0::2].astype(np.uint16) + image[:, 1::2]) // 2
+    return image.astype(np.uint8)
+
+
+def get_transcoded_paths(output_base: str) -> List[str]:
+    return [output_base + suffix for suffix, _ in TEXTURE_VARIANTS.values()]
+
+
+def is_texture_up_to_date(source_path: str, output_base: str) -> bool:
+    try:
+        source_time = os.stat(source_path).st_mtime
+        return all(os.stat(x).st_mtime >= source_time for x in get_transcoded_paths(output_base))
+    except OSError:
+        return False
+
+
+def transcode_texture(source_path: str, output_base: str) -> Tuple[int, int]:
+    # Writes every variant of the texture (see `TEXTURE_VARIANTS`) next to `output_base`, and returns the size of the
+    # exported file and that of the full-size PNG file. This runs in the processes of the transcoder's pool.
+    image = read_tga(source_path)
+    os.makedirs(os.path.dirname(output_base), exist_ok=True)
+    output_size = 0
+    scale = 1
+    for suffix, variant_scale in sorted(TEXTURE_VARIANTS.values(), key=lambda x: x[1]):
+        while scale < variant_scale:
+            image = downscale(image)
+            scale *= 2
+        path = output_base + suffix
+        # Written to a temporary file first, so that a texture that was interrupted is never mistaken for a complete one.
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+        os.close(fd)
+        try:
+            write_png(temporary_path, image)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        if scale == 1:
+            output_size = os.path.getsize(path)
+    return os.path.getsize(source_path), output_size
+
+
+def get_texture_key(file_hash: str, suffix: str) -> str:
+    # Transcoded textures are kept in the content store under the hash of the exported file (see `dedup.py`).
+    return f'{file_hash}.t{TEXTURE_VERSION}{suffix}'
+
+
+def restore_texture(source_path: str, output_base: str, file_hash: str) -> Optional[Tuple[int, int]]:
+    # Links the variants of a texture that was already transcoded for another package from the content store, and
+    # returns the same sizes as `transcode_texture`, or None if they aren't all stored.
+    for suffix, _ in TEXTURE_VARIANTS.values():
+        if not content_store.restore(get_texture_key(file_hash, suffix), output_base + suffix):
+            return None
+    return os.path.getsize(source_path), os.path.getsize(output_base + TEXTURE_VARIANTS['png'][0])
+
+
+def store_texture(output_base: str, file_hash: str):
+    for suffix, _ in TEXTURE_VARIANTS.values():
+        try:
+            content_store.add(output_base + suffix, get_texture_key(file_hash, suffix))
+        except OSError as e:
+            print(f'Failed to deduplicate {output_base + suffix}: {e}')
+
+
+def remove_stale_textures(texture_directory: str, output_bases: Iterable[str]):
+    # Removes the transcoded textures of textures that the package no longer exports.
+    expected_paths = set(path for output_base in output_bases for path in get_transcoded_paths(output_base))
+    for directory, _, filenames in os.walk(texture_directory):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if path not in expected_paths:
+                os.remove(path)
+
+
+# Transcodes textures in a pool of processes, since compressing images is CPU-bound. Which variant libraries reference
+# is set from the command line (`tga` references the exported files, and doesn't transcode anything).
+class TextureTranscoder:
+
+    def __init__(self, variant: str = 'tga', job_count: Optional[int] = None):
+        self.variant = variant
+        self.job_count = job_count
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.variant in TEXTURE_VARIANTS
+
+    @property
+    def suffix(self) -> str:
+        return TEXTURE_VARIANTS[self.variant][0]
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process with running threads (e.g., the process engine) isn't safe.
+                self._executor = ProcessPoolExecutor(max_workers=self.job_count,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    async def transcode(self, source_path: str, output_base: str, file_hash: Optional[str] = None) -> Tuple[int, int]:
+        # Textures that other packages export as well (e.g., copies of retail packages in mods) are only transcoded
+        # once when the content store is enabled.
+        use_content_store = file_hash is not None and content_store.is_enabled
+        if use_content_store:
+            sizes = await asyncio.to_thread(restore_texture, source_path, output_base, file_hash)
+            if sizes is not None:
+                return sizes
+        sizes = await asyncio.get_running_loop().run_in_executor(self._get_executor(), transcode_texture, source_path,
+                                                                 output_base)
+        if use_content_store:
+            await asyncio.to_thread(store_texture, output_base, file_hash)
+        return sizes
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+# Shared by every stage, and set from the command line.
+texture_transcoder = TextureTranscoder()
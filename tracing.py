@@ -0,0 +1,171 @@
+import asyncio
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Dict, List, Any
+
+TRACE_DIRECTORY_NAME = '.bdktraces'
+
+
+def get_trace_directory() -> str:
+    build_directory = str(Path(os.environ['BUILD_DIRECTORY']).resolve())
+    return os.path.join(build_directory, TRACE_DIRECTORY_NAME)
+
+
+def _get_lane() -> int:
+    # Spans are laid out by thread, except for those of coroutines on the process engine (see
+    # `processes.ProcessEngine`), which share a thread and are laid out by task instead.
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+
+# Records timed spans as Chrome trace events (https://ui.perfetto.dev opens them). Timestamps are wall-clock
+# microseconds so that spans reported by child processes (e.g., the phases of a Blender job) line up with ours.
+class Tracer:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events: List[Dict[str, Any]] = []
+        self.start_time = time.time()
+
+    def add_span(self, name: str, category: str, start: float, duration: float, **args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1_000_000),
+            'dur': int(duration * 1_000_000),
+            'pid': os.getpid(),
+            'tid': _get_lane(),
+            'args': args
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, category: str = 'build', **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.time() - start, **args)
+
+    def save(self, command: str) -> Optional[str]:
+        # Writes the trace and its summary to the trace directory, and returns the path of the trace.
+        if not self.events:
+            return None
+        trace_directory = get_trace_directory()
+        os.makedirs(trace_directory, exist_ok=True)
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start_time)) + f'-{command}'
+        path = os.path.join(trace_directory, f'{name}.json')
+        with self._lock:
+            trace = {
+                'traceEvents': list(self.events),
+                'displayTimeUnit': 'ms',
+                'metadata': {'command': command, 'start_time': self.start_time, 'end_time': time.time()}
+            }
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+        summary = format_summary(summarize(trace))
+        with open(os.path.join(trace_directory, f'{name}.txt'), 'w') as f:
+            f.write(summary)
+        print(summary, end='')
+        print(f'Trace written to {path}')
+        return path
+
+
+# Shared by every stage of the build.
+tracer = Tracer()
+
+
+def summarize(trace: Dict[str, Any]) -> Dict[str, Any]:
+    # Returns the total time spent in each kind of span, and the time spent on each package across every stage.
+    metadata = trace.get('metadata', {})
+    spans: Dict[str, Dict[str, float]] = {}
+    packages: Dict[str, float] = {}
+    for event in trace['traceEvents']:
+        if event.get('ph') != 'X':
+            continue
+        duration = event['dur'] / 1_000_000
+        span = spans.setdefault(event['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+        span['count'] += 1
+        span['total'] += duration
+        span['max'] = max(span['max'], duration)
+        package = event.get('args', {}).get('package', None)
+        # Spans reported from inside a Blender job are already counted by the job's own span.
+        if package is not None and event.get('cat') != 'blender':
+            packages[package] = packages.get(package, 0.0) + duration
+    return {
+        'command': metadata.get('command', None),
+        'start_time': metadata.get('start_time', None),
+        'wall_time': metadata.get('end_time', 0.0) - metadata.get('start_time', 0.0),
+        'spans': spans,
+        'packages': packages
+    }
+
+
+def format_summary(summary: Dict[str, Any], package_count: int = 10) -> str:
+    lines = [f'Wall time: {summary["wall_time"]:.1f}s']
+    for name, span in sorted(summary['spans'].items(), key=lambda x: -x[1]['total']):
+        lines.append(f'{name:<24} {span["count"]:>6} span(s) {span["total"]:>10.1f}s total {span["max"]:>8.1f}s max')
+    slowest_packages = sorted(summary['packages'].items(), key=lambda x: -x[1])[:package_count]
+    if slowest_packages:
+        lines.append('Slowest packages:')
+        for package, duration in slowest_packages:
+            lines.append(f'{duration:>10.1f}s {package}')
+    return '\n'.join(lines) + '\n'
+
+
+def load_summaries(command: Optional[str] = None) -> List[Dict[str, Any]]:
+    # Returns the summaries of the recorded runs, oldest first.
+    summaries = []
+    for path in sorted(glob.glob(os.path.join(get_trace_directory(), '*.json'))):
+        with open(path, 'r') as f:
+            summary = summarize(json.load(f))
+        if command is None or summary['command'] == command:
+            summary['path'] = path
+            summaries.append(summary)
+    return summaries
+
+
+def print_stats(command: Optional[str] = None, run_count: int = 5, package_count: int = 10):
+    # Compares the latest run with the average of the runs before it.
+    summaries = load_summaries(command)
+    if not summaries:
+        print('No traces recorded')
+        return
+    latest, previous = summaries[-1], summaries[-run_count - 1:-1]
+    print(f'Latest run: {os.path.basename(latest["path"])}')
+    print(format_summary(latest, package_count), end='')
+    if not previous:
+        return
+
+    def average(values: List[float]) -> float:
+        return sum(values) / len(values)
+
+    print(f'Compared with the average of the {len(previous)} previous run(s):')
+    wall_time = average([x['wall_time'] for x in previous])
+    print(f'{"wall time":<24} {wall_time:>10.1f}s -> {latest["wall_time"]:>10.1f}s')
+    names = sorted(set(latest['spans']).union(*[x['spans'] for x in previous]))
+    for name in names:
+        before = average([x['spans'].get(name, {}).get('total', 0.0) for x in previous])
+        after = latest['spans'].get(name, {}).get('total', 0.0)
+        print(f'{name:<24} {before:>10.1f}s -> {after:>10.1f}s')
+
+    # Packages that were built in both are compared, since incremental runs only build a few of them.
+    changes = []
+    for package, duration in latest['packages'].items():
+        durations = [x['packages'][package] for x in previous if package in x['packages']]
+        if durations:
+            changes.append((duration - average(durations), package))
+    if changes:
+        print('Largest slowdowns:')
+        for change, package in sorted(changes, reverse=True)[:package_count]:
+            print(f'{change:>+10.1f}s {package}')
@@ -0,0 +1,101 @@
+import os
+import time
+from pathlib import Path
+from typing import Optional, Set, Union
+
+from artifacts import artifact_cache
+from build import BuildManifest, PACKAGE_SUFFIXES, get_asset_directories, find_packages_to_export, \
+    find_out_of_date_packages, remove_package, export_packages, build_cube_maps, find_packages_to_blend, \
+    blend_packages, get_blend_job_count, trim_content_store
+from scanner import ScannedFile, read_ignore_patterns
+from watcher import create_watcher
+from workers import BlenderWorkerPool
+
+
+def rebuild_changed_packages(manifest: BuildManifest, pool: BlenderWorkerPool, blend_job_count: int,
+                             changed_paths: Optional[Set[str]], mod: Optional[str] = None,
+                             name_filter: Optional[str] = None, cubemap_engine: str = 'blender',
+                             export_jobs: Union[int, str] = 'auto', cubemap_jobs: Union[int, str] = 'auto'):
+    # Exports and blends the packages that changed, or everything that is out-of-date if `changed_paths` is None.
+    # Only the changed packages are looked at, so a rebuild doesn't have to scan the whole tree.
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    start = time.monotonic()
+
+    if changed_paths is None:
+        packages_to_export, pending_updates = find_packages_to_export(manifest, mod, name_filter=name_filter)
+    else:
+        scanned_files = {}
+        for path in sorted(changed_paths):
+            package_path = os.path.relpath(path, root_directory)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if package_path in manifest.files:
+                    print(f'{path} no longer exists!')
+                    remove_package(manifest, package_path)
+                continue
+            scanned_files[path] = ScannedFile(path, stat.st_mtime, stat.st_size)
+        packages_to_export, pending_updates = find_out_of_date_packages(manifest, scanned_files, name_filter=name_filter)
+        for path in scanned_files:
+            manifest.commit_file(os.path.relpath(path, root_directory))
+
+    export_packages(manifest, packages_to_export, pending_updates, export_jobs)
+    exported_package_paths = set(os.path.relpath(x, root_directory) for x in packages_to_export)
+
+    if changed_paths is None or len(exported_package_paths) > 0:
+        build_cube_maps(name_filter=name_filter, engine=cubemap_engine, jobs=cubemap_jobs,
+                        package_paths=exported_package_paths if changed_paths is not None else None)
+
+    package_paths_to_build = find_packages_to_blend(manifest, name_filter=name_filter)
+    if changed_paths is not None:
+        package_paths_to_build = [x for x in package_paths_to_build if x in exported_package_paths]
+    success_count, failure_count = blend_packages(manifest, pool, package_paths_to_build, blend_job_count, verbose=False)
+    artifact_cache.trim()
+    trim_content_store()
+
+    print(f'{len(packages_to_export)} exported | {success_count} Succeeded | {failure_count} Failed '
+          f'({time.monotonic() - start:.1f}s)')
+
+
+def watch_assets(
+        mod: Optional[str] = None,
+        name_filter: Optional[str] = None,
+        cubemap_engine: str = 'blender',
+        export_jobs: Union[int, str] = 'auto',
+        cubemap_jobs: Union[int, str] = 'auto',
+        blend_jobs: Union[int, str] = 'auto',
+        worker_max_jobs: int = 100,
+        worker_max_memory: Optional[int] = None,
+        debounce: float = 1.0,
+        polling: bool = False,
+        poll_interval: float = 2.0):
+    # Rebuilds packages as soon as they are saved, until interrupted. A Blender worker is kept running between
+    # rebuilds, so that a single package is blended without waiting for Blender to start.
+    root_directory = str(Path(os.environ['ROOT_DIRECTORY']).resolve())
+    manifest = BuildManifest.load()
+    blend_job_count = get_blend_job_count(blend_jobs)
+
+    # Changes are watched for before catching up, so that nothing saved in the meantime is missed.
+    with create_watcher(get_asset_directories(mod), PACKAGE_SUFFIXES, read_ignore_patterns(root_directory), polling,
+                        poll_interval) as watcher, \
+            BlenderWorkerPool(blend_job_count, max_jobs=worker_max_jobs, max_memory=worker_max_memory) as pool:
+        pool.warm_up()
+        rebuild_changed_packages(manifest, pool, blend_job_count, None, mod, name_filter, cubemap_engine, export_jobs,
+                                 cubemap_jobs)
+        print(f'Watching for changes with {type(watcher).__name__} (press Ctrl+C to stop)')
+        try:
+            while True:
+                changed_paths = watcher.read_debounced_changes(debounce)
+                if changed_paths is not None and len(changed_paths) == 0:
+                    continue
+                if changed_paths is None:
+                    print('Lost track of changes, looking for out-of-date packages')
+                else:
+                    print(f'{len(changed_paths)} package(s) changed: '
+                          f'{", ".join(sorted(os.path.relpath(x, root_directory) for x in changed_paths))}')
+                rebuild_changed_packages(manifest, pool, blend_job_count, changed_paths, mod, name_filter,
+                                         cubemap_engine, export_jobs, cubemap_jobs)
+                # A worker that was recycled (or crashed) is replaced before the next change comes in.
+                pool.warm_up()
+        except KeyboardInterrupt:
+            print('Stopped watching')
@@ -0,0 +1,199 @@
+import abc
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Iterable, Optional, Set, Dict, List
+
+from scanner import IgnoreMatcher, ScannedFile, scan
+
+# See `inotify(7)`.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# Files are reported once they are closed after writing (not on every write), so that packages are only rebuilt once
+# they have been saved completely.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+# Reports which files in a set of directories (and their subdirectories) were created, changed or deleted.
+# `read_changes` returns None when the changes could not be tracked (e.g., the kernel dropped events), in which case
+# every file may have changed.
+class FileWatcher(abc.ABC):
+
+    def __init__(self, directories: Iterable[str], suffixes: Iterable[str], ignore_patterns: Iterable[str] = ()):
+        self.directories = [x for x in directories if os.path.isdir(x)]
+        self.suffixes = tuple(suffixes)
+        self.matcher = IgnoreMatcher(ignore_patterns)
+
+    def is_watched_file(self, path: str) -> bool:
+        return os.path.splitext(path)[1] in self.suffixes and not self.matcher.is_ignored(path)
+
+    @abc.abstractmethod
+    def read_changes(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        # Waits up to `timeout` seconds (or until there are changes, if it's None), and returns the paths of the
+        # files that changed.
+        pass
+
+    def read_debounced_changes(self, debounce: float) -> Optional[Set[str]]:
+        # Waits for changes, and then until no more arrive for `debounce` seconds, so that a burst of writes (e.g.,
+        # saving several packages, or an editor writing a file in several steps) is reported at once.
+        changes = self.read_changes()
+        while True:
+            more_changes = self.read_changes(debounce)
+            if more_changes is not None and len(more_changes) == 0:
+                return changes
+            changes = None if changes is None or more_changes is None else changes | more_changes
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'FileWatcher':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Watches the directories with inotify, which tells about changes as they happen without scanning anything.
+class InotifyWatcher(FileWatcher):
+
+    def __init__(self, directories: Iterable[str], suffixes: Iterable[str], ignore_patterns: Iterable[str] = ()):
+        super().__init__(directories, suffixes, ignore_patterns)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._directories_by_descriptor: Dict[int, str] = {}
+        try:
+            for directory in self.directories:
+                self._add_directory_tree(directory)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _add_directory(self, directory: str):
+        descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if descriptor < 0:
+            errno = ctypes.get_errno()
+            # Running out of watches (`fs.inotify.max_user_watches`) fails the watcher, since changes would be missed.
+            raise OSError(errno, f'Could not watch {directory}: {os.strerror(errno)}')
+        self._directories_by_descriptor[descriptor] = directory
+
+    def _add_directory_tree(self, directory: str) -> List[str]:
+        # Watches the directory and its subdirectories, and returns the files already in them. Those may have been
+        # written before the watch was added (e.g., a directory that was moved in).
+        files = []
+        for path, directory_names, filenames in os.walk(directory):
+            directory_names[:] = [x for x in directory_names if not self.matcher.is_directory_ignored(os.path.join(path, x))]
+            self._add_directory(path)
+            files += [os.path.join(path, x) for x in filenames]
+        return files
+
+    def _read_events(self) -> Optional[Set[str]]:
+        changes = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self._directories_by_descriptor.pop(descriptor, None)
+                    continue
+                directory = self._directories_by_descriptor.get(descriptor, None)
+                if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    continue
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and not self.matcher.is_directory_ignored(path):
+                        try:
+                            changes.update(self._add_directory_tree(path))
+                        except FileNotFoundError:
+                            pass
+                    elif mask & (IN_MOVED_FROM | IN_DELETE):
+                        # Whatever was in the directory is gone, which only a full scan can tell.
+                        return None
+                elif not mask & IN_CREATE:
+                    # Creating a file is followed by writing and closing it.
+                    changes.add(path)
+
+    def read_changes(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        changes = self._read_events()
+        if changes is None:
+            return None
+        return set(x for x in changes if self.is_watched_file(x))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+# Finds changes by scanning the directories periodically, comparing the modification time and size of each file.
+# Each scan stats every file once, in parallel (see `scanner.scan`).
+class PollingWatcher(FileWatcher):
+
+    def __init__(self, directories: Iterable[str], suffixes: Iterable[str], ignore_patterns: Iterable[str] = (),
+                 interval: float = 2.0):
+        super().__init__(directories, suffixes, ignore_patterns)
+        self.ignore_patterns = list(ignore_patterns)
+        self.interval = interval
+        self._files = self._scan()
+        self._next_scan_time = time.monotonic() + interval
+
+    def _scan(self) -> Dict[str, ScannedFile]:
+        return scan(self.directories, self.suffixes, self.ignore_patterns)
+
+    def read_changes(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            now = time.monotonic()
+            if now >= self._next_scan_time:
+                self._next_scan_time = now + self.interval
+                files = self._scan()
+                changes = files.keys() ^ self._files.keys()
+                changes.update(x for x, file in files.items() if x in self._files and self._files[x] != file)
+                self._files = files
+                if changes:
+                    return changes
+                continue
+            if deadline is not None and now >= deadline:
+                return set()
+            time.sleep((self._next_scan_time if deadline is None else min(self._next_scan_time, deadline)) - now)
+
+
+def create_watcher(directories: Iterable[str], suffixes: Iterable[str], ignore_patterns: Iterable[str] = (),
+                   polling: bool = False, interval: float = 2.0) -> FileWatcher:
+    # Watches with inotify where it's available, and falls back to polling elsewhere (e.g., on Windows, or when
+    # there aren't enough inotify watches).
+    directories = list(directories)
+    ignore_patterns = list(ignore_patterns)
+    if not polling and hasattr(os, 'O_CLOEXEC') and os.uname().sysname == 'Linux':
+        try:
+            return InotifyWatcher(directories, suffixes, ignore_patterns)
+        except (OSError, AttributeError) as e:
+            print(f'Could not use inotify ({e}), polling for changes instead')
+    return PollingWatcher(directories, suffixes, ignore_patterns, interval)
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import sys
+import json
+import threading
+import time
+from queue import Queue, Empty
+from typing import Optional, List, Callable
+
+from processes import ProcessWatchdog, kill_process_tree, process_engine, read_line
+from resources import get_process_memory_usage, memory_gate, BLENDER_MEMORY_ESTIMATE
+from tracing import tracer
+
+# Must match the prefix written by `blender/blend.py` in worker mode.
+WORKER_RESULT_PREFIX = 'BDK_WORKER_RESULT:'
+
+
+# A long-running Blender process that runs the jobs (e.g., building a package) sent to it over stdin. The process and
+# its pipes are handled by the process engine, and the methods block the calling thread until it is done with them.
+class BlenderWorker:
+
+    def __init__(self, low_priority: bool = False):
+        args = [
+            os.environ['BLENDER_PATH'],
+            '--background',
+            './blender/build_template.blend',
+            '--python',
+            './blender/blend.py',
+            '--',
+            'worker'
+        ]
+        self.start_time = time.time()
+        self.process = process_engine.run(process_engine.start_process(args, low_priority, stdin=asyncio.subprocess.PIPE,
+                                                                       stdout=asyncio.subprocess.PIPE))
+        # Kills the worker if a job takes too long or hangs, after which the pool starts a new one.
+        self.watchdog = ProcessWatchdog(self.process)
+        self.watchdog.start()
+        self.job_count = 0
+        self._is_closed = False
+
+    @property
+    def is_alive(self) -> bool:
+        return self.process.returncode is None
+
+    @property
+    def memory_usage(self) -> Optional[int]:
+        return get_process_memory_usage(self.process.pid)
+
+    async def _run(self, job: dict, on_output: Callable[[str], None]) -> Optional[dict]:
+        # Returns None if the worker exits before reporting a result.
+        try:
+            self.process.stdin.write((json.dumps(job) + '\n').encode())
+            await self.process.stdin.drain()
+        except (OSError, RuntimeError):
+            return None
+        # Forward the worker's output until it reports the result of the job.
+        while True:
+            line = await read_line(self.process.stdout)
+            if line == '':
+                return None
+            self.watchdog.notify_output()
+            if line is None:
+                continue
+            if line.startswith(WORKER_RESULT_PREFIX):
+                return json.loads(line[len(WORKER_RESULT_PREFIX):])
+            on_output(line)
+
+    def run(self, job: dict, timeout: Optional[float] = None, on_output: Optional[Callable[[str], None]] = None) -> dict:
+        # Returns the result that the worker reported for the job (see `worker` in `blender/blend.py`), forwarding the
+        # output of the job to `on_output` (stdout by default). If the worker exits (or is killed) before reporting
+        # one, the result has `crashed` set.
+        if on_output is None:
+            on_output = sys.stdout.write
+        self.job_count += 1
+        # Memory is admitted for each job rather than for the life of the worker, since idle workers don't grow. The
+        # memory that the worker already uses is observed by the gate, so only the rest of the estimate is admitted.
+        estimate = max(0, BLENDER_MEMORY_ESTIMATE - (self.memory_usage or 0))
+        with memory_gate.admit(estimate):
+            self.watchdog.start_job(timeout)
+            try:
+                result = process_engine.run(self._run(job, on_output))
+            finally:
+                self.watchdog.end_job()
+        if result is not None:
+            self._trace(job, result)
+            return result
+        # The process exited before reporting a result (e.g., it crashed, or the watchdog killed it).
+        reason = self.watchdog.reason or 'exited'
+        if self.watchdog.reason is not None:
+            on_output(f'Killed Blender worker ({reason})\n')
+        return {'success': False, 'crashed': True, 'error': reason}
+
+    def _trace(self, job: dict, result: dict):
+        if self.job_count == 1 and 'ready_time' in result:
+            tracer.add_span('blender_startup', 'blender', self.start_time, result['ready_time'] - self.start_time)
+        path = job.get('input_directory', job.get('blend_path', None))
+        for span in result.get('spans', []):
+            tracer.add_span(span['name'], 'blender', span['start'], span['duration'], path=path)
+
+    async def _close(self):
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            kill_process_tree(self.process)
+            await self.process.wait()
+
+    def close(self):
+        if self._is_closed:
+            return
+        self._is_closed = True
+        self.watchdog.stop()
+        process_engine.run(self._close())
+
+
+# A pool of Blender workers. Workers are started lazily and are recycled once they have built `max_jobs` packages or
+# their memory usage exceeds `max_memory` bytes.
+class BlenderWorkerPool:
+
+    def __init__(self, worker_count: int = 1, max_jobs: int = 100, max_memory: Optional[int] = None,
+                 low_priority: bool = False):
+        self.worker_count = max(1, worker_count)
+        self.low_priority = low_priority
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        # A `None` entry is a free slot that a new worker will be started in when it is acquired.
+        self._idle_workers: Queue = Queue()
+        for _ in range(self.worker_count):
+            self._idle_workers.put(None)
+        self._workers: List[BlenderWorker] = []
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> BlenderWorker:
+        worker = self._idle_workers.get()
+        if worker is None:
+            worker = BlenderWorker(self.low_priority)
+            with self._lock:
+                self._workers.append(worker)
+        return worker
+
+    def _should_recycle(self, worker: BlenderWorker) -> bool:
+        if not worker.is_alive:
+            return True
+        if self.max_jobs and worker.job_count >= self.max_jobs:
+            return True
+        if self.max_memory:
+            memory_usage = worker.memory_usage
+            if memory_usage is not None and memory_usage > self.max_memory:
+                return True
+        return False
+
+    def _release(self, worker: BlenderWorker):
+        if self._should_recycle(worker):
+            worker.close()
+            with self._lock:
+                self._workers.remove(worker)
+            self._idle_workers.put(None)
+        else:
+            self._idle_workers.put(worker)
+
+    def warm_up(self, count: int = 1):
+        # Starts workers in free slots until `count` are running, so that the next jobs don't wait for Blender to
+        # start (e.g., after a worker was recycled).
+        slots = []
+        while True:
+            try:
+                slots.append(self._idle_workers.get_nowait())
+            except Empty:
+                break
+        try:
+            for i, worker in enumerate(slots):
+                with self._lock:
+                    if len(self._workers) >= count:
+                        break
+                if worker is None:
+                    slots[i] = BlenderWorker(self.low_priority)
+                    with self._lock:
+                        self._workers.append(slots[i])
+        finally:
+            for worker in slots:
+                self._idle_workers.put(worker)
+
+    def run(self, job: dict, timeout: Optional[float] = None, on_output: Optional[Callable[[str], None]] = None) -> dict:
+        worker = self._acquire()
+        try:
+            return worker.run(job, timeout, on_output)
+        finally:
+            self._release(worker)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers.clear()
+
+    def __enter__(self) -> 'BlenderWorkerPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()